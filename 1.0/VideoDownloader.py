@@ -1,77 +1,162 @@
-import requests  
-import keyboard  
-import os  
-import threading  
-import concurrent.futures 
-from tqdm import tqdm  
-from requests_html import HTMLSession  
-from win10toast import ToastNotifier  # 导入ToastNotifier类
-
-# 创建ToastNotifier实例
-toaster = ToastNotifier()
+import os
+import re
+import shutil
+import subprocess
+import threading
+import concurrent.futures
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from requests_html import HTMLSession
+
+# keyboard 和 win10toast 只在 Windows 上可用，其他平台使用 Ctrl+C 停止、notify-send 通知
+try:
+    import keyboard
+except ImportError:
+    keyboard = None
+
+try:
+    from win10toast import ToastNotifier  # 导入ToastNotifier类
+except ImportError:
+    ToastNotifier = None
+
+# 每次从网络读取并写入文件的块大小
+CHUNK_SIZE = 1024 * 1024
+
+# 用于控制是否应停止下载的事件，所有下载线程共享
+stop_event = threading.Event()
+
 
 # 定义一个函数，用于设置下载目录
 def set_download_directory():
     while True:
-        download_dir = input("输入下载目录的路径: ").strip()  
-        if os.path.isdir(download_dir):  
-            os.chdir(download_dir)  
+        download_dir = input("输入下载目录的路径: ").strip()
+        if os.path.isdir(download_dir):
+            os.chdir(download_dir)
             print(f"下载目录已设置为: {download_dir}")
             break
         else:
             print("无效的目录路径，请输入有效的目录路径.")
 
-# 设置下载目录
-set_download_directory()
 
-# 用于控制是否应停止下载的全局变量
-should_stop = False  
+# 定义一个函数，当按下Esc键或Ctrl+C时，设置停止事件
+def should_stop_download():
+    if not stop_event.is_set():
+        stop_event.set()
+        print("用户停止了下载.")
+
+
+# 设置Esc键的监听事件，keyboard 不可用或没有权限时只能使用 Ctrl+C
+def register_stop_hotkey():
+    if keyboard is None:
+        return False
+    try:
+        keyboard.add_hotkey('esc', should_stop_download)
+    except Exception:
+        return False
+    return True
+
+
+# 发送桌面通知: Windows 使用 win10toast，Linux 使用 notify-send，都不可用时只打印
+class Notifier:
+    def __init__(self):
+        self.toaster = None
+        self.notify_send = None
+        if ToastNotifier is not None:
+            self.toaster = ToastNotifier()
+        else:
+            self.notify_send = shutil.which("notify-send")
 
-# 定义一个函数，当按下Esc键时，将should_stop设置为True
-def should_stop_download():  
-    global should_stop  
-    should_stop = True  
-    print("用户停止了下载.")  
+    def notify(self, title, message):
+        if self.toaster is not None:
+            self.toaster.show_toast(title, message, duration=5, threaded=True)  # 5秒显示时间
+        elif self.notify_send is not None:
+            subprocess.run([self.notify_send, title, message], check=False)
+        else:
+            print(f"{title}: {message}")
+
+
+# 下载目录的文件名索引: 启动时读取一次目录，之后在内存中分配文件名
+# 分配的文件名会立即占用，多个线程同时下载也不会得到同一个名字
+class DirectoryIndex:
+    def __init__(self, path="."):
+        self.lock = threading.Lock()
+        self.names = set(os.listdir(path))
+        self.counter = 0
+        for name in self.names:
+            match = re.match(r"downloaded_video_(\d+)", name)
+            if match:
+                self.counter = max(self.counter, int(match.group(1)) + 1)
+
+    # 根据原始文件名分配新文件名，使用"downloaded_video_{index}.mp4"的命名方式
+    def allocate(self, original_video_name):
+        with self.lock:
+            new_video_name = f"downloaded_video_{self.counter}.mp4"
+            # 检测是否已存在同名文件，如果存在，则自动重命名
+            while new_video_name in self.names:
+                new_video_name = f"downloaded_video_{self.counter}_{original_video_name}"
+                self.counter += 1
+            self.counter += 1
+            self.names.add(new_video_name)
+            return new_video_name
+
+
+# 创建共用的会话，连接池大小与线程数一致，所有请求复用连接
+def create_session(max_workers, proxies=None):
+    session = HTMLSession()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if proxies:
+        session.proxies.update(proxies)
+    return session
 
-# 设置Esc键的监听事件，当按下Esc时，调用should_stop_download函数
-keyboard.add_hotkey('esc', should_stop_download)  
 
 # 定义一个函数，用于下载单个视频的线程函数
-def download_video(video_url, new_video_name, proxies=None):  # 添加proxies参数
-    global should_stop  
-    
+def download_video(session, video_url, new_video_name, notifier):
+    if stop_event.is_set():
+        return
+    temp_video_name = new_video_name + ".part"
     try:
         # 发送GET请求以下载视频
-        video_response = requests.get(video_url, stream=True, proxies=proxies)  # 使用代理
-        
-        # 检查请求是否成功
-        if video_response.status_code == 200:
+        with session.get(video_url, stream=True) as video_response:
+            # 检查请求是否成功
+            if video_response.status_code != 200:
+                print(f"无法下载视频: {new_video_name}, 状态码: {video_response.status_code}")
+                return
+
             # 获取文件总大小（字节）
             total_size = int(video_response.headers.get('content-length', 0))
-            
+
             # 初始化进度条
             with tqdm(total=total_size, unit='B', unit_scale=True, desc=new_video_name, ascii=True) as pbar:
-                # 打开文件以写入新文件名的视频
-                with open(new_video_name, "wb") as video_file:
+                # 先写入临时文件，下载完成后再重命名
+                with open(temp_video_name, "wb", buffering=CHUNK_SIZE) as video_file:
                     # 遍历视频响应内容并将其写入文件
-                    for chunk in video_response.iter_content(chunk_size=1024):
-                        if should_stop:
+                    for chunk in video_response.iter_content(chunk_size=CHUNK_SIZE):
+                        if stop_event.is_set():
                             print(f"下载已停止: {new_video_name}")
                             return
-                        if chunk:  
+                        if chunk:
                             video_file.write(chunk)
                             # 更新进度条
                             pbar.update(len(chunk))
-            print(f"已下载: {new_video_name}")
-            # 发送通知
-            toaster.show_toast("下载完成", f"已下载视频: {new_video_name}", duration=5)  # 5秒显示时间
-        else:
-            print(f"无法下载视频: {new_video_name}, 状态码: {video_response.status_code}")
+        os.replace(temp_video_name, new_video_name)
+        print(f"已下载: {new_video_name}")
+        # 发送通知
+        notifier.notify("下载完成", f"已下载视频: {new_video_name}")
 
     except Exception as e:
         print(f"下载视频时出错: {new_video_name}, 错误: {str(e)}")
         # 发送异常通知
-        toaster.show_toast("下载出错", f"下载视频时出错: {new_video_name}, 错误: {str(e)}", duration=5)
+        notifier.notify("下载出错", f"下载视频时出错: {new_video_name}, 错误: {str(e)}")
+    finally:
+        # 停止或出错时删除未完成的临时文件，下次运行会重新下载，不会留下无用的 .part 文件
+        if os.path.exists(temp_video_name):
+            try:
+                os.remove(temp_video_name)
+            except OSError:
+                pass
+
 
 # 定义一个函数，用于设置代理服务器
 def set_proxy():
@@ -82,71 +167,87 @@ def set_proxy():
     else:
         return None
 
+
+# 等待所有下载完成，期间按下Ctrl+C会通知所有线程停止
+def wait_for_downloads(futures):
+    pending = set(futures)
+    while pending:
+        try:
+            _, pending = concurrent.futures.wait(pending, timeout=0.5)
+        except KeyboardInterrupt:
+            should_stop_download()
+
+
 # 下载视频的函数
-def download_videos_from_website(max_workers, proxies):  
-    while True:
-        # 获取用户输入的URL
-        url = input("输入要下载视频的网站的URL: ")  
+def download_videos_from_website(session, executor, directory_index, notifier):
+    # 获取用户输入的URL
+    url = input("输入要下载视频的网站的URL: ")
 
-        # 创建HTMLSession实例
-        session = HTMLSession()  
+    try:
+        # 发送GET请求到指定网站
+        response = session.get(url)
 
+        # 检查请求是否成功
+        if response.status_code != 200:
+            print(f"无法获取网站内容，状态码: {response.status_code}")
+            return
+
+        # 从具有"class post__attachment-link"的HTML元素中提取视频链接
+        video_links = response.html.find(".post__attachment-link")
+
+        # 遍历视频链接并下载，使用多线程
+        futures = []
+        for link in video_links:
+            if stop_event.is_set():
+                break
+
+            # 获取视频链接的'href'属性
+            video_url = link.attrs['href']
+
+            # 提取原始视频文件名（不包含查询参数）
+            original_video_name = video_url.split("?")[0].split("/")[-1]
+            new_video_name = directory_index.allocate(original_video_name)
+
+            # 提交下载任务
+            futures.append(executor.submit(download_video, session, video_url, new_video_name, notifier))
+
+        # 等待所有线程完成
+        wait_for_downloads(futures)
+
+    except Exception as e:
+        print(f"获取网站内容时出错: {url}, 错误: {str(e)}")
+        # 发送异常通知
+        notifier.notify("获取网站内容出错", f"获取网站内容时出错: {url}, 错误: {str(e)}")
+
+
+def main():
+    # 设置下载目录
+    set_download_directory()
+
+    # 获取代理设置
+    proxies = set_proxy()
+
+    # 允许用户选择多线程的max_workers大小
+    max_workers = int(input("输入多线程的最大工作线程数: "))
+
+    if register_stop_hotkey():
+        print("按下Esc键或Ctrl+C停止下载.")
+    else:
+        print("按下Ctrl+C停止下载.")
+
+    session = create_session(max_workers, proxies)
+    directory_index = DirectoryIndex()
+    notifier = Notifier()
+
+    # 不断调用下载视频的函数,直到用户停止
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         try:
-            # 发送GET请求到指定网站
-            response = session.get(url)
+            while not stop_event.is_set():
+                download_videos_from_website(session, executor, directory_index, notifier)
+        except (KeyboardInterrupt, EOFError):
+            should_stop_download()
+    session.close()
 
-            # 检查请求是否成功
-            if response.status_code == 200:
-                # 从具有"class post__attachment-link"的HTML元素中提取视频链接
-                video_links = response.html.find(".post__attachment-link")  
-
-                # 初始化下载视频的计数器为0
-                download_counter = 0  
-
-                # 遍历视频链接并下载，使用多线程
-                threads = []
-                with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    for link in video_links:
-                        if should_stop:
-                            print("用户停止了下载.")
-                            break
-
-                        # 获取视频链接的'href'属性
-                        video_url = link.attrs['href']  
-
-                        # 提取原始视频文件名（不包含查询参数）
-                        original_video_name = video_url.split("?")[0].split("/")[-1] 
-
-                        # 根据原始文件名或自定义逻辑创建新文件名，此处使用"downloaded_video_{index}.mp4"的命名方式
-                        new_video_name = f"downloaded_video_{download_counter}.mp4"
-                        #检测是否已存在同名文件，如果存在，则自动重命名
-                        while os.path.exists(new_video_name):
-                            new_video_name = f"downloaded_video_{download_counter}_{original_video_name}"
-                            download_counter += 1  
-                        
-                        # 创建线程并提交下载任务
-                        thread = executor.submit(download_video, video_url, new_video_name, proxies)
-                        threads.append(thread)
-
-                # 等待所有线程完成
-                for thread in threads:
-                    thread.result()
-
-            else:
-                print(f"无法获取网站内容，状态码: {response.status_code}")
-
-        except Exception as e:
-            print(f"获取网站内容时出错: {url}, 错误: {str(e)}")
-            # 发送异常通知
-            toaster.show_toast("获取网站内容出错", f"获取网站内容时出错: {url}, 错误: {str(e)}", duration=5)
-
-# 获取代理设置
-proxies = set_proxy()
-
-# 允许用户选择多线程的max_workers大小
-max_workers = int(input("输入多线程的最大工作线程数: "))
-
-# 不断调用下载视频的函数,直到用户按下Esc键
-while not should_stop:  
-    download_videos_from_website(max_workers, proxies)
 
+if __name__ == "__main__":
+    main()
@@ -16,18 +16,97 @@ from PySide6.QtWidgets import (
     QProgressBar,
     QMessageBox,
     QComboBox,
+    QTableWidget,
+    QTableWidgetItem,
+    QTabWidget,
+    QScrollArea,
 )
-from PySide6.QtCore import QThread, Signal, Slot
+from PySide6.QtCore import Qt, QThread, Signal, Slot
 from collections import deque
 import os
 import re
-import aiofiles
 from bs4 import BeautifulSoup
 import datetime  # 引入datetime模块
+import time
+import random
+import json
+import csv
+import argparse
+import fnmatch
+import contextlib
+import threading
+import hashlib
+import mmap
+import concurrent.futures
+import multiprocessing
+import zipfile
+import subprocess
+import shlex
+import shutil
+import sqlite3
+import tempfile
+import socket
+import secrets
+import errno
+import dataclasses
+import abc
+from typing import Optional
 
+# HTTP/2 需要安装 h2 (pip install httpx[http2])，没有安装时页面请求使用 HTTP/1.1
+try:
+    import h2  # noqa: F401
 
-# 全局哈希表，存储已经下载的文件名
-downloaded_files = set()
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+# 下载目录的内存索引: 每个下载目录只在第一次用到时扫描一次
+# 之后判断文件是否已下载、文件夹是否需要创建都只查哈希表，不再访问磁盘
+class LibraryIndex:
+    def __init__(self):
+        self.files = set()  # 已完成文件的完整路径
+        self.dirs = set()
+        self.roots = set()
+
+    def scan(self, root):
+        root = os.path.abspath(root)
+        if root in self.roots:
+            return
+        self.roots.add(root)
+        for dir_path, _, files in os.walk(root):
+            self.dirs.add(dir_path)
+            for name in files:
+                if not name.endswith((".part", ".corrupt")):
+                    self.files.add(os.path.join(dir_path, name))
+
+    def has_file(self, path):
+        return os.path.abspath(path) in self.files
+
+    def has_attachment(self, root, attachment):
+        return self.has_file(os.path.join(root, attachment.relative_path))
+
+    def add_file(self, path):
+        self.files.add(os.path.abspath(path))
+
+    def discard_file(self, path):
+        self.files.discard(os.path.abspath(path))
+
+    # 创建文件夹，已经创建过的直接跳过
+    def ensure_dir(self, path):
+        path = os.path.abspath(path)
+        if path not in self.dirs:
+            os.makedirs(path, exist_ok=True)
+            while path not in self.dirs and path != os.path.dirname(path):
+                self.dirs.add(path)
+                path = os.path.dirname(path)
+
+
+# 全局的下载目录索引
+library_index = LibraryIndex()
+
+# 代理池支持的代理协议
+PROXY_SCHEMES = ("http", "https", "socks5", "socks5h")
 
 
 # 清理文件名的函数
@@ -37,27 +116,1008 @@ def sanitize_filename(filename):
     return filename
 
 
+# 从列表文件读取代理地址的函数
+# 每行一个代理，例如 socks5://127.0.0.1:1080，省略协议时按 http 处理，# 开头为注释
+def load_proxy_list(path):
+    proxies = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if "://" not in line:
+                line = f"http://{line}"
+            scheme = line.split("://", 1)[0].lower()
+            if scheme not in PROXY_SCHEMES:
+                raise ValueError(f"不支持的代理类型: {line}")
+            if line not in proxies:
+                proxies.append(line)
+    if not proxies:
+        raise ValueError("代理列表文件中没有代理")
+    return proxies
+
+
+# 站点持续封锁时抛出的异常，用于终止任务而不是继续发送注定失败的请求
+class HostBlockedError(Exception):
+    pass
+
+
+# 下载目录所在的磁盘已满，临时下载目录中的文件无法移动时抛出，任务终止而不是重新下载
+class LibraryDiskFullError(Exception):
+    pass
+
+
+# 页面在重试之后仍然无法获取 (403/5xx/连接错误) 时抛出，任务据此报告结果不完整
+class PageFetchError(Exception):
+    def __init__(self, url, reason):
+        super().__init__(f"{url} ({reason})")
+        self.url = url
+        self.reason = reason
+
+
+# 单个站点的熔断状态
+class HostCircuit:
+    def __init__(self, window):
+        self.state = "closed"  # closed 正常 / open 熔断 / half_open 试探
+        self.outcomes = deque(maxlen=window)
+        self.open_until = 0.0
+        self.trips = 0
+        self.probing = False
+        self.blocked = False
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+
+# 按站点熔断: 403/5xx/连接错误的比例超过阈值时暂停该站点的所有请求，
+# 等待一段时间后只放行一个试探请求，成功则恢复，失败则继续熔断并延长等待时间
+class CircuitBreaker:
+    def __init__(
+        self,
+        error_rate=0.5,
+        window=20,
+        min_requests=5,
+        open_seconds=30,
+        max_trips=5,
+        log_signal=None,
+        state_signal=None,
+    ):
+        self.error_rate = error_rate
+        self.window = window
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.max_trips = max_trips
+        self.log_signal = log_signal
+        self.state_signal = state_signal
+        self.circuits = {}
+        self.last_state = "正常"
+
+    def _log(self, message):
+        if self.log_signal is not None:
+            self.log_signal.emit(message)
+
+    def _circuit(self, host):
+        if host not in self.circuits:
+            self.circuits[host] = HostCircuit(self.window)
+        return self.circuits[host]
+
+    @property
+    def blocked(self):
+        return any(c.blocked for c in self.circuits.values())
+
+    # 汇总所有站点的状态: 正常 / 降级 / 受阻
+    def state(self):
+        circuits = self.circuits.values()
+        if any(c.state == "open" or c.blocked for c in circuits):
+            return "受阻"
+        if any(
+            c.state == "half_open" or c.error_rate() > self.error_rate / 2
+            for c in circuits
+        ):
+            return "降级"
+        return "正常"
+
+    def _notify(self):
+        state = self.state()
+        if state != self.last_state:
+            self.last_state = state
+            if self.state_signal is not None:
+                self.state_signal.emit(state)
+
+    # 发送请求前调用，熔断期间在这里等待，半开状态下只放行一个试探请求
+    async def before_request(self, host):
+        circuit = self._circuit(host)
+        while True:
+            if circuit.blocked:
+                raise HostBlockedError(host)
+            if circuit.state == "closed":
+                return
+            now = time.monotonic()
+            if circuit.state == "open":
+                if now < circuit.open_until:
+                    await asyncio.sleep(min(circuit.open_until - now, 1))
+                    continue
+                circuit.state = "half_open"
+                self._notify()
+            if not circuit.probing:
+                circuit.probing = True
+                return
+            await asyncio.sleep(0.5)
+
+    def record(self, host, ok):
+        circuit = self._circuit(host)
+        if circuit.state == "open":
+            return
+        if circuit.state == "half_open":
+            circuit.probing = False
+            if ok:
+                circuit.state = "closed"
+                circuit.outcomes.clear()
+                circuit.trips = 0
+                self._log(f"站点 {host} 已恢复，解除熔断")
+            else:
+                self._trip(host, circuit)
+        else:
+            circuit.outcomes.append(ok)
+            if (
+                len(circuit.outcomes) >= self.min_requests
+                and circuit.error_rate() > self.error_rate
+            ):
+                self._trip(host, circuit)
+        self._notify()
+
+    def _trip(self, host, circuit):
+        circuit.trips += 1
+        if circuit.trips >= self.max_trips:
+            circuit.blocked = True
+            self._log(f"站点 {host} 连续 {circuit.trips} 次熔断，判定为已被封锁")
+            return
+        duration = min(self.open_seconds * (2 ** (circuit.trips - 1)), 600)
+        circuit.state = "open"
+        circuit.open_until = time.monotonic() + duration
+        self._log(f"站点 {host} 错误率过高，暂停请求 {duration:.0f} 秒")
+
+
+# 进程内共用的 httpx 客户端: 同一个事件循环中先后运行的任务 (批量下载、监视模式的多次检查)
+# 复用已经建立的连接和域名解析结果，不用每个任务重新进行 DNS 查询和 TLS 握手
+# 客户端不能跨事件循环使用，事件循环变化时重新创建
+WARM_KEEPALIVE_EXPIRY = 120
+DNS_CACHE_SECONDS = 300
+
+
+class WarmClients:
+    def __init__(self):
+        self.loop = None
+        self.clients = {}
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.clients = {}
+            self._install_dns_cache(loop)
+
+    # 缓存事件循环的域名解析结果，新建连接时不再重复查询 DNS
+    @staticmethod
+    def _install_dns_cache(loop):
+        resolve = loop.getaddrinfo
+        cache = {}
+
+        async def getaddrinfo(host, port, *args, **kwargs):
+            key = (host, port, args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            cached = cache.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+            result = await resolve(host, port, *args, **kwargs)
+            cache[key] = (now + DNS_CACHE_SECONDS, result)
+            return result
+
+        loop.getaddrinfo = getaddrinfo
+
+    def get(self, proxy, limits, http2=False):
+        self._bind_loop()
+        key = (proxy, http2, limits.max_connections, limits.max_keepalive_connections)
+        client = self.clients.get(key)
+        if client is None or client.is_closed:
+            limits = httpx.Limits(
+                max_connections=limits.max_connections,
+                max_keepalive_connections=limits.max_keepalive_connections,
+                keepalive_expiry=WARM_KEEPALIVE_EXPIRY,
+            )
+            client = httpx.AsyncClient(limits=limits, proxies=proxy, http2=http2)
+            self.clients[key] = client
+        return client
+
+    async def aclose(self):
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+warm_clients = WarmClients()
+
+
+# 在同一个事件循环中依次运行多个任务 (每个地址一个)，共用预热的客户端，全部结束后关闭
+async def run_jobs(make_job, urls, interrupted, log_signal=None):
+    try:
+        for index, url in enumerate(urls, 1):
+            if interrupted[0]:
+                break
+            if len(urls) > 1 and log_signal is not None:
+                log_signal.emit(f"批量任务 {index}/{len(urls)}: {url}")
+            await make_job(url)
+    finally:
+        await warm_clients.aclose()
+
+
+# 代理池中的单个出口，拥有独立的客户端、限速状态和健康评分
+# 开启 HTTP/2 时页面和 HEAD 请求使用单独的 HTTP/2 客户端，多个请求复用同一个连接，
+# 也不用排在占满连接池的文件下载后面；文件下载仍然使用 HTTP/1.1，每个文件一个连接
+class ProxyEndpoint:
+    def __init__(self, proxy, limits, http2=False):
+        self.proxy = proxy
+        self.client = warm_clients.get(proxy, limits)
+        self.page_client = warm_clients.get(proxy, limits, http2=True) if http2 else self.client
+        self.inflight = 0
+        self.requests = 0
+        self.error_rate = 0.0  # 错误率的指数滑动平均
+        self.latency = 1.0  # 响应耗时的指数滑动平均 (秒)
+        self.cooldown_until = 0.0  # 遇到 429 后暂停使用直到该时间
+        self.cooldown_count = 0
+        self.ejected_until = 0.0  # 被移出代理池直到该时间
+        self.eject_count = 0
+
+    @property
+    def name(self):
+        return self.proxy or "直连"
+
+    def available(self, now):
+        return now >= self.cooldown_until and now >= self.ejected_until
+
+    # 评分越低越优先: 耗时越短、错误越少、正在进行的请求越少越好
+    def score(self):
+        return self.latency * (1 + 4 * self.error_rate) * (1 + self.inflight)
+
+    def record(self, ok, latency, alpha=0.2):
+        self.requests += 1
+        self.error_rate = (1 - alpha) * self.error_rate + alpha * (0.0 if ok else 1.0)
+        if ok:
+            self.latency = (1 - alpha) * self.latency + alpha * latency
+
+
+# 全局请求频率限制 (次/秒)，和带宽限制一样在一条时间轴上依次预约，0 表示不限制
+class RequestBudget:
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.next_time = 0.0
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_time)
+        self.next_time = start + 1 / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+# 代理池，将请求分散到健康的代理上，并自动移除错误率过高的代理
+# 对外提供与 httpx.AsyncClient 相同的 get 接口，可直接替换 client 使用
+class ProxyPool:
+    def __init__(
+        self,
+        proxies,
+        limits,
+        log_signal=None,
+        max_error_rate=0.5,
+        min_samples=5,
+        eject_seconds=60,
+        breaker=None,
+        budget=None,
+        http2=False,
+    ):
+        self.endpoints = [
+            ProxyEndpoint(proxy, limits, http2) for proxy in (proxies or [None])
+        ]
+        self.log_signal = log_signal
+        self.breaker = breaker
+        self.budget = budget  # 全局请求频率限制，所有请求 (包括失败切换) 都要先取得配额
+        # 整个代理池的请求统计，供并发数自动调整使用
+        self.request_count = 0
+        self.error_count = 0
+        self.throttled_count = 0
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.eject_seconds = eject_seconds
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    # 客户端由 warm_clients 管理，任务结束后保持连接供下一个任务使用
+    async def aclose(self):
+        pass
+
+    # 提前建立到站点的连接，与本地的准备工作同时进行，不计入统计但占用请求配额
+    async def prewarm(self, url, timeout=5):
+        origin = httpx.URL(url).copy_with(path="/", query=None, fragment=None)
+
+        async def warm(endpoint):
+            if self.budget is not None:
+                await self.budget.acquire()
+            with contextlib.suppress(httpx.HTTPError, asyncio.TimeoutError):
+                response = await endpoint.page_client.head(origin, timeout=timeout)
+                await response.aclose()
+
+        await asyncio.gather(*(warm(endpoint) for endpoint in self.endpoints))
+
+    def _log(self, message):
+        if self.log_signal is not None:
+            self.log_signal.emit(message)
+
+    def healthy_count(self):
+        now = time.monotonic()
+        return sum(1 for endpoint in self.endpoints if now >= endpoint.ejected_until)
+
+    # 按健康代理的数量分摊请求间隔，每个出口 IP 仍保持原有的请求频率
+    def pacing_delay(self, request_delay):
+        return request_delay / max(1, self.healthy_count())
+
+    # 按评分加权随机选择可用代理，让请求轮流分散到各个出口 IP
+    # 全部不可用时等待最早恢复的那个
+    async def acquire(self, exclude=()):
+        while True:
+            now = time.monotonic()
+            candidates = [
+                e for e in self.endpoints if e.available(now) and e not in exclude
+            ]
+            if candidates:
+                weights = [1 / e.score() for e in candidates]
+                return random.choices(candidates, weights=weights)[0]
+            if exclude:
+                return None
+            wait_until = min(
+                max(e.cooldown_until, e.ejected_until) for e in self.endpoints
+            )
+            await asyncio.sleep(max(0.1, wait_until - now))
+
+    def _eject(self, endpoint):
+        endpoint.eject_count += 1
+        duration = min(self.eject_seconds * (2 ** (endpoint.eject_count - 1)), 3600)
+        endpoint.ejected_until = time.monotonic() + duration
+        # 恢复后以一半的阈值重新观察，避免立即再次被移除
+        endpoint.error_rate = self.max_error_rate / 2
+        endpoint.requests = 0
+        self._log(f"代理 {endpoint.name} 错误率过高，暂时移出代理池 {duration:.0f} 秒")
+
+    def _record(self, endpoint, ok, latency):
+        endpoint.record(ok, latency)
+        self.request_count += 1
+        if not ok:
+            self.error_count += 1
+        if ok:
+            endpoint.eject_count = 0
+        elif (
+            endpoint.requests >= self.min_samples
+            and endpoint.error_rate > self.max_error_rate
+            and len(self.endpoints) > 1
+        ):
+            self._eject(endpoint)
+
+    def _record_response(self, endpoint, response, latency):
+        status = response.status_code
+        if status == 429:
+            # 429 表示该出口 IP 被限速，只暂停这个代理，不计入错误率
+            self.request_count += 1
+            self.throttled_count += 1
+            endpoint.cooldown_count += 1
+            wait_time = min(5 * (2 ** (endpoint.cooldown_count - 1)), 60)
+            endpoint.cooldown_until = time.monotonic() + wait_time
+            return
+        endpoint.cooldown_count = 0
+        self._record(endpoint, status != 403 and status < 500, latency)
+
+    async def _request_once(self, endpoint, method, url, stream=False, **kwargs):
+        send_kwargs = {}
+        if "follow_redirects" in kwargs:
+            send_kwargs["follow_redirects"] = kwargs.pop("follow_redirects")
+        if self.budget is not None:
+            await self.budget.acquire()
+        endpoint.inflight += 1
+        start = time.monotonic()
+        client = endpoint.client if stream else endpoint.page_client
+        try:
+            request = client.build_request(method, url, **kwargs)
+            response = await client.send(request, stream=stream, **send_kwargs)
+        except (httpx.RequestError, asyncio.TimeoutError):
+            self._record(endpoint, False, time.monotonic() - start)
+            raise
+        finally:
+            endpoint.inflight -= 1
+        self._record_response(endpoint, response, time.monotonic() - start)
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def head(self, url, **kwargs):
+        return await self.request("HEAD", url, **kwargs)
+
+    # 流式请求，用法与 httpx.AsyncClient.stream 相同
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        response = await self.request(method, url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            await close_uncancelled(response.aclose())
+
+    # 经过熔断器发送请求，最终结果 (换代理重试之后) 计入站点的错误率
+    async def request(self, method, url, max_failover=3, **kwargs):
+        if self.breaker is None:
+            return await self._request_failover(method, url, max_failover, **kwargs)
+        host = httpx.URL(url).host
+        await self.breaker.before_request(host)
+        try:
+            response = await self._request_failover(method, url, max_failover, **kwargs)
+        except (httpx.RequestError, asyncio.TimeoutError):
+            self.breaker.record(host, False)
+            raise
+        except BaseException:
+            # 被取消等情况不计入结果，但要释放试探名额
+            self.breaker._circuit(host).probing = False
+            raise
+        self.breaker.record(
+            host, response.status_code != 403 and response.status_code < 500
+        )
+        return response
+
+    # 某个代理出错 (连接失败、403 或 5xx) 时换一个代理重试，最多尝试 max_failover 个
+    async def _request_failover(self, method, url, max_failover=3, **kwargs):
+        tried = []
+        endpoint = await self.acquire()
+        while True:
+            tried.append(endpoint)
+            try:
+                response = await self._request_once(endpoint, method, url, **kwargs)
+                if response.status_code != 403 and response.status_code < 500:
+                    return response
+            except (httpx.RequestError, asyncio.TimeoutError):
+                if len(tried) >= max_failover:
+                    raise
+                endpoint = await self.acquire(exclude=tried)
+                if endpoint is None:
+                    raise
+                continue
+            if len(tried) >= max_failover:
+                return response
+            next_endpoint = await self.acquire(exclude=tried)
+            if next_endpoint is None:
+                return response
+            await response.aclose()  # 流式请求需要先释放连接
+            endpoint = next_endpoint
+
+
+# 等待 coro 执行完再响应取消: 停止任务时下载任务可能在释放连接的途中再次被取消，
+# 连接没有还回连接池，之后关闭连接池会报错说还有请求没有结束
+async def close_uncancelled(coro):
+    closing = asyncio.ensure_future(coro)
+    cancelled = False
+    while not closing.done():
+        try:
+            await asyncio.shield(closing)
+        except asyncio.CancelledError:
+            cancelled = True
+    closing.result()
+    if cancelled:
+        raise asyncio.CancelledError
+
+
 # 异步获取页面 HTML 的函数
+# 页面不存在 (404/410，例如帖子已删除) 时返回 None
+# 403/429/5xx 和连接错误按指数回退重试，重试用完后抛出 PageFetchError，不会悄悄当成没有内容
 async def get_page_html(url, client, proxy=None, max_retries=3, request_timeout=30):
     retries = 0
+    reason = None
     while retries < max_retries:
         try:
             response = await client.get(url, timeout=request_timeout)
             response.raise_for_status()
             return response.text
         except httpx.HTTPStatusError as e:
-            if e.response.status_code == 403:
-                return None
-            elif e.response.status_code == 429:
-                wait_time = min(5 * (2**retries), 60)  # 指数回退
-                retries += 1
-                await asyncio.sleep(wait_time)
-            else:
+            status = e.response.status_code
+            reason = f"状态码 {status}"
+            if status in (404, 410):
                 return None
+            if status not in (403, 429) and status < 500:
+                raise PageFetchError(url, reason) from e
+            wait_time = min(5 * (2**retries), 60)  # 指数回退
         except (httpx.RequestError, asyncio.TimeoutError) as e:
-            retries += 1
-            await asyncio.sleep(5)
-    return None
+            reason = str(e) or type(e).__name__
+            wait_time = 5
+        retries += 1
+        if retries < max_retries:
+            await asyncio.sleep(wait_time)
+    raise PageFetchError(url, reason)
+
+
+# 默认的写入缓冲区大小，网络数据攒够这么多再一次性写入磁盘
+DEFAULT_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Windows 下需要以二进制方式打开文件
+O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+# 每次 writev 最多提交的数据块数量，低于各系统的 IOV_MAX
+IOV_BATCH = 512
+
+
+# 文件写入器: 把网络数据合并成大块后在线程中写入，写入和接收数据同时进行
+# 已知大小时用 posix_fallocate 预分配空间，完成时 fsync 一次再原子重命名
+class FileWriter:
+    def __init__(
+        self, path, expected_size=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE, offset=0
+    ):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.chunks = []  # 只保存数据块的引用，写入时用 writev 一次提交，避免拼接复制
+        self.buffered = 0
+        self.written = offset  # 已经写入文件的字节数，续传时从 offset 开始
+        self.pending = None  # 正在线程中执行的写入
+        flags = os.O_WRONLY | os.O_CREAT | O_BINARY
+        self.fd = os.open(path, flags if offset else flags | os.O_TRUNC, 0o644)
+        if offset:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+        self.preallocated = False
+        if expected_size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, expected_size)
+                self.preallocated = True
+            except OSError:
+                pass  # 文件系统不支持预分配时直接写入
+
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+
+    def _write_chunks(self, chunks):
+        if not hasattr(os, "writev"):
+            self._write_all(b"".join(chunks))
+            return
+        for i in range(0, len(chunks), IOV_BATCH):
+            batch = chunks[i : i + IOV_BATCH]
+            written = os.writev(self.fd, batch)
+            if written < sum(map(len, batch)):
+                self._write_all(b"".join(batch)[written:])
+
+    async def _wait_pending(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            await pending
+
+    async def _flush(self):
+        await self._wait_pending()
+        if self.chunks:
+            chunks, self.chunks = self.chunks, []
+            self.written += self.buffered
+            self.buffered = 0
+            loop = asyncio.get_running_loop()
+            self.pending = loop.run_in_executor(None, self._write_chunks, chunks)
+
+    async def write(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            await self._flush()
+
+    def _finish(self):
+        # 预分配的大小和实际大小不一致时截断到实际写入的长度
+        if self.preallocated:
+            os.ftruncate(self.fd, self.written)
+        os.fsync(self.fd)
+        os.close(self.fd)
+
+    # 写完剩余数据、落盘并关闭文件
+    async def close(self):
+        await self._flush()
+        await self._wait_pending()
+        await asyncio.get_running_loop().run_in_executor(None, self._finish)
+        self.fd = None
+
+    # 放弃写入并关闭文件，keep_buffered 时先写入缓冲区中的数据，written 字节可以用来续传
+    async def abort(self, keep_buffered=False):
+        try:
+            if keep_buffered:
+                await self._flush()
+            await self._wait_pending()
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+# 下载时每次读取的数据块大小，固定大小让带宽限制在各个下载之间平均分配
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# 解析带宽，例如 "300Mbit"、"300Mbps" 按比特计算，"40MB" 按字节计算，0 表示不限速
+# K/M/G 与 parse_size 一样按 1024 进制换算
+def parse_bandwidth(value):
+    if value is None or value == "":
+        return 0
+    match = re.fullmatch(
+        r"\s*([\d.]+)\s*([KMG]?)(?:bit|bps|b/s)\s*", str(value), re.IGNORECASE
+    )
+    if match:
+        power = " KMG".index(match.group(2).upper() or " ")
+        return int(float(match.group(1)) * 1024**power / 8)
+    return parse_size(value)
+
+
+# 解析带宽时间表，例如 "00:00-07:00=0,07:00-23:00=300Mbit"
+def parse_bandwidth_schedule(text):
+    schedule = []
+    for item in (text or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        period, rate = item.split("=", 1)
+        start, end = period.split("-", 1)
+        start = datetime.datetime.strptime(start.strip(), "%H:%M").time()
+        end = datetime.datetime.strptime(end.strip(), "%H:%M").time()
+        schedule.append((start, end, parse_bandwidth(rate)))
+    return schedule
+
+
+# 全局带宽限制: 所有下载共用一个时间轴，每读取一块数据就预约相应的传输时间
+# 每个下载同一时刻最多只有一个预约，按先来后到轮流，所以带宽在活动的下载之间平均分配
+# 限速可以在运行时从其他线程修改
+class BandwidthLimiter:
+    def __init__(self, rate=0, schedule=None):
+        self.rate = rate  # 字节/秒，0 表示不限速
+        self.schedule = schedule or []
+        self.next_time = 0.0
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.next_time = 0.0  # 丢弃按旧速率排好的预约
+
+    def set_schedule(self, schedule):
+        self.schedule = schedule
+        self.next_time = 0.0
+
+    # 当前生效的速率，时间表中匹配的时段优先
+    def current_rate(self):
+        if self.schedule:
+            now = datetime.datetime.now().time()
+            for start, end, rate in self.schedule:
+                if start <= end:
+                    if start <= now < end:
+                        return rate
+                elif now >= start or now < end:  # 跨越午夜的时段
+                    return rate
+        return self.rate
+
+    async def consume(self, num_bytes):
+        rate = self.current_rate()
+        if not rate:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_time)
+        self.next_time = start + num_bytes / rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+# 任务控制: 从界面线程或终端线程停止、暂停和继续正在运行的任务
+# 停止时取消整个任务，所有正在进行的请求、等待和重试都会立即结束并释放连接
+# 暂停时不再发起新的请求，正在下载的文件停在当前数据块，已下载的部分保留
+class JobControl:
+    def __init__(self, interrupted=None):
+        self.interrupted = interrupted if interrupted is not None else [False]
+        self.paused = False
+        self.loop = None
+        self.task = None
+        self.running = None  # 未暂停时处于 set 状态的 asyncio.Event
+
+    # 在任务的事件循环中调用，记录需要取消的任务
+    def bind(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.running = asyncio.Event()
+        if not self.paused:
+            self.running.set()
+
+    def _call(self, callback):
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(callback)
+
+    def stop(self):
+        self.interrupted[0] = True
+        self.paused = False
+        if self.task is not None:
+            self._call(self.task.cancel)
+
+    def pause(self):
+        self.paused = True
+        if self.running is not None:
+            self._call(self.running.clear)
+
+    def resume(self):
+        self.paused = False
+        if self.running is not None:
+            self._call(self.running.set)
+
+    async def wait_if_paused(self):
+        if self.running is not None and not self.running.is_set():
+            await self.running.wait()
+
+
+# 磁盘空间准入: 开始传输前按已知大小预约空间，剩余空间减去正在下载的文件还要写入的部分后
+# 低于保留值时新的下载原地等待，空间释放后自动继续，不在存不下的数据上浪费带宽
+# 使用临时下载目录时，等待移动的文件和正在下载的文件合计超过 max_staged 时也会等待
+DEFAULT_MIN_FREE_SPACE = 1024**3
+DISK_SPACE_POLL_SECONDS = 5
+
+
+class DiskSpaceGuard:
+    def __init__(
+        self,
+        path,
+        min_free=DEFAULT_MIN_FREE_SPACE,
+        log_signal=None,
+        mover=None,
+        max_staged=None,
+        activity="开始新的下载",
+    ):
+        self.path = path
+        self.min_free = min_free
+        self.log_signal = log_signal
+        self.mover = mover
+        self.max_staged = max_staged
+        self.activity = activity  # 空间不足时暂停的操作，用于日志
+        self.outstanding = 0  # 已经预约、还没有写入磁盘的字节数
+        self.reserved = 0  # 进行中的下载预约的总字节数，包括已经写入的部分
+        self.waiters = 0
+        self.released = None  # 有预约释放时 set 的 asyncio.Event
+
+    # 下载目录可能还没有创建，使用最近的已存在的上级目录所在的磁盘
+    def free_space(self):
+        path = os.path.abspath(self.path)
+        while not os.path.isdir(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        return shutil.disk_usage(path).free
+
+    def disk_available(self):
+        return self.free_space() - self.outstanding - self.min_free
+
+    # 临时下载目录中还可以放入的字节数，没有等待移动的文件时不限制，单个大文件也能下载
+    def staging_available(self):
+        if self.mover is None or not self.max_staged:
+            return None
+        staged = self.mover.pending_bytes + self.reserved
+        return self.max_staged - staged if staged else None
+
+    def available(self):
+        available = self.disk_available()
+        staging = self.staging_available()
+        return available if staging is None else min(available, staging)
+
+    # 预约 size 字节 (未知大小时为 0，只要求剩余空间高于保留值)，空间不足时等待
+    async def reserve(self, size):
+        size = max(size or 0, 0)
+        if self.released is None:
+            self.released = asyncio.Event()
+        if self.available() < size:
+            self.waiters += 1
+            disk_full = self.disk_available() < size
+            if self.waiters == 1 and self.log_signal is not None:
+                if disk_full:
+                    self.log_signal.emit(
+                        f"{self.path} 所在磁盘剩余空间不足 ({format_size(self.free_space())})，"
+                        f"暂停{self.activity}，空间释放后自动继续"
+                    )
+                else:
+                    staged = self.mover.pending_bytes + self.reserved
+                    self.log_signal.emit(
+                        f"临时下载目录中正在下载和等待移动的文件已有 {format_size(staged)}，"
+                        "暂停开始新的下载，移动完成后自动继续"
+                    )
+            try:
+                while self.available() < size:
+                    self.released.clear()
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self.released.wait(), DISK_SPACE_POLL_SECONDS)
+            finally:
+                self.waiters -= 1
+            if self.waiters == 0 and self.log_signal is not None:
+                self.log_signal.emit(
+                    f"{self.path} 所在磁盘空间已恢复，自动继续"
+                    if disk_full
+                    else "文件已移动到下载目录，继续下载"
+                )
+        self.outstanding += size
+        self.reserved += size
+        return DiskReservation(self, size)
+
+    # 空间可能已经释放 (例如文件移出了临时下载目录)，让等待的下载重新检查
+    def wake(self):
+        if self.released is not None:
+            self.released.set()
+
+
+# 一个下载的空间预约，写入磁盘的部分不再计入预约，下载结束时释放剩余部分
+class DiskReservation:
+    def __init__(self, guard, size):
+        self.guard = guard
+        self.size = size
+        self.remaining = size
+        self.active = True
+
+    def consume(self, num_bytes):
+        num_bytes = min(num_bytes, self.remaining)
+        self.remaining -= num_bytes
+        self.guard.outstanding -= num_bytes
+
+    def release(self):
+        if not self.active:
+            return
+        self.active = False
+        self.consume(self.remaining)
+        self.guard.reserved -= self.size
+        self.guard.wake()
+
+
+# 分级下载: 先下载到本地的临时下载目录 (例如 SSD)，完成后由后台线程以大块顺序写入下载目录
+# (例如 NAS)，同时按文件地址中的 sha256 校验，校验通过后才出现在下载目录中
+# 同时移动的文件数不超过 MOVER_WORKERS，等待移动的字节数会反馈给磁盘空间准入
+DEFAULT_MAX_STAGED = 20 * 1024**3
+MOVER_WORKERS = 2
+MOVER_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class StagingMover:
+    def __init__(self, staging_path, save_path, log_signal=None, workers=MOVER_WORKERS):
+        self.staging_path = staging_path
+        self.save_path = save_path
+        self.log_signal = log_signal
+        self.workers = workers
+        self.executor = None
+        self.slots = None
+        self.disk_guard = None  # 移动完成后唤醒等待空间的下载
+        self.library_guard = None  # 下载目录所在磁盘的空间准入，不在同一个磁盘上时使用
+        self.pending = 0  # 等待移动和正在移动的文件数
+        self.pending_bytes = 0
+        self.moved = 0
+        self.moved_bytes = 0
+        self.busy_seconds = 0.0
+        self.failed = 0
+
+    def start(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix="kemono-mover"
+        )
+        self.slots = asyncio.Semaphore(self.workers)
+        return self
+
+    # 上次运行已经完整下载到临时目录的文件 (未完成的下载是 .part 文件)
+    def has_staged(self, file_name):
+        return os.path.isfile(os.path.join(self.staging_path, file_name))
+
+    # 把临时下载目录中的文件移动到下载目录，返回最终路径，校验失败时返回 None
+    async def move(self, staged_path, file_name, sha256=None):
+        size = os.path.getsize(staged_path)
+        final_path = os.path.join(self.save_path, file_name)
+        library_index.ensure_dir(os.path.dirname(final_path))
+        self.pending += 1
+        self.pending_bytes += size
+        reservation = None
+        try:
+            # 复制到另一个磁盘前先在下载目录所在的磁盘上预约空间，空间不足时暂停移动
+            if self.library_guard is not None and not same_device(
+                staged_path, os.path.dirname(final_path)
+            ):
+                reservation = await self.library_guard.reserve(size)
+            async with self.slots:
+                start = time.monotonic()
+                error = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, copy_staged_file, staged_path, final_path, sha256
+                )
+                self.busy_seconds += time.monotonic() - start
+        except OSError as e:
+            # 只有磁盘已满会抛出到这里，重新下载也放不下，文件留在临时目录中下次运行再移动
+            self.failed += 1
+            raise LibraryDiskFullError(f"{self.save_path} ({e})") from e
+        finally:
+            if reservation is not None:
+                reservation.release()
+            self.pending -= 1
+            self.pending_bytes -= size
+            if self.disk_guard is not None:
+                self.disk_guard.wake()
+        library_index.discard_file(staged_path)
+        if error:
+            self.failed += 1
+            if self.log_signal is not None:
+                self.log_signal.emit(f"移动到下载目录失败: {file_name} {error}", "error")
+            return None
+        self.moved += 1
+        self.moved_bytes += size
+        library_index.add_file(final_path)
+        return final_path
+
+    def describe(self):
+        speed = self.moved_bytes / self.busy_seconds * self.workers if self.busy_seconds else 0
+        return (
+            f"已移动 {self.moved} 个文件到下载目录 ({format_size(self.moved_bytes)}，"
+            f"{format_size(speed)}/s)" + (f"，失败 {self.failed} 个" if self.failed else "")
+        )
+
+    # 停止时不取消正在进行的复制，等它们写完，下载目录中不会留下 .part 文件
+    async def close(self):
+        if self.executor is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+            self.executor = None
+
+
+def same_device(path, other):
+    return os.stat(path).st_dev == os.stat(other).st_dev
+
+
+# 在移动线程中执行: 以大块顺序复制并计算 sha256，写入 .part 并落盘后再重命名，最后删除临时文件
+# 临时目录和下载目录在同一个磁盘上时校验后直接重命名；返回错误信息，成功时返回 None
+# 下载目录所在的磁盘已满时删除写了一半的 .part 文件并抛出 OSError，临时文件保留
+def copy_staged_file(staged_path, final_path, sha256=None):
+    temp_path = final_path + ".part"
+    try:
+        if same_device(staged_path, os.path.dirname(final_path)):
+            if sha256:
+                _, digest = hash_file(staged_path)
+                if digest is None:
+                    return "无法读取临时文件"
+                if digest != sha256:
+                    os.remove(staged_path)
+                    return "sha256 校验失败"
+            os.replace(staged_path, final_path)
+            return None
+        digest = hashlib.sha256() if sha256 else None
+        buffer = bytearray(MOVER_CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(staged_path, "rb", buffering=0) as src, open(temp_path, "wb", buffering=0) as dst:
+            while True:
+                count = src.readinto(buffer)
+                if not count:
+                    break
+                if digest is not None:
+                    digest.update(view[:count])
+                dst.write(view[:count])
+            dst.flush()
+            os.fsync(dst.fileno())
+        if digest is not None and digest.hexdigest() != sha256:
+            # 下载的内容与文件地址中的哈希不一致，两边都删除，之后可以重新下载
+            os.remove(temp_path)
+            os.remove(staged_path)
+            return "sha256 校验失败"
+        os.replace(temp_path, final_path)
+        os.remove(staged_path)
+        return None
+    except OSError as e:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        if e.errno == errno.ENOSPC:
+            raise
+        return str(e)
 
 
 # 异步下载文件的函数
@@ -73,103 +1133,1492 @@ async def download_file(
     max_retries=3,
     request_timeout=30,
     retry_queue=None,
+    job_progress=None,
+    write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+    bandwidth_limiter=None,
+    job_control=None,
+    disk_guard=None,
+    expected_size=None,
 ):
-    # 检查哈希表中是否已有该文件
-    if file_name in downloaded_files:
-        log_signal.emit(f"文件已下载: {file_name}")
+    file_path = os.path.join(save_path, file_name)
+    # 检查索引中是否已有该文件
+    if library_index.has_file(file_path):
+        log_signal.emit(f"文件已下载: {file_name}", "debug")
         return
 
-    retries = 0
-    while retries < max_retries:
-        try:
-            response = await client.get(url, timeout=request_timeout)
-            response.raise_for_status()
-            total_size = int(response.headers.get("content-length", 0))
-            block_size = 4096
-
-            if not os.path.exists(save_path):
-                os.makedirs(save_path)
-
-            file_path = os.path.join(save_path, file_name)
-            temp_path = file_path + ".part"
-
-            async with aiofiles.open(temp_path, "wb") as f:
-                downloaded_size = 0
-                async for data in response.aiter_bytes(block_size):
-                    if interrupted[0]:
-                        log_signal.emit("下载已中断")
-                        return
-                    await f.write(data)
-                    downloaded_size += len(data)
-                    progress = (downloaded_size / total_size) * 100 if total_size else 0
-                    progress_signal.emit(progress)
-
-            # 检查最终文件是否已经存在
-            if os.path.exists(file_path):
-                log_signal.emit(f"文件已存在: {file_path}")
-                os.remove(temp_path)  # 如果存在则删除临时文件
-            else:
-                os.rename(temp_path, file_path)  # 将临时文件重命名为最终文件名
-                downloaded_files.add(file_name)  # 更新哈希表
-            return
-        except (httpx.RequestError, asyncio.TimeoutError) as e:
-            log_signal.emit(f"下载失败: {e}")
-            retries += 1
-            await asyncio.sleep(10)
+    temp_path = file_path + ".part"
 
-            # 删除部分下载的文件和最终文件
-            try:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                if os.path.exists(file_path) and not os.path.exists(temp_path):
-                    os.remove(file_path)
-            except PermissionError:
-                log_signal.emit(
-                    f"无法删除文件: {temp_path} 或 {file_path}，可能正在被使用。"
+    retries = 0
+    resume_from = 0  # 上次中断时已经写入 .part 文件的字节数，重试时从这里续传
+    counted = 0  # 这个文件已经计入总进度的字节数
+    writer = None
+    reservation = None
+    try:
+        while retries < max_retries:
+            writer = None
+            if disk_guard is not None:
+                # 每次尝试前重新预约还需要写入的部分，从头下载时 .part 文件已经删除
+                if reservation is not None:
+                    reservation.release()
+                reservation = None
+                reservation = await disk_guard.reserve(
+                    expected_size - resume_from if expected_size else 0
                 )
+            try:
+                headers = {"Range": f"bytes={resume_from}-"} if resume_from else None
+                async with client.stream(
+                    "GET", url, headers=headers, timeout=request_timeout, follow_redirects=True
+                ) as response:
+                    response.raise_for_status()
+                    # 服务器不支持续传时返回完整文件，从头写入
+                    offset = resume_from if response.status_code == 206 else 0
+                    content_length = int(response.headers.get("content-length", 0))
+                    total_size = offset + content_length if content_length else 0
+                    downloaded_size = offset
+                    if job_progress is not None:
+                        job_progress.add(offset - counted)
+                        counted = offset
+
+                    if reservation is not None and total_size:
+                        # 预检时不知道大小或大小有变化时按实际大小补充预约
+                        extra = total_size - offset - reservation.remaining
+                        if extra > 0:
+                            reservation.release()
+                            reservation = await disk_guard.reserve(total_size - offset)
+
+                    library_index.ensure_dir(os.path.dirname(file_path))
+                    writer = FileWriter(temp_path, total_size, write_buffer_size, offset)
+                    if reservation is not None and writer.preallocated:
+                        reservation.consume(total_size - offset)
+                    async for data in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        if job_control is not None:
+                            await job_control.wait_if_paused()
+                        if interrupted[0]:
+                            await writer.abort()
+                            writer = None
+                            remove_partial_file(temp_path, log_signal)
+                            log_signal.emit("下载已中断")
+                            return
+                        if bandwidth_limiter is not None:
+                            await bandwidth_limiter.consume(len(data))
+                        await writer.write(data)
+                        downloaded_size += len(data)
+                        if reservation is not None:
+                            reservation.consume(len(data))
+                        if job_progress is not None:
+                            job_progress.add(len(data))
+                            counted += len(data)
+                        else:
+                            progress = (downloaded_size / total_size) * 100 if total_size else 0
+                            progress_signal.emit(progress)
+                    await writer.close()
+                    writer = None
 
-    log_signal.emit("达到最大重试次数，放弃下载，将任务加入重试队列。")
+                # 检查最终文件是否已经存在 (例如同一个文件的另一个任务先完成了)
+                if library_index.has_file(file_path):
+                    log_signal.emit(f"文件已存在: {file_path}", "debug")
+                    os.remove(temp_path)  # 如果存在则删除临时文件
+                else:
+                    os.replace(temp_path, file_path)  # 将临时文件原子地重命名为最终文件名
+                    library_index.add_file(file_path)  # 更新索引
+                    return file_path
+                return
+            except httpx.HTTPStatusError as e:
+                # 除了限速以外的 4xx 重试也不会成功，直接放弃
+                status = e.response.status_code
+                if status == 416 and resume_from:
+                    # 续传的位置无效，删除 .part 文件从头下载
+                    resume_from = 0
+                    remove_partial_file(temp_path, log_signal)
+                    retries += 1
+                    continue
+                if 400 <= status < 500 and status != 429:
+                    log_signal.emit(
+                        f"下载失败: {file_name} 返回状态码 {status}", "warning", "download-failed"
+                    )
+                    remove_partial_file(temp_path, log_signal)
+                    return
+                log_signal.emit(f"下载失败: {e}", "warning", "download-failed")
+                retries += 1
+                await asyncio.sleep(10)
+            except (httpx.RequestError, asyncio.TimeoutError) as e:
+                # 网络中断 (例如暂停太久被服务器断开) 时保留已写入的部分，下次续传
+                log_signal.emit(f"下载失败: {e}", "warning", "download-failed")
+                retries += 1
+                if writer is not None:
+                    await writer.abort(keep_buffered=True)
+                    resume_from = writer.written
+                if job_progress is not None:
+                    job_progress.failures += 1
+                await asyncio.sleep(10)
+            except OSError as e:
+                # 写入出错时已写入的数据不可信，从头下载
+                log_signal.emit(f"下载失败: {e}", "warning", "download-failed")
+                retries += 1
+                if writer is not None:
+                    await writer.abort()
+                    writer = None
+                resume_from = 0
+                if job_progress is not None:
+                    job_progress.failures += 1
+                remove_partial_file(temp_path, log_signal)
+                await asyncio.sleep(10)
+    except asyncio.CancelledError:
+        # 任务被停止，删除未完成的文件后继续向上取消
+        if writer is not None:
+            await writer.abort()
+        remove_partial_file(temp_path, log_signal)
+        raise
+    finally:
+        if reservation is not None:
+            reservation.release()
+        if job_progress is not None and not library_index.has_file(file_path):
+            job_progress.add(-counted)  # 没有下载完成的部分不计入进度
+
+    log_signal.emit(
+        f"达到最大重试次数，放弃下载，将任务加入重试队列: {file_name}",
+        "warning",
+        "download-gave-up",
+    )
+    remove_partial_file(temp_path, log_signal)
     if retry_queue is not None:
         retry_queue.append((url, file_name))
 
 
-# 异步提取链接的函数
-async def extract_links(html):
+# 删除部分下载的文件，最终文件只会在完整写入后出现，不需要删除
+def remove_partial_file(temp_path, log_signal):
+    try:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    except PermissionError:
+        log_signal.emit(f"无法删除文件: {temp_path}，可能正在被使用。", "warning")
+
+
+# 解析创作者的帖子列表页，一次解析同时取出帖子链接和下一页地址
+def parse_listing_page(html, base_url):
     soup = BeautifulSoup(html, "html.parser")
     pattern = r"/.*/user/\d+/post/.*"
     links = []
     for link in soup.find_all("a"):
         href = link.get("href")
         if href and re.search(pattern, href):
-            links.append("https://kemono.su" + href)
-    return links
-
-
-# 异步获取下一页 URL 的函数
-async def get_next_page_url(html, base_url):
-    soup = BeautifulSoup(html, "html.parser")
+            links.append(base_url + href)
+    next_page_url = None
     next_page_link = soup.find("a", class_="next")
     if next_page_link:
         next_page_url = base_url + next_page_link.get("href")
-        return next_page_url
+    return links, next_page_url
+
+
+# 页面解析池: BeautifulSoup 解析是纯 CPU 工作，直接在事件循环里执行会让所有下载停顿
+# 普通页面交给线程池，较大的页面交给进程池，解析期间事件循环继续收发数据
+PROCESS_PARSE_THRESHOLD = 256 * 1024
+
+
+class HtmlParserPool:
+    def __init__(self, threads=2, processes=2, process_threshold=PROCESS_PARSE_THRESHOLD):
+        self.threads = threads
+        self.processes = processes
+        self.process_threshold = process_threshold
+        self.thread_pool = None
+        self.process_pool = None
+        self.lock = threading.Lock()
+
+    def _executor(self, size):
+        with self.lock:
+            if self.processes and size >= self.process_threshold:
+                if self.process_pool is None:
+                    self.process_pool = concurrent.futures.ProcessPoolExecutor(self.processes)
+                return self.process_pool
+            if self.thread_pool is None:
+                self.thread_pool = concurrent.futures.ThreadPoolExecutor(
+                    self.threads, thread_name_prefix="html-parser"
+                )
+            return self.thread_pool
+
+    # 在解析池中执行 func(html, *args)，func 必须是模块级函数，返回值可以跨进程传递
+    async def run(self, func, html, *args):
+        executor = self._executor(len(html))
+        return await asyncio.get_running_loop().run_in_executor(executor, func, html, *args)
+
+    def shutdown(self):
+        with self.lock:
+            for executor in (self.thread_pool, self.process_pool):
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+            self.thread_pool = self.process_pool = None
+
+
+parser_pool = HtmlParserPool()
+
+
+# 待下载的附件
+# 全站下载时会有上百万个附件同时排队，使用 __slots__ 省去每个对象的属性字典，
+# 同一帖子、同一创作者、同一天的附件共用一份字符串
+class Attachment:
+    __slots__ = ("url", "file_name", "post_url", "creator", "size", "published", "content_hash")
+
+    def __init__(
+        self,
+        url,
+        file_name,
+        post_url=None,
+        creator=None,
+        size=None,
+        published=None,
+        content_hash=None,
+    ):
+        self.url = url
+        self.file_name = file_name
+        self.post_url = intern_optional(post_url)
+        self.creator = intern_optional(creator)
+        self.size = size  # 预检得到的文件大小，未知时为 None
+        self.published = intern_optional(published)  # 帖子发布日期 YYYY-MM-DD，未知时为 None
+        self.content_hash = content_hash  # 清单中给出的 sha256，文件地址中没有哈希时使用
+
+    @property
+    def sha256(self):
+        return content_hash_from_url(self.url) or self.content_hash
+
+    # 在下载目录中的位置: 服务/创作者/帖子/文件名
+    @property
+    def relative_path(self):
+        return library_path(self.post_url, self.file_name)
+
+
+def intern_optional(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+# kemono 的文件地址形如 /data/ab/cd/<sha256>.ext，从中取出文件内容的哈希
+def content_hash_from_url(url):
+    match = re.search(r"/([0-9a-f]{64})(?:\.[^/?#]*)?(?:[?#]|$)", url)
+    if match:
+        return match.group(1)
     return None
 
 
-# 处理重试队列中的任务
-async def handle_retry_queue(
-    client,
-    retry_queue,
-    user_save_path,
-    progress_signal,
-    log_signal,
-    interrupted,
-    proxy,
-    max_retries,
-    request_timeout,
-):
+# 下载目录的固定结构，每次运行都放到同一个位置，重新运行时可以直接看到之前下载的文件
+# 不知道帖子地址的附件 (例如旧的清单) 放在 unsorted 文件夹中
+UNSORTED_FOLDER = "unsorted"
+
+
+def library_path(post_url, file_name):
+    match = re.search(r"/([^/]+)/user/([^/?#]+)/post/([^/?#]+)", post_url or "")
+    if not match:
+        return os.path.join(UNSORTED_FOLDER, file_name)
+    service, creator, post = (sanitize_filename(part) for part in match.groups())
+    return os.path.join(service, creator, post, file_name)
+
+
+# 以前每次运行都会创建的 download_YYYYmmdd_HHMMSS 文件夹
+LEGACY_FOLDER_PATTERN = re.compile(r"download_\d{8}_\d{6}")
+
+
+def find_legacy_folders(save_path):
+    try:
+        names = os.listdir(save_path)
+    except OSError:
+        return []
+    return sorted(
+        os.path.join(save_path, name)
+        for name in names
+        if LEGACY_FOLDER_PATTERN.fullmatch(name) and os.path.isdir(os.path.join(save_path, name))
+    )
+
+
+def same_content(path, other):
+    if os.path.getsize(path) != os.path.getsize(other):
+        return False
+    return hash_file(path)[1] == hash_file(other)[1]
+
+
+# 把旧的按时间命名的文件夹一次性整理到固定结构中
+# 按清单中的文件名找到所属的帖子，同名文件有多个时用内容哈希区分，找不到的放进 unsorted
+# 目标位置已有相同内容的文件时删除重复的那个，内容不同时加上原文件夹名保留在 unsorted 中
+def migrate_library(save_path, manifest_files, log_signal):
+    by_name = {}
+    by_hash = {}
+    for manifest_file in manifest_files or []:
+        for attachment in load_manifest(manifest_file):
+            by_name.setdefault(attachment.file_name, []).append(attachment)
+            if attachment.sha256:
+                by_hash[attachment.sha256] = attachment
+
+    folders = find_legacy_folders(save_path)
+    moved = duplicates = unsorted = partial = 0
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for name in files:
+                source = os.path.join(root, name)
+                if name.endswith(".part"):
+                    os.remove(source)  # 没下载完的文件无法续传，直接删除
+                    partial += 1
+                    continue
+                candidates = by_name.get(name, [])
+                attachment = candidates[0] if len(candidates) == 1 else None
+                if len(candidates) > 1:
+                    attachment = by_hash.get(hash_file(source)[1])
+                target = os.path.join(
+                    save_path,
+                    attachment.relative_path if attachment else library_path(None, name),
+                )
+                if os.path.exists(target):
+                    if same_content(source, target):
+                        os.remove(source)
+                        duplicates += 1
+                        continue
+                    target = os.path.join(
+                        save_path, library_path(None, f"{os.path.basename(folder)}_{name}")
+                    )
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(source, target)
+                library_index.add_file(target)
+                moved += 1
+                if os.path.dirname(target) == os.path.join(save_path, UNSORTED_FOLDER):
+                    unsorted += 1
+        # 删除已经清空的旧文件夹
+        for root, _, _ in sorted(os.walk(folder), key=lambda item: -len(item[0])):
+            with contextlib.suppress(OSError):
+                os.rmdir(root)
+    log_signal.emit(
+        f"整理完成: {len(folders)} 个旧文件夹，移动 {moved} 个文件 (其中 {unsorted} 个放入 "
+        f"{UNSORTED_FOLDER})，删除重复文件 {duplicates} 个，未完成的 .part 文件 {partial} 个"
+    )
+    return moved
+
+
+# 下载清单的字段，清单可以是 JSONL (默认) 或 CSV (扩展名为 .csv)
+MANIFEST_FIELDS = (
+    "url",
+    "file_name",
+    "size",
+    "sha256",
+    "post_url",
+    "creator",
+    "published",
+    "in_library",
+)
+
+
+# library 是已经在下载目录中的附件路径 (Attachment.relative_path) 集合
+def write_manifest(path, attachments, library):
+    rows = [
+        {
+            "url": a.url,
+            "file_name": a.file_name,
+            "size": a.size,
+            "sha256": a.sha256,
+            "post_url": a.post_url,
+            "creator": a.creator,
+            "published": a.published,
+            "in_library": a.relative_path in library,
+        }
+        for a in attachments
+    ]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return rows
+
+
+def load_manifest(path):
+    return list(iter_manifest(path))
+
+
+# 逐行读取清单，大清单不用一次全部读入内存
+def iter_manifest(path):
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            size = row.get("size")
+            yield Attachment(
+                row["url"],
+                row["file_name"],
+                row.get("post_url") or None,
+                row.get("creator") or None,
+                int(size) if size not in (None, "") else None,
+                row.get("published") or None,
+                (row.get("sha256") or "").lower() or None,
+            )
+
+
+# 计算文件的 sha256，在进程池中执行，用 mmap 让大文件以大块顺序读取
+def hash_file(path):
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return path, hashlib.sha256().hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return path, hashlib.sha256(mapped).hexdigest()
+    except (OSError, ValueError):
+        return path, None
+
+
+# 校验下载目录: 用文件地址或清单中的 sha256 并行校验所有文件，没有哈希的文件只检查是否存在
+# 损坏的文件重命名为 .corrupt，损坏和缺失的文件写入修复清单，之后可以直接按清单重新下载
+def verify_library(save_path, manifest_file, repair_file, workers, log_signal):
+    attachments = load_manifest(manifest_file)
+    part_files = 0
+    for _, _, files in os.walk(save_path):
+        part_files += sum(1 for name in files if name.endswith(".part"))
+    # 旧的下载文件夹中没有帖子信息，只能按文件名查找
+    legacy_index = {}
+    for folder in find_legacy_folders(save_path):
+        for root, _, files in os.walk(folder):
+            for name in files:
+                legacy_index.setdefault(name, []).append(os.path.join(root, name))
+
+    owners = {}  # 路径 -> 可能属于的附件
+    missing = []
+    unknown = 0
+    for attachment in attachments:
+        # 固定结构中的文件只按自己的位置校验，找不到时才在旧的下载文件夹中按文件名查找
+        path = os.path.join(save_path, attachment.relative_path)
+        paths = [path] if os.path.isfile(path) else legacy_index.get(attachment.file_name)
+        if not paths:
+            missing.append(attachment)
+            continue
+        # 文件地址和清单中都没有哈希时只能确认文件存在
+        if attachment.sha256 is None:
+            unknown += 1
+            continue
+        for path in paths:
+            owners.setdefault(path, []).append(attachment)
+
+    log_signal.emit(
+        f"开始校验 {len(owners)} 个文件 (缺失 {len(missing)} 个，无法校验 {unknown} 个，"
+        f"未完成的 .part 文件 {part_files} 个)"
+    )
+    # 同名文件可能属于不同的帖子，附件只要有一个候选文件的哈希相同就算完好
+    intact = set()
+    corrupt = 0
+    checked = 0
+    checked_bytes = 0
+    start = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, digest in executor.map(hash_file, list(owners), chunksize=4):
+            checked += 1
+            if digest is not None:
+                checked_bytes += os.path.getsize(path)
+            matched = [a for a in owners[path] if a.sha256 == digest]
+            intact.update(id(a) for a in matched)
+            if not matched:
+                corrupt += 1
+                library_index.discard_file(path)
+                try:
+                    os.replace(path, path + ".corrupt")
+                except OSError:
+                    pass
+                log_signal.emit(f"文件损坏: {path}")
+            if checked % 100 == 0:
+                log_signal.emit(f"已校验 {checked}/{len(owners)} 个文件")
+    elapsed = max(time.monotonic() - start, 1e-3)
+
+    # 同名文件可能在多个目录中损坏，修复清单中每个附件只出现一次
+    damaged = {
+        id(a): a for attachments in owners.values() for a in attachments if id(a) not in intact
+    }
+    repair = list(damaged.values()) + missing
+    for attachment in repair:
+        library_index.discard_file(os.path.join(save_path, attachment.relative_path))
+    write_manifest(repair_file, repair, set())
+    log_signal.emit(
+        f"校验完成: {checked} 个文件 ({format_size(checked_bytes)}，"
+        f"{format_size(checked_bytes / elapsed)}/s)，损坏 {corrupt} 个，"
+        f"缺失 {len(missing)} 个，修复清单已写入 {repair_file}"
+    )
+    return repair
+
+
+# 分布式下载的任务队列接口: 抓取端发布附件，多个下载进程 (可以在不同机器上) 领取任务
+# 领取的任务带有租约，下载进程定期续约，进程退出后租约过期的任务会重新分配给其他进程
+class WorkQueue(abc.ABC):
+    def __init__(self, lease_seconds=300, max_attempts=3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    # 发布附件，已经在队列中的附件不会重复加入，返回新加入的数量
+    @abc.abstractmethod
+    def publish(self, attachments):
+        raise NotImplementedError
+
+    # 领取最多 count 个任务，返回 Attachment 列表
+    @abc.abstractmethod
+    def claim(self, worker_id, count):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def renew(self, worker_id, urls):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def complete(self, worker_id, url, file_path, size):
+        raise NotImplementedError
+
+    # 下载失败时归还任务，超过最大尝试次数后标记为失败
+    @abc.abstractmethod
+    def fail(self, worker_id, url):
+        raise NotImplementedError
+
+    # 进程停止时归还尚未完成的任务，不计入尝试次数
+    @abc.abstractmethod
+    def release(self, worker_id, urls):
+        raise NotImplementedError
+
+    # 返回各状态的任务数，例如 {"pending": 3, "leased": 2, "done": 10}
+    @abc.abstractmethod
+    def counts(self):
+        raise NotImplementedError
+
+    # 返回已完成的任务，用于导出下载清单
+    @abc.abstractmethod
+    def completed(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# 基于 SQLite 的任务队列，适合单机多进程或共享磁盘上的多台机器
+class SQLiteWorkQueue(WorkQueue):
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        super().__init__(lease_seconds, max_attempts)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                url TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                post_url TEXT,
+                creator TEXT,
+                size INTEGER,
+                published TEXT,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                file_path TEXT,
+                completed_at REAL
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until)")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            # IMMEDIATE 在读取之前就拿到写锁，多个进程不会领取到同一个任务
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def publish(self, attachments):
+        with self.transaction() as db:
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO jobs (url, file_name, post_url, creator, size, published)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (a.url, a.file_name, a.post_url, a.creator, a.size, a.published)
+                    for a in attachments
+                ],
+            )
+            return db.total_changes - before
+
+    def claim(self, worker_id, count):
+        now = time.time()
+        with self.transaction() as db:
+            rows = db.execute(
+                "SELECT url, file_name, post_url, creator, size, published FROM jobs"
+                " WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)"
+                " ORDER BY rowid LIMIT ?",
+                (now, count),
+            ).fetchall()
+            db.executemany(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_until = ? WHERE url = ?",
+                [(worker_id, now + self.lease_seconds, row[0]) for row in rows],
+            )
+        return [Attachment(*row) for row in rows]
+
+    def renew(self, worker_id, urls):
+        lease_until = time.time() + self.lease_seconds
+        with self.transaction() as db:
+            db.executemany(
+                "UPDATE jobs SET lease_until = ?"
+                " WHERE url = ? AND worker = ? AND state = 'leased'",
+                [(lease_until, url, worker_id) for url in urls],
+            )
+
+    def complete(self, worker_id, url, file_path, size):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = 'done', worker = ?, file_path = ?,"
+                " size = COALESCE(?, size), completed_at = ? WHERE url = ?",
+                (worker_id, file_path, size, time.time(), url),
+            )
+
+    def fail(self, worker_id, url):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE jobs SET attempts = attempts + 1,"
+                " state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,"
+                " worker = NULL, lease_until = NULL"
+                " WHERE url = ? AND worker = ? AND state = 'leased'",
+                (self.max_attempts, url, worker_id),
+            )
+
+    def release(self, worker_id, urls):
+        with self.transaction() as db:
+            db.executemany(
+                "UPDATE jobs SET state = 'pending', worker = NULL, lease_until = NULL"
+                " WHERE url = ? AND worker = ? AND state = 'leased'",
+                [(url, worker_id) for url in urls],
+            )
+
+    def counts(self):
+        with self.lock:
+            rows = self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+    def completed(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT url, file_name, post_url, creator, size, published FROM jobs"
+                " WHERE state = 'done' ORDER BY completed_at"
+            ).fetchall()
+        return [Attachment(*row) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+
+# 任务队列的实现，队列地址形如 "sqlite:/path/queue.db"，省略前缀时使用 SQLite
+WORK_QUEUE_BACKENDS = {
+    "sqlite": SQLiteWorkQueue,
+}
+
+
+def open_work_queue(spec, lease_seconds=300, max_attempts=3):
+    backend, sep, target = spec.partition(":")
+    if not sep or backend not in WORK_QUEUE_BACKENDS:
+        # 没有前缀 (或是 Windows 盘符) 时按 SQLite 文件处理
+        backend, target = "sqlite", spec
+    return WORK_QUEUE_BACKENDS[backend](target, lease_seconds, max_attempts)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+# 本地元数据索引: 抓取过的帖子和附件 (标题、日期、创作者、文件名、大小、哈希、本地路径)
+# 保存在下载目录的 .kemono_index.db 中，查找时不需要访问网站
+# 文件名、标题和创作者使用 FTS5 trigram 全文索引，可以按任意片段 (包括中文和日文) 搜索
+METADATA_INDEX_FILE_NAME = ".kemono_index.db"
+SEARCH_FILTERS = ("ext", "creator", "service", "since", "until", "year", "sha256", "downloaded")
+SEARCH_BATCH = 500
+
+
+class MetadataIndex:
+    def __init__(self):
+        self.root = None
+        self.db = None
+        self.fts = False  # SQLite 不支持 FTS5 trigram 时退回到 LIKE 查找
+        self.lock = threading.Lock()
+        # 下载任务中的索引操作都在这个线程中依次进行，等待 SQLite 的锁时不阻塞事件循环
+        self.writer = None
+
+    # 打开下载目录中的索引，已经打开同一个目录时直接返回
+    def open(self, root):
+        root = os.path.abspath(root)
+        if self.db is not None and self.root == root:
+            return self
+        self.close()
+        os.makedirs(root, exist_ok=True)
+        db = sqlite3.connect(
+            os.path.join(root, METADATA_INDEX_FILE_NAME),
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS posts (
+                url TEXT PRIMARY KEY,
+                service TEXT,
+                creator TEXT,
+                creator_name TEXT,
+                post_id TEXT,
+                title TEXT,
+                published TEXT,
+                crawled_at REAL
+            )"""
+        )
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS attachments (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                url TEXT NOT NULL,
+                post_url TEXT,
+                file_name TEXT NOT NULL,
+                creator TEXT,
+                published TEXT,
+                size INTEGER,
+                sha256 TEXT,
+                downloaded_at REAL
+            )"""
+        )
+        # 创作者和发布日期在附件表中也保存一份，搜索时按日期顺序扫描附件，取够结果就停止
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS attachments_published ON attachments (published)"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS attachments_creator ON attachments (creator, published)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS attachments_post ON attachments (post_url)")
+        db.execute("CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256)")
+        try:
+            db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS attachment_search"
+                " USING fts5(file_name, title, creator, tokenize='trigram')"
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self.root = root
+        self.db = db
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="metadata-index"
+        )
+        return self
+
+    def close(self):
+        # 先等待写入线程中剩下的操作完成，再关闭数据库
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+        self.writer = None
+        if self.db is not None:
+            self.db.close()
+        self.db = None
+        self.root = None
+
+    # 在写入线程中执行索引操作，索引没有打开时直接执行 (各个方法此时什么都不做)
+    async def run(self, method, *args):
+        if self.writer is None:
+            return method(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.writer, method, *args)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    # 记录一个帖子和它的全部附件 (过滤之前)，已经下载的附件同时记录下载时间
+    def record_post(self, post, attachments):
+        if self.db is None:
+            return
+        now = time.time()
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO posts (url, service, creator, creator_name, post_id, title,"
+                " published, crawled_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (url) DO UPDATE SET creator_name = COALESCE("
+                "excluded.creator_name, creator_name), title = excluded.title,"
+                " published = COALESCE(excluded.published, published),"
+                " crawled_at = excluded.crawled_at",
+                (
+                    post["url"],
+                    post["service"],
+                    post["creator"],
+                    post["creator_name"],
+                    post["post_id"],
+                    post["title"],
+                    post["published"],
+                    now,
+                ),
+            )
+            creator_text = " ".join(
+                part for part in (post["creator"], post["creator_name"]) if part
+            )
+            for attachment in attachments:
+                path = attachment.relative_path
+                downloaded = now if library_index.has_file(os.path.join(self.root, path)) else None
+                db.execute(
+                    "INSERT INTO attachments (path, url, post_url, file_name, creator,"
+                    " published, sha256, downloaded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (path) DO UPDATE SET url = excluded.url,"
+                    " published = excluded.published, sha256 = excluded.sha256,"
+                    " downloaded_at = COALESCE(downloaded_at, excluded.downloaded_at)",
+                    (
+                        path,
+                        attachment.url,
+                        post["url"],
+                        attachment.file_name,
+                        post["creator"],
+                        post["published"],
+                        attachment.sha256,
+                        downloaded,
+                    ),
+                )
+                if not self.fts:
+                    continue
+                (rowid,) = db.execute(
+                    "SELECT id FROM attachments WHERE path = ?", (path,)
+                ).fetchone()
+                db.execute("DELETE FROM attachment_search WHERE rowid = ?", (rowid,))
+                db.execute(
+                    "INSERT INTO attachment_search (rowid, file_name, title, creator)"
+                    " VALUES (?, ?, ?, ?)",
+                    (rowid, attachment.file_name, post["title"], creator_text),
+                )
+
+    # 用索引中记录的大小补全附件的大小，内容相同 (哈希相同) 的文件大小一定相同，不用再预检
+    def fill_sizes(self, attachments):
+        if self.db is None:
+            return 0
+        pending = {}
+        for attachment in attachments:
+            if attachment.size is None and attachment.sha256:
+                pending.setdefault(attachment.sha256, []).append(attachment)
+        hashes = list(pending)
+        filled = 0
+        with self.lock:
+            for start in range(0, len(hashes), SEARCH_BATCH):
+                chunk = hashes[start : start + SEARCH_BATCH]
+                rows = self.db.execute(
+                    "SELECT sha256, MAX(size) FROM attachments WHERE size IS NOT NULL"
+                    f" AND sha256 IN ({','.join('?' * len(chunk))}) GROUP BY sha256",
+                    chunk,
+                ).fetchall()
+                for sha256, size in rows:
+                    for attachment in pending[sha256]:
+                        attachment.size = size
+                        filled += 1
+        return filled
+
+    # 记录预检得到的大小
+    def record_sizes(self, attachments):
+        if self.db is None:
+            return
+        with self.transaction() as db:
+            db.executemany(
+                "UPDATE attachments SET size = ? WHERE path = ?",
+                [(a.size, a.relative_path) for a in attachments if a.size is not None],
+            )
+
+    # 记录下载完成的文件，path 为下载目录中的相对路径
+    def record_download(self, path, size=None):
+        if self.db is None:
+            return
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE attachments SET downloaded_at = ?, size = COALESCE(?, size)"
+                " WHERE path = ?",
+                (time.time(), size, path),
+            )
+
+    # 搜索索引，query 为 parse_search_query 支持的查询字符串，返回结果字典的列表
+    # 先在附件表中按发布日期取出符合条件的附件，再为这一页结果读取帖子信息
+    def search(self, query, limit=100):
+        options = parse_search_query(query)
+        conditions = []
+        params = []
+        match_terms = []
+        for term in options["terms"]:
+            if self.fts and len(term) >= 3:
+                match_terms.append('"' + term.replace('"', '""') + '"')
+            else:
+                # trigram 不能匹配少于 3 个字符的片段，直接在原表上查找
+                conditions.append(
+                    "(a.file_name LIKE ? ESCAPE '\\' OR a.creator LIKE ? ESCAPE '\\'"
+                    " OR a.post_url IN (SELECT url FROM posts WHERE title LIKE ? ESCAPE '\\'"
+                    " OR creator_name LIKE ? ESCAPE '\\'))"
+                )
+                pattern = "%" + re.sub(r"([\\%_])", r"\\\1", term) + "%"
+                params += [pattern] * 4
+        if match_terms:
+            conditions.append(
+                "a.id IN (SELECT rowid FROM attachment_search WHERE attachment_search MATCH ?)"
+            )
+            params.append(" ".join(match_terms))
+        if options["ext"]:
+            conditions.append(
+                "(" + " OR ".join("a.file_name LIKE ?" for _ in options["ext"]) + ")"
+            )
+            params += [f"%.{ext}" for ext in options["ext"]]
+        if options["creator"]:
+            creator = options["creator"]
+            conditions.append(
+                "(a.creator = ? OR a.creator LIKE ?"
+                " OR a.post_url IN (SELECT url FROM posts WHERE creator_name LIKE ?))"
+            )
+            params += [creator, f"%/{creator}", creator]
+        if options["service"]:
+            conditions.append("a.creator LIKE ?")
+            params.append(f"{options['service']}/%")
+        if options["since"]:
+            conditions.append("a.published >= ?")
+            params.append(options["since"])
+        if options["until"]:
+            conditions.append("a.published <= ?")
+            params.append(options["until"])
+        if options["sha256"]:
+            conditions.append("a.sha256 LIKE ?")
+            params.append(options["sha256"].lower() + "%")
+        if options["downloaded"] is not None:
+            conditions.append(
+                "a.downloaded_at IS NOT NULL" if options["downloaded"] else "a.downloaded_at IS NULL"
+            )
+        hits = "SELECT a.id FROM attachments a"
+        if conditions:
+            hits += " WHERE " + " AND ".join(conditions)
+        hits += " ORDER BY a.published DESC, a.id"
+        if limit:
+            hits += f" LIMIT {int(limit)}"
+        sql = (
+            "SELECT a.url, a.file_name, a.post_url, a.creator, p.creator_name, p.service,"
+            " p.title, a.published, a.size, a.sha256, a.path, a.downloaded_at"
+            f" FROM ({hits}) AS hit JOIN attachments a ON a.id = hit.id"
+            " LEFT JOIN posts p ON p.url = a.post_url"
+            " ORDER BY a.published DESC, a.id"
+        )
+        with self.lock:
+            cursor = self.db.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for row in rows:
+            row["local_path"] = os.path.join(self.root, row["path"])
+        return rows
+
+    # 索引中的帖子数和附件数
+    def counts(self):
+        with self.lock:
+            (posts,) = self.db.execute("SELECT COUNT(*) FROM posts").fetchone()
+            (attachments,) = self.db.execute("SELECT COUNT(*) FROM attachments").fetchone()
+        return posts, attachments
+
+
+# 全局的元数据索引，任务开始时打开下载目录中的索引文件
+metadata_index = MetadataIndex()
+
+# 界面中搜索结果的列: (标题, 结果字典的键)
+SEARCH_RESULT_COLUMNS = (
+    ("日期", "published"),
+    ("创作者", "creator"),
+    ("标题", "title"),
+    ("文件名", "file_name"),
+    ("大小", "size"),
+    ("本地文件", "local_path"),
+)
+SEARCH_RESULT_LIMIT = 500
+
+
+# 解析搜索条件: 普通词按文件名、标题和创作者匹配 (全部满足)，"键:值" 为过滤条件
+#   ext:zip,mp4  creator:12345 或创作者名  service:patreon  year:2023
+#   since:2023-01-01  until:2023-06-30  sha256:<哈希或前缀>  downloaded:yes/no
+def parse_search_query(text):
+    options = {key: None for key in SEARCH_FILTERS}
+    options["terms"] = []
+    try:
+        tokens = shlex.split(text or "")
+    except ValueError:
+        tokens = (text or "").split()
+    for token in tokens:
+        key, sep, value = token.partition(":")
+        key = key.lower()
+        if not sep or key not in SEARCH_FILTERS or not value:
+            options["terms"].append(token)
+        elif key == "ext":
+            options["ext"] = [e.strip().lstrip(".").lower() for e in value.split(",") if e.strip()]
+        elif key == "year":
+            if not re.fullmatch(r"\d{4}", value):
+                raise ValueError(f"无法识别的年份: {value}")
+            options["since"] = f"{value}-01-01"
+            options["until"] = f"{value}-12-31"
+        elif key in ("since", "until"):
+            if not re.fullmatch(r"\d{4}(-\d{2}){0,2}", value):
+                raise ValueError(f"无法识别的日期: {value}")
+            options[key] = value
+        elif key == "downloaded":
+            options["downloaded"] = value.lower() in ("yes", "y", "true", "1")
+        else:
+            options[key] = value
+    if options["until"] and len(options["until"]) < 10:
+        # "until:2023" 或 "until:2023-06" 包括这一年或这个月的最后一天
+        options["until"] += "\uffff"
+    return options
+
+
+# 搜索结果转换为附件，用于生成下载清单
+def search_results_to_attachments(rows):
+    return [
+        Attachment(
+            row["url"],
+            row["file_name"],
+            row["post_url"],
+            row["creator"],
+            row["size"],
+            row["published"],
+        )
+        for row in rows
+    ]
+
+
+# 解析 "500MB"、"1.5GB" 这样的大小，K/M/G/T 按 1024 进制换算，纯数字按字节处理
+def parse_size(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"无法识别的大小: {value}")
+    power = " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * 1024**power)
+
+
+# 将多个文件名规则合并成一个正则表达式，"re:" 开头的按正则处理，其余按通配符处理
+def compile_name_patterns(patterns):
+    parts = []
+    for pattern in patterns or ():
+        if pattern.startswith("re:"):
+            parts.append(f"(?:{pattern[3:]})")
+        else:
+            # 正则在文件名中任意位置匹配即可，通配符需要匹配整个文件名
+            parts.append(f"(?:^{fnmatch.translate(pattern)})")
+    if not parts:
+        return None
+    return re.compile("|".join(parts), re.IGNORECASE)
+
+
+# 默认只下载视频和压缩包，与之前的行为一致
+DEFAULT_EXTENSIONS = (".mp4", ".zip")
+
+
+# 附件过滤规则，在请求任何文件之前执行
+# 文件名、扩展名和发布日期在抓取时检查，大小在预检之后、下载之前检查
+class AttachmentFilter:
+    def __init__(
+        self,
+        extensions=DEFAULT_EXTENSIONS,
+        include=(),
+        exclude=(),
+        min_size=None,
+        max_size=None,
+        date_from=None,
+        date_to=None,
+    ):
+        # 扩展名列表为空表示不限制扩展名
+        self.extensions = tuple(
+            (ext if ext.startswith(".") else f".{ext}").lower()
+            for ext in (extensions or ())
+        )
+        self.include = compile_name_patterns(include)
+        self.exclude = compile_name_patterns(exclude)
+        self.min_size = parse_size(min_size)
+        self.max_size = parse_size(max_size)
+        self.date_from = date_from
+        self.date_to = date_to
+        self.creator_rules = {}
+
+    # 从配置字典创建过滤器，creators 中按 "服务/创作者ID" 给出覆盖全局设置的规则
+    @classmethod
+    def from_config(cls, config):
+        base = {key: value for key, value in config.items() if key != "creators"}
+        attachment_filter = cls(**base)
+        for creator, rule in (config.get("creators") or {}).items():
+            attachment_filter.creator_rules[creator] = cls(**dict(base, **rule))
+        return attachment_filter
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_config(json.load(f))
+
+    def for_creator(self, creator):
+        return self.creator_rules.get(creator, self)
+
+    def accepts(self, attachment):
+        rule = self.for_creator(attachment.creator)
+        name = attachment.file_name
+        if rule.extensions and not name.lower().endswith(rule.extensions):
+            return False
+        if rule.include is not None and not rule.include.search(name):
+            return False
+        if rule.exclude is not None and rule.exclude.search(name):
+            return False
+        published = attachment.published
+        if published:
+            if rule.date_from and published < rule.date_from:
+                return False
+            if rule.date_to and published > rule.date_to:
+                return False
+        return True
+
+    # 大小未知的附件不按大小过滤
+    def accepts_size(self, attachment):
+        rule = self.for_creator(attachment.creator)
+        size = attachment.size
+        if size is None:
+            return True
+        if rule.min_size is not None and size < rule.min_size:
+            return False
+        if rule.max_size is not None and size > rule.max_size:
+            return False
+        return True
+
+
+# 由界面或命令行的设置创建过滤器，指定了规则文件时以规则文件为准
+def build_attachment_filter(extensions=None, filter_file=None, **options):
+    if filter_file:
+        return AttachmentFilter.from_file(filter_file)
+    if extensions is not None:
+        options["extensions"] = [e.strip() for e in extensions.split(",") if e.strip()]
+    return AttachmentFilter(**options)
+
+
+# 从帖子页面取出发布日期 YYYY-MM-DD
+def parse_published(soup):
+    published = soup.find("div", class_="post__published")
+    if published is None:
+        return None
+    time_tag = published.find("time")
+    text = time_tag.get("datetime") if time_tag else published.get_text()
+    match = re.search(r"\d{4}-\d{2}-\d{2}", text or "")
+    return match.group(0) if match else None
+
+
+# 从帖子链接中取出 "服务/创作者ID"，例如 patreon/12345
+def creator_from_url(url):
+    match = re.search(r"/([^/]+)/user/([^/?#]+)", url)
+    if match:
+        return f"{match.group(1)}/{match.group(2)}"
+    return None
+
+
+# 将字节数格式化为便于阅读的字符串
+def format_size(num_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+# 将秒数格式化为 时:分:秒
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+# 调度策略: 最大优先可以避免大文件拖到最后，最小优先可以尽快拿到结果
+# 大小未知的文件视为 0 字节
+def schedule_largest_first(attachments):
+    return sorted(attachments, key=lambda a: a.size or 0, reverse=True)
+
+
+def schedule_smallest_first(attachments):
+    return sorted(attachments, key=lambda a: a.size or 0)
+
+
+# 按创作者轮流调度，避免一个创作者的大量附件占满所有下载槽
+def schedule_creator_fair(attachments):
+    groups = {}
+    for attachment in attachments:
+        groups.setdefault(attachment.creator, deque()).append(attachment)
+    ordered = []
+    while groups:
+        for creator in list(groups):
+            ordered.append(groups[creator].popleft())
+            if not groups[creator]:
+                del groups[creator]
+    return ordered
+
+
+SCHEDULING_POLICIES = {
+    "none": list,
+    "largest": schedule_largest_first,
+    "smallest": schedule_smallest_first,
+    "fair": schedule_creator_fair,
+}
+
+# 写入磁盘的附件队列按同样的策略排序时使用的 ORDER BY，与上面的函数结果一致
+SPILLED_SCHEDULING_ORDER = {
+    "none": "seq",
+    "largest": "COALESCE(size, 0) DESC, seq",
+    "smallest": "COALESCE(size, 0), seq",
+    "fair": "round, first_seq",
+}
+
+# 附件队列超过这个数量后写入临时文件，之后每次只在内存中保留一批
+ATTACHMENT_SPILL_THRESHOLD = 200_000
+ATTACHMENT_SPILL_BATCH = 5000
+
+
+# 排队中的附件: 数量不多时就是内存中的列表，超过 spill_threshold 后转存到临时 SQLite 文件，
+# 过滤、预检和调度都按批读取，全站下载时内存占用不随附件数量增长
+class AttachmentQueue:
+    def __init__(self, attachments=(), spill_threshold=ATTACHMENT_SPILL_THRESHOLD):
+        self.spill_threshold = spill_threshold
+        self.items = []  # 未转存时是全部附件，转存后是尚未写入文件的一批
+        self.count = 0
+        self.db = None
+        self.db_path = None
+        self.extend(attachments)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.ordered("none")
+
+    @property
+    def spilled(self):
+        return self.db is not None
+
+    def append(self, attachment):
+        self.items.append(attachment)
+        self.count += 1
+        if self.db is None:
+            if len(self.items) > self.spill_threshold:
+                self._spill()
+        elif len(self.items) >= ATTACHMENT_SPILL_BATCH:
+            self._flush()
+
+    def extend(self, attachments):
+        for attachment in attachments:
+            self.append(attachment)
+
+    def _spill(self):
+        fd, self.db_path = tempfile.mkstemp(prefix="kemono_queue_", suffix=".db")
+        os.close(fd)
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute(
+            "CREATE TABLE attachments (seq INTEGER PRIMARY KEY, url TEXT, file_name TEXT,"
+            " post_url TEXT, creator TEXT, size INTEGER, published TEXT)"
+        )
+        self._flush()
+
+    def _flush(self):
+        if self.db is None or not self.items:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO attachments (url, file_name, post_url, creator, size, published)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (a.url, a.file_name, a.post_url, a.creator, a.size, a.published)
+                    for a in self.items
+                ],
+            )
+        self.items = []
+
+    # 按调度策略的顺序逐个返回附件
+    def ordered(self, policy="none"):
+        if self.db is None:
+            return iter(SCHEDULING_POLICIES[policy](self.items))
+        return (a for batch in self._read_batches(policy) for a in batch)
+
+    # 按批返回附件列表，修改列表中的附件不会写回队列
+    def batches(self, size=ATTACHMENT_SPILL_BATCH):
+        if self.db is None:
+            for i in range(0, len(self.items), size):
+                yield self.items[i : i + size]
+        else:
+            yield from self._read_batches("none", size)
+
+    def _read_batches(self, policy, size=ATTACHMENT_SPILL_BATCH):
+        self._flush()
+        columns = "url, file_name, post_url, creator, size, published"
+        if policy == "fair":
+            # 每个创作者的第 n 个附件排在第 n 轮，同一轮内按创作者第一次出现的顺序
+            columns += (
+                ", ROW_NUMBER() OVER (PARTITION BY creator ORDER BY seq) AS round"
+                ", MIN(seq) OVER (PARTITION BY creator) AS first_seq"
+            )
+        cursor = self.db.execute(
+            f"SELECT {columns} FROM attachments ORDER BY {SPILLED_SCHEDULING_ORDER[policy]}"
+        )
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            yield [Attachment(*row[:6]) for row in rows]
+
+    # 返回满足条件的附件组成的新队列
+    def filter(self, predicate):
+        return AttachmentQueue(
+            (a for a in self.ordered() if predicate(a)), self.spill_threshold
+        )
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            with contextlib.suppress(OSError):
+                os.remove(self.db_path)
+
+
+# 预检: 并发发送 HEAD 请求获取所有附件的 Content-Length
+# 同时进行的 HEAD 请求不超过 concurrency 个，设置了全局请求预算时也计入预算，不再逐个等待请求间隔
+async def preflight_sizes(client, attachments, request_timeout, concurrency, interrupted):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_size(attachment):
+        if interrupted[0]:
+            return
+        async with semaphore:
+            try:
+                response = await client.head(
+                    attachment.url, timeout=request_timeout, follow_redirects=True
+                )
+            except (httpx.RequestError, asyncio.TimeoutError):
+                return
+            length = response.headers.get("content-length")
+            if response.is_success and length and length.isdigit():
+                attachment.size = int(length)
+
+    await asyncio.gather(*(fetch_size(a) for a in attachments))
+    known = [a.size for a in attachments if a.size is not None]
+    return sum(known)
+
+
+# 保存目录中记录的任务统计 (上次的下载速度、自动调整得到的并发数等)
+STATS_FILE_NAME = ".kemono_stats.json"
+
+
+def load_job_stats(save_path):
+    try:
+        with open(os.path.join(save_path, STATS_FILE_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_job_stats(save_path, stats):
+    merged = load_job_stats(save_path)
+    merged.update(stats)
+    try:
+        with open(os.path.join(save_path, STATS_FILE_NAME), "w", encoding="utf-8") as f:
+            json.dump(merged, f, ensure_ascii=False)
+    except OSError:
+        pass
+
+
+# 上次的下载速度，用于在传输开始前估算剩余时间
+def load_throughput_hint(save_path):
+    return load_job_stats(save_path).get("throughput")
+
+
+# 整个任务的下载进度，汇总所有附件的字节数并估算剩余时间
+class JobProgress:
+    def __init__(self, total_bytes, progress_signal, log_signal, throughput_hint=None):
+        self.total_bytes = total_bytes
+        self.done_bytes = 0
+        self.progress_signal = progress_signal
+        self.log_signal = log_signal
+        self.throughput_hint = throughput_hint
+        self.start_time = time.monotonic()
+        self.last_emit = 0.0
+        self.last_report = self.start_time
+        self.failures = 0  # 下载失败 (需要重试) 的次数
+        self.concurrency = None  # 启用自动调整时当前的并发数
+        self.postprocessor = None
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.start_time
+        if elapsed >= 5 and self.done_bytes:
+            return self.done_bytes / elapsed
+        return self.throughput_hint
+
+    def eta(self):
+        throughput = self.throughput()
+        if not throughput or not self.total_bytes:
+            return None
+        return max(0, self.total_bytes - self.done_bytes) / throughput
+
+    def describe(self):
+        text = f"已下载 {format_size(self.done_bytes)} / {format_size(self.total_bytes)}"
+        throughput = self.throughput()
+        if throughput:
+            text += f"，速度 {format_size(throughput)}/s"
+        eta = self.eta()
+        if eta is not None:
+            text += f"，预计剩余 {format_duration(eta)}"
+        if self.concurrency is not None:
+            text += f"，并发 {self.concurrency}"
+        if self.postprocessor is not None:
+            text += f"，{self.postprocessor.describe()}"
+        return text
+
+    # 进度信号最多每 0.2 秒发送一次，全部下载完成时一定发送，进度条不会停在中途
+    def add(self, num_bytes):
+        self.done_bytes += num_bytes
+        now = time.monotonic()
+        if now - self.last_emit >= 0.2 or self.done_bytes >= self.total_bytes:
+            self.emit_progress()
+        if now - self.last_report >= 30:
+            self.last_report = now
+            self.log_signal.emit(self.describe())
+
+    def emit_progress(self):
+        self.last_emit = time.monotonic()
+        if self.total_bytes:
+            self.progress_signal.emit(min(100.0, self.done_bytes / self.total_bytes * 100))
+
+
+# 处理重试队列中的任务
+async def handle_retry_queue(
+    client,
+    retry_queue,
+    user_save_path,
+    progress_signal,
+    log_signal,
+    interrupted,
+    proxy,
+    max_retries,
+    request_timeout,
+    job_progress=None,
+    write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+    bandwidth_limiter=None,
+    postprocessor=None,
+    job_control=None,
+    disk_guard=None,
+    mover=None,
+):
     while retry_queue:
+        if job_control is not None:
+            await job_control.wait_if_paused()
+        if interrupted[0]:
+            log_signal.emit("任务已中断")
+            break
         url, file_name = retry_queue.popleft()
-        await download_file(
+        file_path = await download_file(
             url,
             file_name,
             client,
@@ -181,131 +2630,1763 @@ async def handle_retry_queue(
             max_retries,
             request_timeout,
             retry_queue,
+            job_progress,
+            write_buffer_size,
+            bandwidth_limiter,
+            job_control,
+            disk_guard,
         )
+        await finish_download(url, file_name, file_path, postprocessor, mover, None, job_progress)
+
+
+# 下载完成后的处理: 使用临时下载目录时先移动到下载目录，再记录到元数据索引并提交后处理
+# 移动失败 (例如 sha256 校验失败) 的文件放回重试队列重新下载
+# 每个文件结束后发送一次最新进度，节流时跳过的最后一次更新不会丢失
+async def finish_download(
+    url,
+    file_name,
+    file_path,
+    postprocessor=None,
+    mover=None,
+    retry_queue=None,
+    job_progress=None,
+):
+    if job_progress is not None:
+        job_progress.emit_progress()
+    if file_path is None:
+        return
+    if mover is not None:
+        file_path = await mover.move(file_path, file_name, content_hash_from_url(url))
+        if file_path is None:
+            if retry_queue is not None:
+                retry_queue.append((url, file_name))
+            return
+    await metadata_index.run(
+        metadata_index.record_download, file_name, os.path.getsize(file_path)
+    )
+    if postprocessor is not None:
+        await postprocessor.submit(file_path)
+
+
+# 一个下载任务的全部设置，由命令行或界面创建一次，原样传给 main 和下层函数
+# 运行中会变化的对象 (信号、带宽限制、暂停/停止控制、任务队列) 不放在这里，单独传递
+@dataclasses.dataclass
+class JobOptions:
+    save_path: str
+    max_retries: int = 3
+    request_delay: float = 0
+    request_timeout: float = 30
+    max_concurrent_requests: int = 5
+    use_proxy: bool = False
+    proxy_type: str = "http"
+    proxy_address: str = ""
+    proxy_port: str = ""
+    proxy_list_file: Optional[str] = None
+    breaker_error_rate: float = 0.5
+    scheduling_policy: str = "none"
+    plan_file: Optional[str] = None
+    manifest_file: Optional[str] = None
+    attachment_filter: Optional["AttachmentFilter"] = None
+    write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE
+    autotune_bounds: Optional[tuple] = None
+    postprocess_actions: Optional[list] = None
+    postprocess_command: Optional[str] = None
+    watch_urls: Optional[list] = None
+    watch_intervals: tuple = (600, 3600)
+    request_budget: float = 0
+    http2: bool = False
+    min_free_space: int = DEFAULT_MIN_FREE_SPACE
+    scratch_path: Optional[str] = None
+    max_staged: int = DEFAULT_MAX_STAGED
+
+    def __post_init__(self):
+        if self.attachment_filter is None:
+            self.attachment_filter = AttachmentFilter()
+
+    # 单个代理的地址，使用代理列表或不使用代理时为 None
+    @property
+    def proxy(self):
+        if self.use_proxy and not self.proxy_list_file:
+            return f"{self.proxy_type}://{self.proxy_address}:{self.proxy_port}"
+        return None
+
+
+# 主函数
+# 指定 work_queue 时: 有 worker_id 则作为下载进程领取任务，否则抓取后把附件发布到队列
+async def main(
+    url,
+    options,
+    progress_signal,
+    log_signal,
+    interrupted,
+    state_signal=None,
+    bandwidth_limiter=None,
+    job_control=None,
+    work_queue=None,
+    worker_id=None,
+):
+    save_path = options.save_path
+    publish_only = work_queue is not None and worker_id is None
+    http2 = options.http2
+    if http2 and not HTTP2_AVAILABLE:
+        log_signal.emit("没有安装 h2，页面请求改用 HTTP/1.1 (pip install httpx[http2])")
+        http2 = False
+
+    proxies = []
+    if options.proxy_list_file:
+        proxies = load_proxy_list(options.proxy_list_file)
+        log_signal.emit(f"已从代理列表加载 {len(proxies)} 个代理")
+    elif options.proxy:
+        proxies = [options.proxy]
+
+    # 自动调整并发数时按上限建立连接池
+    max_connections = options.max_concurrent_requests
+    if options.autotune_bounds is not None:
+        max_connections = max(max_connections, options.autotune_bounds[1])
+    limits = httpx.Limits(
+        max_keepalive_connections=max_connections,
+        max_connections=max_connections,
+    )
+    breaker = CircuitBreaker(
+        error_rate=options.breaker_error_rate, log_signal=log_signal, state_signal=state_signal
+    )
+    if job_control is None:
+        job_control = JobControl(interrupted)
+    job_control.bind()
+    stopped = False
+    failed_pages = 0
+    if state_signal is not None:
+        state_signal.emit("运行中")
+    budget = RequestBudget(options.request_budget) if options.request_budget else None
+    async with ProxyPool(
+        proxies, limits, log_signal, breaker=breaker, budget=budget, http2=http2
+    ) as client:
+        try:
+            # 所有文件都按 服务/创作者/帖子/文件名 保存在下载目录中，启动时建立一次目录索引
+            # 扫描下载目录、打开元数据索引的同时预先建立到站点的连接
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(
+                client.prewarm(url or "https://kemono.su"),
+                loop.run_in_executor(None, library_index.scan, save_path),
+                loop.run_in_executor(None, metadata_index.open, save_path),
+            )
+            legacy_folders = find_legacy_folders(save_path)
+            if legacy_folders:
+                log_signal.emit(
+                    f"下载目录中有 {len(legacy_folders)} 个旧的按时间命名的文件夹，"
+                    "可以用 migrate 命令整理到新的目录结构"
+                )
+            if options.watch_urls:
+                await watch_creators(
+                    options,
+                    client,
+                    breaker,
+                    progress_signal,
+                    log_signal,
+                    interrupted,
+                    bandwidth_limiter,
+                    job_control,
+                )
+            elif work_queue is not None and worker_id is not None:
+                await run_queue_worker(
+                    work_queue,
+                    worker_id,
+                    options,
+                    client,
+                    breaker,
+                    progress_signal,
+                    log_signal,
+                    interrupted,
+                    bandwidth_limiter,
+                    job_control,
+                )
+            else:
+                failed_pages = await crawl_and_download(
+                    url,
+                    options,
+                    client,
+                    breaker,
+                    progress_signal,
+                    log_signal,
+                    interrupted,
+                    bandwidth_limiter,
+                    job_control,
+                    work_queue,
+                )
+        except HostBlockedError as e:
+            log_signal.emit(f"站点 {e} 已封锁或不可用，任务终止", "error")
+        except LibraryDiskFullError as e:
+            # 继续下载只会在临时目录中堆积无法移动的文件，任务按出错结束
+            if state_signal is not None:
+                state_signal.emit("受阻")
+            log_signal.emit(
+                f"下载目录所在磁盘已满: {e}，任务终止。已下载的文件保留在临时下载目录中，"
+                "释放空间后重新运行会直接移动，不需要重新下载",
+                "error",
+            )
+            raise
+        except asyncio.CancelledError:
+            # 任务被停止 (包括 Ctrl+C): 所有请求已经取消，批量任务中后面的地址也不再开始
+            stopped = True
+            interrupted[0] = True
+
+    if stopped:
+        if state_signal is not None:
+            state_signal.emit("已停止")
+        log_signal.emit("下载任务已停止")
+        return
+    if options.plan_file:
+        message = "下载清单生成完成！"
+    elif publish_only:
+        message = "任务已发布到队列！"
+    elif work_queue is not None:
+        message = "队列中的任务已全部完成！"
+    elif options.watch_urls:
+        message = "监视已结束"
+    else:
+        message = "所有下载任务完成！"
+    finish_job(breaker, state_signal, log_signal, message, failed_pages)
+
+
+# 根据熔断器的状态和无法获取的页面数报告任务结果，有页面没有抓取到时结果不完整，不报告完成
+def finish_job(breaker, state_signal, log_signal, message, failed_pages=0):
+    if breaker.blocked:
+        if state_signal is not None:
+            state_signal.emit("受阻")
+        log_signal.emit("下载任务因站点封锁未能完成", "error")
+        return
+    if failed_pages:
+        if state_signal is not None:
+            state_signal.emit("降级")
+        log_signal.emit(f"下载任务结束，但有 {failed_pages} 个页面无法获取，结果不完整", "warning")
+        return
+    if breaker.state() != "正常":
+        if state_signal is not None:
+            state_signal.emit("降级")
+        log_signal.emit("下载任务结束，但站点处于降级状态，部分请求失败")
+        return
+    if state_signal is not None:
+        state_signal.emit("已完成")
+    log_signal.emit(message)
+
+
+# 抓取分页和帖子并下载附件的函数，返回无法获取的页面数
+async def crawl_and_download(
+    url,
+    options,
+    client,
+    breaker,
+    progress_signal,
+    log_signal,
+    interrupted,
+    bandwidth_limiter=None,
+    job_control=None,
+    work_queue=None,
+):
+    save_path = options.save_path
+    plan_file = options.plan_file
+    attachment_filter = options.attachment_filter
+    failed_pages = 0
+    if options.manifest_file:
+        # 直接执行之前生成的清单，不再重新抓取
+        attachments = AttachmentQueue(
+            a for a in iter_manifest(options.manifest_file) if attachment_filter.accepts(a)
+        )
+        log_signal.emit(f"已从清单加载 {len(attachments)} 个附件")
+    else:
+        attachments, failed_pages = await crawl_attachments(
+            url, options, client, log_signal, interrupted, job_control
+        )
+    try:
+        if not attachments or interrupted[0]:
+            return failed_pages
+        if attachments.spilled:
+            log_signal.emit(f"附件较多 ({len(attachments)} 个)，排队中的附件已转存到临时文件")
+
+        if not plan_file and work_queue is None:
+            remaining = attachments.filter(
+                lambda a: not library_index.has_attachment(save_path, a)
+            )
+            attachments.close()
+            skipped = len(attachments) - len(remaining)
+            attachments = remaining
+            if skipped:
+                log_signal.emit(f"下载目录中已有 {skipped} 个文件，跳过")
+
+        # 预检所有附件的大小，在传输第一个字节之前给出总大小和预计时间
+        # 附件按批预检，转存到临时文件的队列每次只读入一批
+        # 元数据索引中已经有大小的附件不再发送预检请求
+        sized = AttachmentQueue(spill_threshold=attachments.spill_threshold)
+        filtered = 0
+        for batch in attachments.batches():
+            await metadata_index.run(metadata_index.fill_sizes, batch)
+            unsized = [a for a in batch if a.size is None]
+            await preflight_sizes(
+                client,
+                unsized,
+                options.request_timeout,
+                options.max_concurrent_requests,
+                interrupted,
+            )
+            await metadata_index.run(metadata_index.record_sizes, unsized)
+            for attachment in batch:
+                if attachment_filter.accepts_size(attachment):
+                    sized.append(attachment)
+                else:
+                    filtered += 1
+        attachments.close()
+        attachments = sized
+        if filtered:
+            log_signal.emit(f"按大小过滤掉 {filtered} 个附件")
+        total_bytes = unknown = 0
+        for attachment in attachments:
+            if attachment.size is None:
+                unknown += 1
+            else:
+                total_bytes += attachment.size
+        log_signal.emit(
+            f"预检完成: 共 {len(attachments)} 个附件，总大小 {format_size(total_bytes)}"
+            + (f"，其中 {unknown} 个大小未知" if unknown else "")
+        )
+
+        if plan_file:
+            library = {
+                a.relative_path
+                for a in attachments
+                if library_index.has_attachment(save_path, a)
+            }
+            rows = write_manifest(plan_file, attachments, library)
+            missing = [row for row in rows if not row["in_library"]]
+            log_signal.emit(
+                f"下载清单已写入 {plan_file}: 共 {len(rows)} 个附件 ({format_size(total_bytes)})，"
+                f"其中 {len(missing)} 个尚未下载"
+            )
+            return failed_pages
+        if work_queue is not None:
+            published = 0
+            for batch in attachments.batches():
+                published += await asyncio.get_running_loop().run_in_executor(
+                    None, work_queue.publish, batch
+                )
+            log_signal.emit(
+                f"已发布 {published} 个新任务到队列 (共 {len(attachments)} 个附件，"
+                f"其余已在队列中)"
+            )
+            return failed_pages
+
+        job_progress = JobProgress(
+            total_bytes, progress_signal, log_signal, load_throughput_hint(save_path)
+        )
+        eta = job_progress.eta()
+        if eta is not None:
+            log_signal.emit(f"根据上次的下载速度，预计需要 {format_duration(eta)}")
+
+        download_options = options
+        if options.autotune_bounds is not None:
+            # 从上次自动调整得到的并发数开始
+            last_concurrency = load_job_stats(save_path).get("concurrency")
+            if last_concurrency:
+                low, high = options.autotune_bounds
+                download_options = dataclasses.replace(
+                    options, max_concurrent_requests=max(low, min(high, last_concurrency))
+                )
+        autotuner = await download_attachments(
+            attachments.ordered(options.scheduling_policy),
+            download_options,
+            client,
+            breaker,
+            progress_signal,
+            log_signal,
+            interrupted,
+            job_progress,
+            bandwidth_limiter,
+            job_control,
+        )
+    finally:
+        attachments.close()
+    stats = {}
+    if job_progress.done_bytes:
+        log_signal.emit(job_progress.describe())
+        elapsed = time.monotonic() - job_progress.start_time
+        stats["throughput"] = job_progress.done_bytes / max(elapsed, 1e-3)
+    if autotuner is not None:
+        stats["concurrency"] = autotuner.semaphore.limit
+        stats["concurrency_history"] = autotuner.history[-200:]
+    if stats:
+        save_job_stats(save_path, stats)
+    return failed_pages
+
+
+# 抓取分页和帖子，收集所有需要下载的附件
+# 返回 (附件队列, 无法获取的页面数)；某一页分页无法获取时后面的分页也无法得到，停止翻页
+async def crawl_attachments(url, options, client, log_signal, interrupted, job_control=None):
+    proxy, max_retries = options.proxy, options.max_retries
+    request_delay, request_timeout = options.request_delay, options.request_timeout
+    attachment_filter = options.attachment_filter
+    links = []
+    base_url = "https://kemono.su"
+    attachments = AttachmentQueue()
+    failed_pages = 0
+
+    page_url = url
+    while page_url:
+        if interrupted[0]:
+            log_signal.emit("任务已中断")
+            return attachments, failed_pages
+        if job_control is not None:
+            await job_control.wait_if_paused()
+        try:
+            html = await get_page_html(
+                page_url,
+                client,
+                proxy,
+                max_retries,
+                request_timeout,
+            )
+        except PageFetchError as e:
+            failed_pages += 1
+            if page_url == url:
+                log_signal.emit(f"无法获取页面: {e}", "error")
+            else:
+                log_signal.emit(f"无法获取分页: {e}，之后的分页没有抓取", "warning")
+            break
+        if not html:
+            if page_url == url:
+                failed_pages += 1
+                log_signal.emit(f"页面不存在: {url}", "error")
+            break
+        page_links, page_url = await parser_pool.run(parse_listing_page, html, base_url)
+        links.extend(page_links)
+        # 添加请求之间的延迟
+        await asyncio.sleep(client.pacing_delay(request_delay))
+
+    for link in links:
+        if job_control is not None:
+            await job_control.wait_if_paused()
+        if interrupted[0]:
+            log_signal.emit("任务已中断")
+            break
+        try:
+            html = await get_page_html(
+                link,
+                client,
+                proxy,
+                max_retries,
+                request_timeout,
+            )
+        except PageFetchError as e:
+            failed_pages += 1
+            log_signal.emit(f"无法获取帖子: {e}", "warning", "post-fetch-failed")
+            html = None
+        if html:
+            attachments.extend(await read_post_page(html, link, attachment_filter))
+        # 添加请求之间的延迟
+        await asyncio.sleep(client.pacing_delay(request_delay))
+    return attachments, failed_pages
+
+
+# 从帖子页面中取出帖子信息和全部附件 (过滤之前)，在解析线程池或进程池中执行
+def parse_post_page(html, link):
+    soup = BeautifulSoup(html, "html.parser")
+    creator = creator_from_url(link)
+    published = parse_published(soup)
+    attachments = []
+    for attachment_link in soup.find_all("a", class_="post__attachment-link"):
+        href = attachment_link.get("href")
+        if href:
+            file_name = sanitize_filename(attachment_link.text)
+            attachments.append(Attachment(href, file_name, link, creator, published=published))
+    title = soup.find("h1", class_="post__title")
+    if title is not None:
+        # 标题后面的 span 是服务名，例如 (Patreon)
+        title = (title.find("span") or title).get_text(strip=True)
+    creator_name = soup.find(class_="post__user-name")
+    post = {
+        "url": link,
+        "service": creator.split("/")[0] if creator else None,
+        "creator": creator,
+        "creator_name": creator_name.get_text(strip=True) if creator_name else None,
+        "post_id": post_id_from_url(link),
+        "title": title or None,
+        "published": published,
+    }
+    return post, attachments
+
+
+# 解析帖子页面，把帖子和全部附件记录到元数据索引，返回通过过滤规则的附件
+async def read_post_page(html, link, attachment_filter):
+    post, attachments = await parser_pool.run(parse_post_page, html, link)
+    await metadata_index.run(metadata_index.record_post, post, attachments)
+    return [a for a in attachments if attachment_filter.accepts(a)]
+
+
+# 下载完成后的处理，在进程池中执行
+#   extract   解压 .zip 到同名文件夹
+#   checksum  在文件旁写入 .sha256 校验文件
+#   command   执行用户指定的命令，{path} 会被替换为文件路径
+POSTPROCESS_ACTIONS = ("extract", "checksum", "command")
+
+
+def parse_postprocess_actions(text):
+    actions = [part.strip().lower() for part in (text or "").split(",") if part.strip()]
+    for action in actions:
+        if action not in POSTPROCESS_ACTIONS:
+            raise ValueError(f"未知的后处理动作: {action}")
+    return actions
+
+
+def postprocess_file(path, actions, command=None):
+    messages = []
+    try:
+        size = os.path.getsize(path)
+        for action in actions:
+            if action == "extract" and zipfile.is_zipfile(path):
+                target = os.path.splitext(path)[0]
+                with zipfile.ZipFile(path) as archive:
+                    archive.extractall(target)
+                messages.append(f"已解压到 {target}")
+            elif action == "checksum":
+                digest = hash_file(path)[1]
+                with open(path + ".sha256", "w", encoding="utf-8") as f:
+                    f.write(f"{digest}  {os.path.basename(path)}\n")
+            elif action == "command" and command:
+                quoted = (
+                    subprocess.list2cmdline([path]) if os.name == "nt" else shlex.quote(path)
+                )
+                result = subprocess.run(
+                    command.replace("{path}", quoted), shell=True, capture_output=True
+                )
+                if result.returncode != 0:
+                    return path, False, f"命令返回 {result.returncode}", size
+    except (OSError, zipfile.BadZipFile, RuntimeError) as e:
+        return path, False, str(e), 0
+    return path, True, "，".join(messages), size
+
+
+# 后台后处理流水线: 下载完成的文件放入有界队列，由进程池并发处理
+# 队列满时只会让提交的下载任务等待，不占用下载并发名额
+class PostProcessor:
+    def __init__(self, actions, command, log_signal, workers=None, queue_size=None):
+        self.actions = tuple(actions)
+        self.command = command
+        self.log_signal = log_signal
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.queue = asyncio.Queue(maxsize=queue_size or self.workers * 2)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        self.tasks = []
+        self.in_progress = 0
+        self.processed = 0
+        self.failed = 0
+        self.processed_bytes = 0
+        self.start_time = time.monotonic()
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, path):
+        await self.queue.put(path)
+
+    def backlog(self):
+        return self.queue.qsize() + self.in_progress
+
+    def describe(self):
+        elapsed = max(time.monotonic() - self.start_time, 1e-3)
+        return (
+            f"后处理: 完成 {self.processed} 个，积压 {self.backlog()} 个，"
+            f"{format_size(self.processed_bytes / elapsed)}/s"
+        )
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            path = await self.queue.get()
+            self.in_progress += 1
+            try:
+                _, ok, message, size = await loop.run_in_executor(
+                    self.executor, postprocess_file, path, self.actions, self.command
+                )
+                if ok:
+                    self.processed += 1
+                    self.processed_bytes += size
+                    if message:
+                        self.log_signal.emit(f"后处理完成: {path} {message}", "debug")
+                else:
+                    self.failed += 1
+                    self.log_signal.emit(
+                        f"后处理失败: {path} {message}", "warning", "postprocess-failed"
+                    )
+            finally:
+                self.in_progress -= 1
+                self.queue.task_done()
+
+    # 等待队列中的文件全部处理完再关闭进程池
+    async def close(self, wait=True):
+        if wait:
+            await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+        self.log_signal.emit(self.describe() + (f"，失败 {self.failed} 个" if self.failed else ""))
+
+
+# 可以在运行中修改上限的信号量，用于动态调整下载并发数
+class AdjustableSemaphore:
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            self.waiting += 1
+            try:
+                await self.condition.wait_for(lambda: self.active < self.limit)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    async def set_limit(self, limit):
+        async with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+# 下载并发数自动调整: 定期测量总下载速度和错误/429 比例
+# 速度还在提升时逐步增加并发，速度不再提升时退回一步，错误增多时按比例减少
+class ConcurrencyAutotuner:
+    def __init__(
+        self,
+        semaphore,
+        job_progress,
+        client,
+        min_limit,
+        max_limit,
+        log_signal,
+        interval=15,
+        max_error_rate=0.1,
+    ):
+        self.semaphore = semaphore
+        self.job_progress = job_progress
+        self.client = client
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.log_signal = log_signal
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        self.history = []  # [时间戳, 并发数, 速度(字节/秒), 错误率]
+        self.last_goodput = None
+        self.hold = 0  # 调整后保持不动的周期数
+
+    def _counters(self):
+        return (
+            self.job_progress.done_bytes,
+            getattr(self.client, "request_count", 0),
+            getattr(self.client, "error_count", 0) + self.job_progress.failures,
+            getattr(self.client, "throttled_count", 0),
+        )
+
+    async def _set_limit(self, limit, reason, goodput):
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if limit == self.semaphore.limit:
+            return
+        self.log_signal.emit(
+            f"并发数调整: {self.semaphore.limit} -> {limit} "
+            f"({reason}，速度 {format_size(goodput)}/s)"
+        )
+        await self.semaphore.set_limit(limit)
+        self.job_progress.concurrency = limit
+
+    # 根据一个周期内的测量结果决定下一步
+    async def step(self, goodput, error_rate, throttled):
+        limit = self.semaphore.limit
+        self.history.append(
+            [round(time.time()), limit, round(goodput), round(error_rate, 3)]
+        )
+        if throttled or error_rate > self.max_error_rate:
+            await self._set_limit(int(limit * 0.75), "错误或限速增多", goodput)
+            self.last_goodput = None
+            self.hold = 2
+        elif self.hold > 0:
+            self.hold -= 1
+        elif self.last_goodput is None or goodput > self.last_goodput * 1.05:
+            # 只有还有任务在排队时增加并发才有意义
+            if self.semaphore.waiting:
+                await self._set_limit(limit + 1, "速度仍在提升", goodput)
+            self.last_goodput = goodput
+        else:
+            await self._set_limit(limit - 1, "速度不再提升", goodput)
+            self.last_goodput = None
+            self.hold = 4
+
+    async def run(self):
+        self.job_progress.concurrency = self.semaphore.limit
+        last = self._counters()
+        last_time = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            current = self._counters()
+            elapsed = max(now - last_time, 1e-3)
+            goodput = (current[0] - last[0]) / elapsed
+            requests = current[1] - last[1]
+            errors = current[2] - last[2]
+            throttled = current[3] - last[3]
+            error_rate = errors / requests if requests else 0.0
+            last, last_time = current, now
+            await self.step(goodput, error_rate, throttled)
+
+
+# 按调度顺序下载附件
+async def download_attachments(
+    attachments,
+    options,
+    client,
+    breaker,
+    progress_signal,
+    log_signal,
+    interrupted,
+    job_progress=None,
+    bandwidth_limiter=None,
+    job_control=None,
+):
+    save_path, scratch_path = options.save_path, options.scratch_path
+    proxy, max_retries = options.proxy, options.max_retries
+    request_delay, request_timeout = options.request_delay, options.request_timeout
+    write_buffer_size = options.write_buffer_size
+    retry_queue = deque()
+    semaphore = AdjustableSemaphore(options.max_concurrent_requests)
+    # 指定了临时下载目录时先下载到临时目录，由后台线程移动到下载目录
+    stage_path = scratch_path or save_path
+    mover = None
+    if scratch_path:
+        mover = StagingMover(scratch_path, save_path, log_signal).start()
+    disk_guard = DiskSpaceGuard(
+        stage_path, options.min_free_space, log_signal, mover, options.max_staged
+    )
+    if mover is not None:
+        mover.disk_guard = disk_guard
+        mover.library_guard = DiskSpaceGuard(
+            save_path, options.min_free_space, log_signal, activity="把文件移动到下载目录"
+        )
+    autotuner = None
+    autotune_task = None
+    if options.autotune_bounds is not None and job_progress is not None:
+        autotuner = ConcurrencyAutotuner(
+            semaphore, job_progress, client, *options.autotune_bounds, log_signal
+        )
+        autotune_task = asyncio.create_task(autotuner.run())
+    postprocessor = None
+    if options.postprocess_actions:
+        postprocessor = PostProcessor(
+            options.postprocess_actions, options.postprocess_command, log_signal
+        )
+        postprocessor.start()
+        if job_progress is not None:
+            job_progress.postprocessor = postprocessor
+
+    async def download_with_semaphore(url, file_name, client, size=None):
+        file_path = None
+        async with semaphore:
+            try:
+                if mover is not None and mover.has_staged(file_name):
+                    # 上次运行已经下载到临时目录、还没有移动的文件，直接移动
+                    file_path = os.path.join(scratch_path, file_name)
+                else:
+                    file_path = await download_file(
+                        url,
+                        file_name,
+                        client,
+                        stage_path,
+                        progress_signal,
+                        log_signal,
+                        interrupted,
+                        proxy,
+                        max_retries,
+                        request_timeout,
+                        retry_queue,
+                        job_progress,
+                        write_buffer_size,
+                        bandwidth_limiter,
+                        job_control,
+                        disk_guard,
+                        size,
+                    )
+            except HostBlockedError:
+                log_signal.emit(f"站点已封锁，跳过: {file_name}", "warning", "host-blocked")
+                retry_queue.append((url, file_name))
+        # 在释放下载名额之后再移动文件和提交后处理，移动或后处理积压时不会阻塞其他下载
+        await finish_download(
+            url, file_name, file_path, postprocessor, mover, retry_queue, job_progress
+        )
+
+    completed = False
+    try:
+        await run_download_tasks(
+            attachments,
+            download_with_semaphore,
+            client,
+            breaker,
+            request_delay,
+            log_signal,
+            interrupted,
+            job_control,
+        )
+        completed = True
+
+        # 处理重试队列中的任务
+        if breaker.blocked:
+            return autotuner
+        if retry_queue:
+            log_signal.emit("开始处理重试队列中的任务")
+            await handle_retry_queue(
+                client,
+                retry_queue,
+                stage_path,
+                progress_signal,
+                log_signal,
+                interrupted,
+                proxy,
+                max_retries,
+                request_timeout,
+                job_progress,
+                write_buffer_size,
+                bandwidth_limiter,
+                postprocessor,
+                job_control,
+                disk_guard,
+                mover,
+            )
+    finally:
+        if autotune_task is not None:
+            autotune_task.cancel()
+            await asyncio.gather(autotune_task, return_exceptions=True)
+        if mover is not None:
+            await mover.close()
+            if mover.moved or mover.failed:
+                log_signal.emit(mover.describe())
+        if postprocessor is not None:
+            # 用户停止或出错时不再等待剩余的后处理
+            wait = completed and not interrupted[0]
+            if wait and postprocessor.backlog():
+                log_signal.emit("等待后处理完成")
+            await postprocessor.close(wait=wait)
+    return autotuner
+
+
+# 同时存在的下载任务数上限，其余附件留在队列中，等有任务完成后再创建
+DOWNLOAD_TASK_WINDOW = 256
+
+
+# 为每个附件创建下载任务并等待全部完成，站点被封锁时取消剩余任务
+async def run_download_tasks(
+    attachments,
+    download_with_semaphore,
+    client,
+    breaker,
+    request_delay,
+    log_signal,
+    interrupted,
+    job_control=None,
+):
+    tasks = set()
+    try:
+        for attachment in attachments:
+            while len(tasks) >= DOWNLOAD_TASK_WINDOW:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            # 暂停时不再开始新的下载
+            if job_control is not None:
+                await job_control.wait_if_paused()
+            if interrupted[0]:
+                log_signal.emit("任务已中断")
+                break
+            if breaker.blocked:
+                raise HostBlockedError(httpx.URL(attachment.url).host)
+            task = asyncio.create_task(
+                download_with_semaphore(
+                    attachment.url, attachment.relative_path, client, attachment.size
+                )
+            )
+            tasks.add(task)
+            # 添加请求之间的延迟
+            await asyncio.sleep(client.pacing_delay(request_delay))
+        await asyncio.gather(*tasks)
+    except (HostBlockedError, asyncio.CancelledError):
+        # 站点已封锁或任务被停止，取消尚未完成的下载任务后再退出
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+# 下载进程: 从任务队列中分批领取附件下载，完成或失败后回报给队列
+# 领取的任务在下载期间定期续约，队列中没有可领取的任务且其他进程的租约都结束后退出
+async def run_queue_worker(
+    work_queue,
+    worker_id,
+    options,
+    client,
+    breaker,
+    progress_signal,
+    log_signal,
+    interrupted,
+    bandwidth_limiter=None,
+    job_control=None,
+):
+    save_path = options.save_path
+    loop = asyncio.get_running_loop()
+    held = set()
+    batch_size = options.max_concurrent_requests * 2
+    job_progress = JobProgress(0, progress_signal, log_signal, load_throughput_hint(save_path))
+    completed = failed = 0
+
+    async def renew_leases():
+        while True:
+            await asyncio.sleep(work_queue.lease_seconds / 3)
+            if held:
+                await loop.run_in_executor(None, work_queue.renew, worker_id, list(held))
+
+    log_signal.emit(f"下载进程 {worker_id} 开始领取任务")
+    renew_task = asyncio.create_task(renew_leases())
+    try:
+        while not interrupted[0] and not breaker.blocked:
+            if job_control is not None:
+                await job_control.wait_if_paused()
+                if interrupted[0]:
+                    break
+            batch = await loop.run_in_executor(None, work_queue.claim, worker_id, batch_size)
+            if not batch:
+                counts = await loop.run_in_executor(None, work_queue.counts)
+                if not counts.get("pending") and not counts.get("leased"):
+                    break
+                # 其他进程还持有租约，等待它们完成或租约过期
+                await asyncio.sleep(min(1, work_queue.lease_seconds / 4))
+                continue
+            held.update(a.url for a in batch)
+
+            # 下载目录中已经有的文件直接回报完成
+            pending = []
+            for attachment in batch:
+                if library_index.has_attachment(save_path, attachment):
+                    await loop.run_in_executor(
+                        None, work_queue.complete, worker_id, attachment.url, None, attachment.size
+                    )
+                    held.discard(attachment.url)
+                else:
+                    pending.append(attachment)
+            job_progress.total_bytes += sum(a.size or 0 for a in pending)
+
+            try:
+                # 每一批下载完成后等待这一批的后处理结束，再领取下一批
+                await download_attachments(
+                    pending,
+                    options,
+                    client,
+                    breaker,
+                    progress_signal,
+                    log_signal,
+                    interrupted,
+                    job_progress,
+                    bandwidth_limiter,
+                    job_control,
+                )
+            except asyncio.CancelledError:
+                interrupted[0] = True  # 被取消的任务不计入失败次数
+                raise
+            finally:
+                for attachment in pending:
+                    file_path = os.path.join(save_path, attachment.relative_path)
+                    if library_index.has_file(file_path):
+                        size = os.path.getsize(file_path)
+                        await loop.run_in_executor(
+                            None, work_queue.complete, worker_id, attachment.url, file_path, size
+                        )
+                        completed += 1
+                        held.discard(attachment.url)
+                    elif not (interrupted[0] or breaker.blocked):
+                        await loop.run_in_executor(
+                            None, work_queue.fail, worker_id, attachment.url
+                        )
+                        failed += 1
+                        held.discard(attachment.url)
+    finally:
+        renew_task.cancel()
+        await asyncio.gather(renew_task, return_exceptions=True)
+        if held:
+            # 被停止或站点被封锁时，把没下载完的任务还给其他进程
+            await loop.run_in_executor(None, work_queue.release, worker_id, list(held))
+            log_signal.emit(f"已归还 {len(held)} 个未完成的任务")
+
+    log_signal.emit(f"下载进程 {worker_id} 结束: 完成 {completed} 个，失败 {failed} 个")
+    if job_progress.done_bytes:
+        log_signal.emit(job_progress.describe())
+
+
+# 监视模式的状态文件，保存在下载目录中，记录每个创作者已知的帖子和检查间隔
+WATCH_STATE_FILE_NAME = ".kemono_watch.json"
+
+# 每个创作者最多记住的帖子数，只需要覆盖最新的几页
+WATCH_KNOWN_POSTS = 200
+
+
+# 读取创作者列表文件，每行一个创作者主页地址，# 开头的行为注释
+def load_creator_list(path):
+    urls = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#") and line not in urls:
+                urls.append(line)
+    return urls
+
+
+def load_watch_state(save_path):
+    try:
+        with open(os.path.join(save_path, WATCH_STATE_FILE_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_watch_state(save_path, watches):
+    path = os.path.join(save_path, WATCH_STATE_FILE_NAME)
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({w.url: w.to_dict() for w in watches}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def post_id_from_url(url):
+    match = re.search(r"/post/([^/?#]+)", url)
+    return match.group(1) if match else None
+
+
+# 单个创作者的监视状态: 已知的帖子、条件请求的缓存验证信息和自适应的检查间隔
+class CreatorWatch:
+    def __init__(
+        self,
+        url,
+        interval,
+        known=None,
+        etag=None,
+        last_modified=None,
+        next_check=0.0,
+        changes=0,
+    ):
+        self.url = url
+        self.interval = interval
+        self.known = known or []  # 已知的帖子 ID，最新的在前
+        self.etag = etag
+        self.last_modified = last_modified
+        self.next_check = next_check
+        self.changes = changes
+
+    @classmethod
+    def from_dict(cls, url, data, interval):
+        data = data or {}
+        return cls(
+            url,
+            data.get("interval", interval),
+            data.get("known"),
+            data.get("etag"),
+            data.get("last_modified"),
+            data.get("next_check", 0.0),
+            data.get("changes", 0),
+        )
+
+    def to_dict(self):
+        return {
+            "interval": self.interval,
+            "known": self.known,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "next_check": self.next_check,
+            "changes": self.changes,
+        }
+
+    # 有新帖子时缩短检查间隔，没有时逐渐放宽，加一点随机避免所有创作者同时检查
+    def schedule(self, changed, min_interval, max_interval):
+        if changed:
+            self.changes += 1
+            self.interval = max(min_interval, self.interval / 2)
+        else:
+            self.interval = min(max_interval, self.interval * 1.5)
+        self.next_check = time.time() + self.interval * random.uniform(0.9, 1.1)
+
+
+# 检查创作者是否有新帖子，返回新帖子地址 (从旧到新) 和第一页的 (ETag, Last-Modified)
+# 先用 If-None-Match/If-Modified-Since 请求第一页，未修改时只花一次 304 响应
+# 新帖子由调用方处理成功后再记为已知，第一次检查只记录现有的帖子作为基准，不下载
+async def check_creator(
+    client, watch, proxy, max_retries, request_timeout, request_delay, max_pages=10
+):
+    headers = {}
+    if watch.etag:
+        headers["If-None-Match"] = watch.etag
+    if watch.last_modified:
+        headers["If-Modified-Since"] = watch.last_modified
+    response = await client.get(watch.url, headers=headers, timeout=request_timeout)
+    if response.status_code == 304:
+        return [], None
+    response.raise_for_status()
+    validators = (response.headers.get("etag"), response.headers.get("last-modified"))
+
+    known = set(watch.known)
+    new_links = []
+    html = response.text
+    for _ in range(max_pages):
+        page_links, next_page_url = await parser_pool.run(
+            parse_listing_page, html, "https://kemono.su"
+        )
+        page_ids = [post_id_from_url(link) for link in page_links]
+        found = any(post_id in known for post_id in page_ids)
+        # 之前获取失败的帖子不在已知列表中，排在已知帖子后面也要重新收集
+        for link, post_id in dict(zip(page_links, page_ids)).items():
+            if post_id not in known:
+                new_links.append(link)
+        # 第一页就全是新帖子时继续往后翻，直到遇到已知的帖子
+        if found or not known:
+            break
+        if not next_page_url:
+            break
+        await asyncio.sleep(client.pacing_delay(request_delay))
+        html = await get_page_html(next_page_url, client, proxy, max_retries, request_timeout)
+        if not html:
+            break
+
+    if not known:
+        watch.known = [post_id_from_url(link) for link in new_links][:WATCH_KNOWN_POSTS]
+        watch.etag, watch.last_modified = validators
+        return [], None
+    return new_links[::-1], validators
+
+
+# 监视模式: 按各自的间隔检查创作者，只把新帖子的附件送进下载流程
+# 所有请求共用代理池上的全局请求预算，检查和下载不会超过设定的请求频率
+async def watch_creators(
+    options,
+    client,
+    breaker,
+    progress_signal,
+    log_signal,
+    interrupted,
+    bandwidth_limiter=None,
+    job_control=None,
+):
+    save_path, attachment_filter = options.save_path, options.attachment_filter
+    proxy, max_retries = options.proxy, options.max_retries
+    request_delay, request_timeout = options.request_delay, options.request_timeout
+    min_interval, max_interval = options.watch_intervals
+    state = load_watch_state(save_path)
+    watches = [
+        CreatorWatch.from_dict(url, state.get(url), max_interval) for url in options.watch_urls
+    ]
+    queued = set()  # 已经加入下载的附件路径
+    download_queue = asyncio.Queue()
+    check_slots = asyncio.Semaphore(4)
+    running = {}  # 创作者地址 -> 正在进行的检查任务
+    wakeup = asyncio.Event()  # 检查完成后重新计算下一次检查的时间
+    log_signal.emit(f"开始监视 {len(watches)} 个创作者")
+
+    async def check(watch):
+        async with check_slots:
+            try:
+                new_links, validators = await check_creator(
+                    client, watch, proxy, max_retries, request_timeout, request_delay
+                )
+            except (httpx.HTTPError, asyncio.TimeoutError, PageFetchError) as e:
+                log_signal.emit(f"检查失败: {watch.url} {e}", "warning", "watch-check-failed")
+                watch.schedule(False, min_interval, max_interval)
+                return
+            count = 0
+            failed = 0
+            for link in new_links:
+                if interrupted[0]:
+                    return
+                await asyncio.sleep(client.pacing_delay(request_delay))
+                try:
+                    html = await get_page_html(link, client, proxy, max_retries, request_timeout)
+                except PageFetchError as e:
+                    log_signal.emit(f"无法获取帖子: {e}", "warning", "post-fetch-failed")
+                    failed += 1
+                    continue
+                if html:
+                    page_attachments = await read_post_page(html, link, attachment_filter)
+                    for attachment in page_attachments:
+                        path = attachment.relative_path
+                        if path not in queued and not library_index.has_attachment(
+                            save_path, attachment
+                        ):
+                            queued.add(path)
+                            download_queue.put_nowait(attachment)
+                            count += 1
+                # 帖子解析完、附件加入下载之后才记为已知，获取失败的帖子下次检查时重试
+                watch.known = ([post_id_from_url(link)] + watch.known)[:WATCH_KNOWN_POSTS]
+                save_watch_state(save_path, watches)
+            # 有帖子失败时不保存第一页的 ETag，否则下次检查得到 304 会漏掉这些帖子
+            if validators is not None and not failed:
+                watch.etag, watch.last_modified = validators
+            if new_links:
+                log_signal.emit(f"{watch.url} 有 {len(new_links)} 个新帖子，{count} 个附件加入下载")
+            watch.schedule(bool(new_links), min_interval, max_interval)
+            save_watch_state(save_path, watches)
+
+    # 把检查期间收集到的附件分批送进下载流程，每一批的后处理完成后再开始下一批
+    async def download_new_attachments():
+        while True:
+            batch = [await download_queue.get()]
+            while not download_queue.empty():
+                batch.append(download_queue.get_nowait())
+            await download_attachments(
+                batch,
+                options,
+                client,
+                breaker,
+                progress_signal,
+                log_signal,
+                interrupted,
+                bandwidth_limiter=bandwidth_limiter,
+                job_control=job_control,
+            )
+
+    def finish_check(url):
+        running.pop(url, None)
+        wakeup.set()
+
+    downloader = asyncio.create_task(download_new_attachments())
+    try:
+        while not interrupted[0] and not breaker.blocked:
+            if job_control is not None:
+                await job_control.wait_if_paused()
+            now = time.time()
+            for watch in watches:
+                if watch.next_check <= now and watch.url not in running:
+                    task = asyncio.create_task(check(watch))
+                    running[watch.url] = task
+                    task.add_done_callback(lambda _, url=watch.url: finish_check(url))
+            idle = [w.next_check for w in watches if w.url not in running]
+            next_check = min(idle, default=now + 60)
+            # 最多等一分钟，让暂停及时生效
+            wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(wakeup.wait(), min(max(next_check - time.time(), 1), 60))
+    finally:
+        tasks = list(running.values()) + [downloader]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        save_watch_state(save_path, watches)
+
+
+# 结构化日志: 任务中的日志只放进内存队列，由后台线程每隔 LOG_FLUSH_INTERVAL 秒批量写入
+# 下载目录中按大小轮换的 .kemono_log.jsonl，界面和终端每批只收到一条抽样后的摘要
+# 同一条日志 (或同一个 key 的日志，例如每次重试的失败) 在 LOG_REPEAT_WINDOW 秒内
+# 超过 LOG_REPEAT_LIMIT 次后不再逐条记录，窗口结束时记录一条省略的数量
+LOG_FILE_NAME = ".kemono_log.jsonl"
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+LOG_FLUSH_INTERVAL = 0.5
+LOG_DISPLAY_LINES = 20
+LOG_REPEAT_WINDOW = 10
+LOG_REPEAT_LIMIT = 3
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+class LogSink:
+    def __init__(self, save_path, output=None, display_level="info", file_level="debug"):
+        self.path = os.path.join(save_path, LOG_FILE_NAME) if save_path else None
+        self.output = output  # 接收摘要的信号，例如界面的日志信号或 ConsoleSignal
+        self.display_level = LOG_LEVELS[display_level]
+        self.file_level = LOG_LEVELS[file_level]
+        self.min_level = min(self.display_level, self.file_level)
+        self.lock = threading.Lock()
+        self.records = []  # (时间, 级别, 日志, 省略的条数)
+        self.repeats = {}  # key -> [窗口开始时间, 次数, 省略的条数, 最近一条省略的日志, 级别]
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = None
+        self.file = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    # 可以从任意线程调用，只把日志放进队列，不做任何 I/O
+    def emit(self, message, level="info", key=None):
+        if LOG_LEVELS[level] < self.min_level:
+            return
+        now = time.time()
+        key = key or message
+        with self.lock:
+            repeat = self.repeats.get(key)
+            if repeat is None or now - repeat[0] >= LOG_REPEAT_WINDOW:
+                if repeat is not None:
+                    self._summarize(repeat, now)
+                repeat = self.repeats[key] = [now, 0, 0, None, level]
+            repeat[1] += 1
+            if repeat[1] > LOG_REPEAT_LIMIT:
+                repeat[2] += 1
+                repeat[3] = message
+                return
+            self.records.append((now, level, message, 0))
+
+    # 在持有锁时调用，窗口中有省略的日志时记录一条摘要
+    def _summarize(self, repeat, now):
+        if repeat[2]:
+            self.records.append(
+                (
+                    now,
+                    repeat[4],
+                    f"省略了 {repeat[2]} 条类似的日志，最近一条: {repeat[3]}",
+                    repeat[2],
+                )
+            )
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(LOG_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self, final=False):
+        now = time.time()
+        with self.lock:
+            for key, repeat in list(self.repeats.items()):
+                if final or now - repeat[0] >= LOG_REPEAT_WINDOW:
+                    self._summarize(repeat, now)
+                    del self.repeats[key]
+            records, self.records = self.records, []
+        if records:
+            self._write(records)
+            self._display(records)
+
+    def _write(self, records):
+        if self.path is None:
+            return
+        lines = []
+        for created, level, message, repeated in records:
+            if LOG_LEVELS[level] < self.file_level:
+                continue
+            record = {
+                "time": datetime.datetime.fromtimestamp(created).isoformat(timespec="milliseconds"),
+                "level": level,
+                "message": message,
+            }
+            if repeated:
+                record["repeated"] = repeated
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        try:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write("".join(lines))
+            self.file.flush()
+            if self.file.tell() >= LOG_FILE_MAX_BYTES:
+                self._rotate()
+        except OSError as e:
+            # 日志文件写不进去时不影响下载，只在界面上提示一次
+            if self.output is not None:
+                self.output.emit(f"无法写入日志文件 {self.path}: {e}")
+            self.path = None
+
+    # .kemono_log.jsonl -> .kemono_log.jsonl.1 -> ... -> .kemono_log.jsonl.<LOG_FILE_BACKUPS>
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        for number in range(LOG_FILE_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    # 每批最多显示 LOG_DISPLAY_LINES 条，优先保留警告和错误，其余显示最新的
+    def _display(self, records):
+        if self.output is None:
+            return
+        shown = [r for r in records if LOG_LEVELS[r[1]] >= self.display_level]
+        if not shown:
+            return
+        keep = set()
+        if len(shown) > LOG_DISPLAY_LINES:
+            for important in (True, False):
+                for i in range(len(shown) - 1, -1, -1):
+                    if len(keep) >= LOG_DISPLAY_LINES:
+                        break
+                    if not important or LOG_LEVELS[shown[i][1]] >= LOG_LEVELS["warning"]:
+                        keep.add(i)
+        else:
+            keep = range(len(shown))
+        lines = [shown[i][2] for i in sorted(keep)]
+        if len(lines) < len(shown):
+            lines.insert(
+                0, f"(省略了 {len(shown) - len(lines)} 条日志，完整日志见 {LOG_FILE_NAME})"
+            )
+        self.output.emit("\n".join(lines))
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush(final=True)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# 后台下载进程: 界面把任务交给独立的进程运行，两者之间通过本地端口传递状态和命令
+# 下载进程在下载目录中写入 .kemono_engine.json (端口和口令)，界面关闭或重新打开后可以重新连接
+# 状态每隔 ENGINE_STATUS_INTERVAL 秒合并发送一次，只包含变化的进度、状态和新的日志行
+ENGINE_STATE_FILE_NAME = ".kemono_engine.json"
+ENGINE_LOG_FILE_NAME = ".kemono_engine.log"
+ENGINE_STATUS_INTERVAL = 0.25
+ENGINE_LOG_BACKLOG = 500
+
+
+# 下载进程中代替 Qt 信号的对象，可以从任意线程调用
+class EngineSignal:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, value):
+        self.callback(value)
+
+
+def load_engine_state(save_path):
+    try:
+        with open(os.path.join(save_path, ENGINE_STATE_FILE_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# 下载进程一侧: 记录最新的进度、状态和日志，接受界面的连接和命令
+#   {"cmd": "stop"} / {"cmd": "pause"} / {"cmd": "resume"}
+#   {"cmd": "bandwidth", "rate": 字节/秒, "schedule": "00:00-07:00=0,..."}
+class EngineServer:
+    def __init__(self, save_path, bandwidth_limiter, job_control):
+        self.state_file = os.path.join(save_path, ENGINE_STATE_FILE_NAME)
+        self.bandwidth_limiter = bandwidth_limiter
+        self.job_control = job_control
+        self.token = secrets.token_hex(16)
+        self.lock = threading.Lock()
+        self.progress = 0.0
+        self.state = "未开始"
+        self.logs = deque(maxlen=ENGINE_LOG_BACKLOG)  # (序号, 日志)
+        self.log_seq = 0
+        self.version = 0
+        self.done = False
+        self.error = None  # 任务出错结束时的错误信息，界面据此显示失败而不是完成
+        self.server = None
+        self.senders = set()
+        self.clients = {}  # 连接处理任务 -> writer
+        self.log_sink = None  # 任务的 LogSink，状态变化记录到日志文件
+        self.progress_signal = EngineSignal(self.set_progress)
+        self.log_signal = EngineSignal(self.add_log)
+        self.state_signal = EngineSignal(self.set_state)
+
+    def set_progress(self, value):
+        with self.lock:
+            self.progress = value
+            self.version += 1
+
+    def set_state(self, state):
+        with self.lock:
+            self.state = state
+            self.version += 1
+        if self.log_sink is not None:
+            self.log_sink.emit(f"任务状态: {state}", "debug")
+
+    # 收到的是 LogSink 整理过的摘要，完整日志已经由 LogSink 写入文件，这里只保存给界面
+    # 标准输出 (.kemono_engine.log) 只留给启动失败等致命错误
+    def add_log(self, message):
+        with self.lock:
+            self.log_seq += 1
+            self.logs.append((self.log_seq, message))
+            self.version += 1
+
+    def snapshot(self, log_seq):
+        with self.lock:
+            return self.version, {
+                "progress": self.progress,
+                "state": self.state,
+                "paused": self.job_control.paused,
+                "logs": [[seq, line] for seq, line in self.logs if seq > log_seq],
+                "done": self.done,
+                "error": self.error,
+            }
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_client, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        state = {"pid": os.getpid(), "port": port, "token": self.token}
+        temp_path = self.state_file + ".tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_file)
+
+    # 任务结束: 把最后的状态发给已连接的界面，然后关闭端口并删除状态文件
+    async def close(self):
+        with self.lock:
+            self.done = True
+            self.version += 1
+        if self.senders:
+            await asyncio.wait(self.senders, timeout=ENGINE_STATUS_INTERVAL * 8)
+        self.server.close()
+        for writer in self.clients.values():
+            writer.close()
+        if self.clients:
+            await asyncio.wait(self.clients, timeout=1)
+        await self.server.wait_closed()
+        state = load_engine_state(os.path.dirname(self.state_file))
+        if state is not None and state.get("pid") == os.getpid():
+            with contextlib.suppress(OSError):
+                os.remove(self.state_file)
+
+    async def _handle_client(self, reader, writer):
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(), 10))
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            writer.close()
+            return
+        if not isinstance(hello, dict) or hello.get("token") != self.token:
+            writer.close()
+            return
+        sender = asyncio.create_task(self._send_status(writer, hello.get("log_seq", 0)))
+        self.senders.add(sender)
+        sender.add_done_callback(self.senders.discard)
+        handler = asyncio.current_task()
+        self.clients[handler] = writer
+        try:
+            while not sender.done():
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    self.handle_command(json.loads(line))
+                except (ValueError, TypeError, KeyError, AttributeError) as e:
+                    self.add_log(f"无效的界面命令: {e}")
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(handler, None)
+            sender.cancel()
+            writer.close()
+
+    async def _send_status(self, writer, log_seq):
+        sent_version = None
+        while True:
+            version, status = self.snapshot(log_seq)
+            if version != sent_version:
+                if status["logs"]:
+                    log_seq = status["logs"][-1][0]
+                writer.write(json.dumps(status, ensure_ascii=False).encode("utf-8") + b"\n")
+                await writer.drain()
+                sent_version = version
+            if status["done"]:
+                return
+            await asyncio.sleep(ENGINE_STATUS_INTERVAL)
 
+    def handle_command(self, command):
+        name = command["cmd"]
+        if name == "stop":
+            self.job_control.stop()
+            self.add_log("下载任务已中止")
+        elif name == "pause":
+            self.job_control.pause()
+            self.add_log("下载任务已暂停")
+        elif name == "resume":
+            self.job_control.resume()
+            self.add_log("下载任务已继续")
+        elif name == "bandwidth":
+            self.bandwidth_limiter.set_rate(int(command["rate"]))
+            if command.get("schedule") is not None:
+                self.bandwidth_limiter.set_schedule(
+                    parse_bandwidth_schedule(command["schedule"])
+                )
+            self.add_log("带宽设置已更新")
+        else:
+            raise ValueError(f"未知命令 {name}")
+        with self.lock:
+            self.version += 1
 
-# 主函数
-async def main(
-    url,
-    use_proxy,
-    proxy_type,
-    proxy_address,
-    proxy_port,
-    max_retries,
-    request_delay,
-    request_timeout,
-    max_concurrent_requests,
-    save_path,
-    progress_signal,
-    log_signal,
-    interrupted,
-):
-    # 生成唯一的文件夹名称，例如使用时间戳
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_folder_name = f"download_{timestamp}"
-    unique_save_path = os.path.join(save_path, unique_folder_name)
-    os.makedirs(unique_save_path, exist_ok=True)  # 创建子文件夹
 
-    links = []
-    base_url = "https://kemono.su"
-    retry_queue = deque()
+# 在下载进程中运行任务，任务结束后通知界面，任务出错时把错误一起发给界面
+async def serve_engine(engine, job, log_sink=None):
+    await engine.start()
+    try:
+        await job
+    except Exception as e:
+        engine.error = f"{type(e).__name__}: {e}"
+        engine.add_log(f"下载任务出错: {engine.error}")
+        raise
+    finally:
+        # 先把日志队列中剩下的日志交给下载进程，界面收到的最后一次状态才包含完整的日志
+        if log_sink is not None:
+            log_sink.close()
+        await engine.close()
 
-    proxy = None
-    if use_proxy:
-        proxy = f"{proxy_type}://{proxy_address}:{proxy_port}"
 
-    limits = httpx.Limits(
-        max_keepalive_connections=max_concurrent_requests,
-        max_connections=max_concurrent_requests,
-    )
-    async with httpx.AsyncClient(limits=limits, proxies=proxy) as client:
-        html = await get_page_html(
-            url,
-            client,
-            proxy,
-            max_retries,
-            request_timeout,
+# 启动下载进程的命令行: 打包成 exe 时直接运行 exe 本身
+def engine_command(argv):
+    if getattr(sys, "frozen", False):
+        return [sys.executable, *argv, "--ipc"]
+    return [sys.executable, os.path.abspath(__file__), *argv, "--ipc"]
+
+
+# 启动与界面分离的下载进程，界面退出或崩溃时下载进程继续运行
+def launch_engine(argv, save_path):
+    options = {}
+    if os.name == "nt":
+        options["creationflags"] = (
+            subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        )
+    else:
+        options["start_new_session"] = True
+    with open(os.path.join(save_path, ENGINE_LOG_FILE_NAME), "ab") as log_file:
+        return subprocess.Popen(
+            engine_command(argv),
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            env={**os.environ, "PYTHONIOENCODING": "utf-8"},
+            **options,
         )
-        if html:
-            while url:
-                html = await get_page_html(
-                    url,
-                    client,
-                    proxy,
-                    max_retries,
-                    request_timeout,
-                )
-                if html:
-                    page_links = await extract_links(html)
-                    links.extend(page_links)
-                    url = await get_next_page_url(html, base_url)
-                    await asyncio.sleep(request_delay)  # 添加请求之间的延迟
-                else:
-                    break
 
-            semaphore = asyncio.Semaphore(max_concurrent_requests)
 
-            async def download_with_semaphore(url, file_name, client):
-                async with semaphore:
-                    await download_file(
-                        url,
-                        file_name,
-                        client,
-                        unique_save_path,  # 传递 unique_save_path 参数
-                        progress_signal,
-                        log_signal,
-                        interrupted,
-                        proxy,
-                        max_retries,
-                        request_timeout,
-                        retry_queue,
-                    )
+# 界面一侧: 启动或连接下载进程，把收到的状态转换成 Qt 信号，信号与 DownloadThread 相同
+class EngineProcess(QThread):
+    finished = Signal()
+    progress = Signal(float)
+    log = Signal(str)
+    state = Signal(str)
 
-            tasks = []
-            for link in links:
-                if interrupted[0]:
-                    log_signal.emit("任务已中断")
+    def __init__(self, save_path, argv=None):
+        super().__init__()
+        self.save_path = save_path
+        self.argv = argv  # 为 None 时连接已经在运行的下载进程
+        self.paused = False
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.detached = False
+        self.failed = False
+
+    def run(self):
+        try:
+            self.sock = self._connect()
+        except (OSError, RuntimeError, ValueError) as e:
+            self.log.emit(f"无法连接下载进程: {e}")
+            self.failed = True
+            self.finished.emit()
+            return
+        done = False
+        try:
+            for line in self.sock.makefile("r", encoding="utf-8"):
+                status = json.loads(line)
+                self.paused = status["paused"]
+                for _, message in status["logs"]:
+                    self.log.emit(message)
+                self.progress.emit(status["progress"])
+                self.state.emit(status["state"])
+                if status["done"]:
+                    done = True
+                    self.failed = status.get("error") is not None
                     break
-                html = await get_page_html(
-                    link,
-                    client,
-                    proxy,
-                    max_retries,
-                    request_timeout,
-                )
-                if html:
-                    soup = BeautifulSoup(html, "html.parser")
-                    for attachment_link in soup.find_all(
-                        "a", class_="post__attachment-link"
-                    ):
-                        href = attachment_link.get("href")
-                        if href:
-                            file_name = sanitize_filename(attachment_link.text)
-                            if file_name.endswith(".mp4") or file_name.endswith(".zip"):
-                                task = asyncio.create_task(
-                                    download_with_semaphore(href, file_name, client)
-                                )
-                                tasks.append(task)
-                                await asyncio.sleep(request_delay)  # 添加请求之间的延迟
-
-            await asyncio.gather(*tasks)
-
-            # 处理重试队列中的任务
-            if retry_queue:
-                log_signal.emit("开始处理重试队列中的任务")
-                await handle_retry_queue(
-                    client,
-                    retry_queue,
-                    unique_save_path,
-                    progress_signal,
-                    log_signal,
-                    interrupted,
-                    proxy,
-                    max_retries,
-                    request_timeout,
-                )
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.sock.close()
+        if not done and not self.detached:
+            self.log.emit(
+                f"与下载进程的连接已断开，详细日志见 {LOG_FILE_NAME}，"
+                f"致命错误见 {ENGINE_LOG_FILE_NAME}"
+            )
+            self.failed = True
+        if not self.detached:
+            self.finished.emit()
+
+    def _connect(self):
+        if self.argv is not None:
+            process = launch_engine(self.argv, self.save_path)
+            self.log.emit(f"已启动下载进程 (PID {process.pid})")
+            deadline = time.monotonic() + 30
+            while True:
+                state = load_engine_state(self.save_path)
+                if state is not None and state.get("pid") == process.pid:
+                    break
+                if process.poll() is not None:
+                    raise RuntimeError(
+                        f"下载进程已退出 (代码 {process.returncode})，错误信息见 {ENGINE_LOG_FILE_NAME}"
+                    )
+                if time.monotonic() > deadline:
+                    raise RuntimeError("等待下载进程启动超时")
+                time.sleep(0.1)
+        else:
+            state = load_engine_state(self.save_path)
+            if state is None:
+                raise RuntimeError("没有正在运行的下载进程")
+        sock = socket.create_connection(("127.0.0.1", state["port"]), timeout=5)
+        sock.settimeout(None)
+        sock.sendall(json.dumps({"token": state["token"]}).encode("utf-8") + b"\n")
+        return sock
+
+    def send(self, command):
+        if self.sock is None:
+            return
+        with self.send_lock:
+            try:
+                self.sock.sendall(json.dumps(command).encode("utf-8") + b"\n")
+            except OSError as e:
+                self.log.emit(f"发送命令失败: {e}")
+
+    # 关闭界面时只断开连接，下载进程继续运行
+    def detach(self):
+        self.detached = True
+        if self.sock is not None:
+            with contextlib.suppress(OSError):
+                self.sock.shutdown(socket.SHUT_RDWR)
+
+    def set_bandwidth(self, rate, schedule=None):
+        schedule_text = None
+        if schedule is not None:
+            schedule_text = ",".join(
+                f"{start:%H:%M}-{end:%H:%M}={period_rate}" for start, end, period_rate in schedule
+            )
+        self.send({"cmd": "bandwidth", "rate": rate, "schedule": schedule_text})
+
+    def stop(self):
+        self.send({"cmd": "stop"})
+
+    def pause(self):
+        self.send({"cmd": "pause"})
+        self.paused = True
+
+    def resume(self):
+        self.send({"cmd": "resume"})
+        self.paused = False
 
-    log_signal.emit("所有下载任务完成！")
+
+# 检查下载目录中是否有正在运行的下载进程
+def find_running_engine(save_path):
+    state = load_engine_state(save_path)
+    if state is None:
+        return None
+    try:
+        with socket.create_connection(("127.0.0.1", state["port"]), timeout=1):
+            return state
+    except (OSError, KeyError, TypeError):
+        return None
 
 
 # 下载线程类
@@ -313,66 +4394,80 @@ class DownloadThread(QThread):
     finished = Signal()
     progress = Signal(float)
     log = Signal(str)
+    state = Signal(str)
 
-    def __init__(
-        self,
-        url,
-        use_proxy,
-        proxy_type,
-        proxy_address,
-        proxy_port,
-        max_retries,
-        request_delay,
-        request_timeout,
-        max_concurrent_requests,
-        save_path,
-    ):
+    def __init__(self, url, options, bandwidth_limiter=None):
         super().__init__()
         self.url = url
-        self.use_proxy = use_proxy
-        self.proxy_type = proxy_type
-        self.proxy_address = proxy_address
-        self.proxy_port = proxy_port
-        self.max_retries = max_retries
-        self.request_delay = request_delay
-        self.request_timeout = request_timeout
-        self.max_concurrent_requests = max_concurrent_requests
-        self.save_path = save_path
+        self.options = options
+        # 带宽限制对象在下载过程中由界面线程直接修改
+        self.bandwidth_limiter = bandwidth_limiter or BandwidthLimiter()
+        self.log_sink = None
+        self.failed = False
         self.interrupted = [False]
+        self.job_control = JobControl(self.interrupted)
 
+    # 无论任务如何结束都发出 finished 信号，界面才能恢复开始按钮
     def run(self):
-        self.log.emit(f"开始下载: {self.url}")  # 发射日志信号
-        asyncio.run(
-            main(
-                self.url,
-                self.use_proxy,
-                self.proxy_type,
-                self.proxy_address,
-                self.proxy_port,
-                self.max_retries,
-                self.request_delay,
-                self.request_timeout,
-                self.max_concurrent_requests,
-                self.save_path,
-                self.progress,
-                self.log,
-                self.interrupted,
-            )
-        )
-        self.finished.emit()
+        self.log.emit(f"开始下载: {self.url or self.options.manifest_file}")  # 发射日志信号
+        try:
+            # 任务的日志经过日志队列批量写入文件，界面每批只收到一条摘要
+            self.log_sink = LogSink(self.options.save_path, self.log).start()
+            try:
+                asyncio.run(run_jobs(self.make_job, [self.url], self.interrupted, self.log_sink))
+            finally:
+                self.log_sink.close()
+                metadata_index.close()
+                parser_pool.shutdown()
+        except Exception as e:
+            self.failed = True
+            self.log.emit(f"下载任务出错: {type(e).__name__}: {e}")
+        finally:
+            self.finished.emit()
+
+    def make_job(self, url):
+        return main(
+            url,
+            self.options,
+            self.progress,
+            self.log_sink,
+            self.interrupted,
+            self.state,
+            self.bandwidth_limiter,
+            self.job_control,
+        )
+
+    def set_bandwidth(self, rate, schedule=None):
+        self.bandwidth_limiter.set_rate(rate)
+        if schedule is not None:
+            self.bandwidth_limiter.set_schedule(schedule)
 
     def stop(self):
-        self.interrupted[0] = True
+        self.job_control.stop()
         self.log.emit("下载任务已中止")  # 发射日志信号
 
+    def pause(self):
+        self.job_control.pause()
+        self.log.emit("下载任务已暂停")
+
+    def resume(self):
+        self.job_control.resume()
+        self.log.emit("下载任务已继续")
+
+    @property
+    def paused(self):
+        return self.job_control.paused
+
 
 # 主窗口类
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
+        self.download_thread = None
+        self.search_query = None
 
         self.setWindowTitle("Kemono Downloader")
-        self.setGeometry(100, 100, 600, 400)
+        self.setGeometry(100, 100, 700, 700)
 
         layout = QVBoxLayout()
 
@@ -381,62 +4476,212 @@ class MainWindow(QMainWindow):
         layout.addWidget(QLabel("目标URL:"))
         layout.addWidget(self.url_input)
 
+        self.save_path_input = QLineEdit()
+        self.save_path_input.setPlaceholderText("保存路径")
+        self.save_path_input.setReadOnly(True)  # 设置为只读
+        layout.addWidget(QLabel("保存路径:"))
+        layout.addWidget(self.save_path_input)
+
+        self.select_folder_button = QPushButton("选择下载目录路径")
+        self.select_folder_button.clicked.connect(self.select_folder)
+        layout.addWidget(self.select_folder_button)
+
+        # 其余设置按类别放在选项卡中，每页内容较多时可以滚动
+        tabs = QTabWidget()
+        layout.addWidget(tabs)
+
+        page = self.add_settings_tab(tabs, "任务")
+        self.manifest_input = QLineEdit()
+        self.manifest_input.setPlaceholderText("下载清单文件 (可选，.jsonl 或 .csv)")
+        page.addWidget(QLabel("下载清单:"))
+        page.addWidget(self.manifest_input)
+
+        self.select_manifest_button = QPushButton("选择下载清单文件")
+        self.select_manifest_button.clicked.connect(self.select_manifest)
+        page.addWidget(self.select_manifest_button)
+
+        self.plan_only_checkbox = QCheckBox("仅生成下载清单 (不下载)")
+        page.addWidget(self.plan_only_checkbox)
+
+        self.scratch_path_input = QLineEdit()
+        self.scratch_path_input.setPlaceholderText("临时下载目录 (可选，例如本地 SSD，下载完成后移动到保存路径)")
+        page.addWidget(QLabel("临时下载目录:"))
+        page.addWidget(self.scratch_path_input)
+
+        self.select_scratch_button = QPushButton("选择临时下载目录")
+        self.select_scratch_button.clicked.connect(self.select_scratch_folder)
+        page.addWidget(self.select_scratch_button)
+
+        self.scheduling_policy_combo = QComboBox()
+        for label, policy in (
+            ("按抓取顺序", "none"),
+            ("大文件优先", "largest"),
+            ("小文件优先", "smallest"),
+            ("按创作者轮流", "fair"),
+        ):
+            self.scheduling_policy_combo.addItem(label, policy)
+        page.addWidget(QLabel("下载调度策略:"))
+        page.addWidget(self.scheduling_policy_combo)
+
+        self.engine_process_checkbox = QCheckBox("在独立进程中下载 (关闭界面不会中断下载)")
+        self.engine_process_checkbox.setChecked(True)
+        page.addWidget(self.engine_process_checkbox)
+
+        page = self.add_settings_tab(tabs, "网络")
         self.use_proxy_checkbox = QCheckBox("使用代理")
-        layout.addWidget(self.use_proxy_checkbox)
+        page.addWidget(self.use_proxy_checkbox)
 
         self.proxy_type_combo = QComboBox()
-        self.proxy_type_combo.addItems(["http", "https"])
-        layout.addWidget(QLabel("代理类型:"))
-        layout.addWidget(self.proxy_type_combo)
+        self.proxy_type_combo.addItems(["http", "https", "socks5"])
+        page.addWidget(QLabel("代理类型:"))
+        page.addWidget(self.proxy_type_combo)
 
         self.proxy_address_input = QLineEdit()
         self.proxy_address_input.setPlaceholderText("代理地址")
-        layout.addWidget(QLabel("代理地址:"))
-        layout.addWidget(self.proxy_address_input)
+        page.addWidget(QLabel("代理地址:"))
+        page.addWidget(self.proxy_address_input)
 
         self.proxy_port_input = QLineEdit()
         self.proxy_port_input.setPlaceholderText("代理端口")
-        layout.addWidget(QLabel("代理端口:"))
-        layout.addWidget(self.proxy_port_input)
+        page.addWidget(QLabel("代理端口:"))
+        page.addWidget(self.proxy_port_input)
+
+        self.proxy_list_input = QLineEdit()
+        self.proxy_list_input.setPlaceholderText("代理列表文件 (可选，每行一个代理)")
+        page.addWidget(QLabel("代理列表文件:"))
+        page.addWidget(self.proxy_list_input)
+
+        self.select_proxy_list_button = QPushButton("选择代理列表文件")
+        self.select_proxy_list_button.clicked.connect(self.select_proxy_list)
+        page.addWidget(self.select_proxy_list_button)
 
         self.max_retries_input = QSpinBox()
         self.max_retries_input.setRange(1, 100)
         self.max_retries_input.setValue(20)
-        layout.addWidget(QLabel("最大重试次数:"))
-        layout.addWidget(self.max_retries_input)
+        page.addWidget(QLabel("最大重试次数:"))
+        page.addWidget(self.max_retries_input)
 
         self.request_delay_input = QSpinBox()
         self.request_delay_input.setRange(1, 60)
         self.request_delay_input.setValue(35)
-        layout.addWidget(QLabel("请求之间的延迟 (秒):"))
-        layout.addWidget(self.request_delay_input)
+        page.addWidget(QLabel("请求之间的延迟 (秒):"))
+        page.addWidget(self.request_delay_input)
 
         self.request_timeout_input = QSpinBox()
         self.request_timeout_input.setRange(10, 300)
         self.request_timeout_input.setValue(30)
-        layout.addWidget(QLabel("请求超时时间 (秒):"))
-        layout.addWidget(self.request_timeout_input)
+        page.addWidget(QLabel("请求超时时间 (秒):"))
+        page.addWidget(self.request_timeout_input)
 
         self.max_concurrent_requests_input = QSpinBox()
         self.max_concurrent_requests_input.setRange(1, 50)
         self.max_concurrent_requests_input.setValue(5)
-        layout.addWidget(QLabel("最大并发请求数:"))
-        layout.addWidget(self.max_concurrent_requests_input)
+        page.addWidget(QLabel("最大并发请求数:"))
+        page.addWidget(self.max_concurrent_requests_input)
 
-        self.save_path_input = QLineEdit()
-        self.save_path_input.setPlaceholderText("保存路径")
-        self.save_path_input.setReadOnly(True)  # 设置为只读
-        layout.addWidget(QLabel("保存路径:"))
-        layout.addWidget(self.save_path_input)
+        self.autotune_checkbox = QCheckBox("自动调整并发数 (以上面的值为起点)")
+        page.addWidget(self.autotune_checkbox)
 
-        self.select_folder_button = QPushButton("选择下载目录路径")
-        self.select_folder_button.clicked.connect(self.select_folder)
-        layout.addWidget(self.select_folder_button)
+        self.autotune_max_input = QSpinBox()
+        self.autotune_max_input.setRange(1, 50)
+        self.autotune_max_input.setValue(20)
+        page.addWidget(QLabel("自动调整的最大并发数:"))
+        page.addWidget(self.autotune_max_input)
+
+        self.breaker_error_rate_input = QSpinBox()
+        self.breaker_error_rate_input.setRange(10, 100)
+        self.breaker_error_rate_input.setValue(50)
+        page.addWidget(QLabel("熔断错误率阈值 (%):"))
+        page.addWidget(self.breaker_error_rate_input)
+
+        self.http2_checkbox = QCheckBox("页面请求使用 HTTP/2")
+        self.http2_checkbox.setEnabled(HTTP2_AVAILABLE)
+        page.addWidget(self.http2_checkbox)
+
+        page = self.add_settings_tab(tabs, "磁盘与带宽")
+        self.write_buffer_input = QSpinBox()
+        self.write_buffer_input.setRange(1, 256)
+        self.write_buffer_input.setValue(DEFAULT_WRITE_BUFFER_SIZE // (1024 * 1024))
+        page.addWidget(QLabel("写入缓冲区 (MB):"))
+        page.addWidget(self.write_buffer_input)
+
+        self.min_free_space_input = QSpinBox()
+        self.min_free_space_input.setRange(0, 10000)
+        self.min_free_space_input.setValue(DEFAULT_MIN_FREE_SPACE // 1024**3)
+        page.addWidget(QLabel("保留磁盘空间 (GB，剩余空间不足时暂停开始新的下载):"))
+        page.addWidget(self.min_free_space_input)
+
+        self.bandwidth_input = QSpinBox()
+        self.bandwidth_input.setRange(0, 100000)
+        self.bandwidth_input.setValue(0)
+        self.bandwidth_input.valueChanged.connect(self.apply_bandwidth)
+        page.addWidget(QLabel("带宽上限 (Mbit/s，0 为不限速，下载中可修改):"))
+        page.addWidget(self.bandwidth_input)
+
+        self.bandwidth_schedule_input = QLineEdit()
+        self.bandwidth_schedule_input.setPlaceholderText(
+            "可选，例如 00:00-07:00=0,07:00-23:00=300Mbit"
+        )
+        self.bandwidth_schedule_input.editingFinished.connect(self.apply_bandwidth)
+        page.addWidget(QLabel("带宽时间表:"))
+        page.addWidget(self.bandwidth_schedule_input)
+
+        page = self.add_settings_tab(tabs, "过滤与后处理")
+        self.extensions_input = QLineEdit(",".join(e[1:] for e in DEFAULT_EXTENSIONS))
+        self.extensions_input.setPlaceholderText("逗号分隔，留空表示下载所有类型")
+        page.addWidget(QLabel("下载的文件类型:"))
+        page.addWidget(self.extensions_input)
+
+        self.filter_file_input = QLineEdit()
+        self.filter_file_input.setPlaceholderText("过滤规则文件 (可选，JSON)")
+        page.addWidget(QLabel("过滤规则文件:"))
+        page.addWidget(self.filter_file_input)
+
+        self.select_filter_file_button = QPushButton("选择过滤规则文件")
+        self.select_filter_file_button.clicked.connect(self.select_filter_file)
+        page.addWidget(self.select_filter_file_button)
+
+        self.extract_checkbox = QCheckBox("下载完成后解压 zip")
+        page.addWidget(self.extract_checkbox)
+        self.checksum_checkbox = QCheckBox("下载完成后生成 .sha256 校验文件")
+        page.addWidget(self.checksum_checkbox)
+
+        self.postprocess_command_input = QLineEdit()
+        self.postprocess_command_input.setPlaceholderText("可选，{path} 为文件路径")
+        page.addWidget(QLabel("下载完成后执行的命令:"))
+        page.addWidget(self.postprocess_command_input)
+
+        page = self.add_settings_tab(tabs, "搜索")
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("文件名、标题或创作者，可加条件，例如 ext:zip year:2023")
+        self.search_input.returnPressed.connect(self.search_index)
+        page.addWidget(QLabel("搜索下载目录中已抓取的帖子和附件 (不访问网站):"))
+        page.addWidget(self.search_input)
+
+        self.search_button = QPushButton("搜索本地索引")
+        self.search_button.clicked.connect(self.search_index)
+        page.addWidget(self.search_button)
+
+        self.search_results = QTableWidget(0, len(SEARCH_RESULT_COLUMNS))
+        self.search_results.setHorizontalHeaderLabels([label for label, _ in SEARCH_RESULT_COLUMNS])
+        self.search_results.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.search_results.setVisible(False)
+        page.addWidget(self.search_results)
+
+        self.export_search_button = QPushButton("把搜索结果保存为下载清单")
+        self.export_search_button.clicked.connect(self.export_search_results)
+        self.export_search_button.setVisible(False)
+        page.addWidget(self.export_search_button)
 
         self.start_button = QPushButton("开始下载")
         self.start_button.clicked.connect(self.start_download)
         layout.addWidget(self.start_button)
 
+        self.pause_button = QPushButton("暂停")
+        self.pause_button.clicked.connect(self.toggle_pause)
+        self.pause_button.setEnabled(False)
+        layout.addWidget(self.pause_button)
+
         self.stop_button = QPushButton("停止下载")
         self.stop_button.clicked.connect(self.stop_download)
         self.stop_button.setEnabled(False)  # 初始状态下禁用停止按钮
@@ -447,6 +4692,9 @@ class MainWindow(QMainWindow):
         layout.addWidget(QLabel("下载进度:"))
         layout.addWidget(self.progress_bar)
 
+        self.state_label = QLabel("任务状态: 未开始")
+        layout.addWidget(self.state_label)
+
         self.log_output = QTextEdit()
         self.log_output.setReadOnly(True)
         layout.addWidget(QLabel("日志输出:"))
@@ -456,10 +4704,132 @@ class MainWindow(QMainWindow):
         container.setLayout(layout)
         self.setCentralWidget(container)
 
+    # 创建一个可以滚动的设置选项卡，返回放置设置项的布局
+    def add_settings_tab(self, tabs, title):
+        content = QWidget()
+        page = QVBoxLayout(content)
+        page.setAlignment(Qt.AlignTop)
+        scroll = QScrollArea()
+        scroll.setWidgetResizable(True)
+        scroll.setWidget(content)
+        tabs.addTab(scroll, title)
+        return page
+
     def select_folder(self):
         folder_path = QFileDialog.getExistingDirectory(self, "选择下载目录")
         if folder_path:
             self.save_path_input.setText(folder_path)
+            self.attach_engine(folder_path)
+
+    def select_scratch_folder(self):
+        folder_path = QFileDialog.getExistingDirectory(self, "选择临时下载目录")
+        if folder_path:
+            self.scratch_path_input.setText(folder_path)
+
+    # 下载目录中有上次启动的下载进程时重新连接，继续显示它的进度并可以控制它
+    def attach_engine(self, save_path):
+        if self.download_thread is not None and self.download_thread.isRunning():
+            return
+        state = find_running_engine(save_path)
+        if state is None:
+            return
+        self.log_output.append(f"已连接到正在运行的下载进程 (PID {state['pid']})")
+        self.start_thread(EngineProcess(save_path))
+
+    # 生成清单时选择保存位置，否则选择要执行的已有清单
+    def select_manifest(self):
+        file_filter = "下载清单 (*.jsonl *.csv);;所有文件 (*)"
+        if self.plan_only_checkbox.isChecked():
+            file_path, _ = QFileDialog.getSaveFileName(
+                self, "保存下载清单", "manifest.jsonl", file_filter
+            )
+        else:
+            file_path, _ = QFileDialog.getOpenFileName(
+                self, "选择下载清单", "", file_filter
+            )
+        if file_path:
+            self.manifest_input.setText(file_path)
+
+    # 在下载目录的元数据索引中搜索，最多显示 SEARCH_RESULT_LIMIT 个结果
+    def search_index(self):
+        save_path = self.save_path_input.text()
+        if not save_path:
+            QMessageBox.warning(self, "警告", "请先选择下载目录")
+            return
+        if not os.path.exists(os.path.join(save_path, METADATA_INDEX_FILE_NAME)):
+            QMessageBox.information(
+                self, "提示", "下载目录中还没有元数据索引，抓取过帖子之后才能搜索"
+            )
+            return
+        query = self.search_input.text()
+        index = MetadataIndex().open(save_path)
+        start = time.perf_counter()
+        try:
+            rows = index.search(query, SEARCH_RESULT_LIMIT)
+        except ValueError as e:
+            QMessageBox.warning(self, "警告", f"搜索条件无效: {e}")
+            return
+        finally:
+            index.close()
+        elapsed = time.perf_counter() - start
+        self.search_query = query
+        self.search_results.setRowCount(len(rows))
+        for row_number, row in enumerate(rows):
+            for column, (_, key) in enumerate(SEARCH_RESULT_COLUMNS):
+                value = row[key]
+                if key == "size":
+                    value = format_size(value) if value is not None else "未知"
+                elif key == "creator":
+                    value = row["creator_name"] or value
+                elif key == "local_path":
+                    value = value if os.path.isfile(value) else "未下载"
+                self.search_results.setItem(row_number, column, QTableWidgetItem(value or ""))
+        self.search_results.resizeColumnsToContents()
+        self.search_results.setVisible(True)
+        self.export_search_button.setVisible(bool(rows))
+        self.log_output.append(
+            f"搜索 \"{query}\": 找到 {len(rows)} 个附件"
+            + (f"，只显示前 {SEARCH_RESULT_LIMIT} 个" if len(rows) == SEARCH_RESULT_LIMIT else "")
+            + f"，耗时 {elapsed * 1000:.1f} 毫秒"
+        )
+
+    # 把上一次搜索的全部结果写入下载清单，并填入下载清单输入框，可以直接开始下载
+    def export_search_results(self):
+        save_path = self.save_path_input.text()
+        if self.search_query is None or not save_path:
+            return
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "保存下载清单", "search.jsonl", "下载清单 (*.jsonl *.csv);;所有文件 (*)"
+        )
+        if not file_path:
+            return
+        index = MetadataIndex().open(save_path)
+        try:
+            rows = index.search(self.search_query, 0)
+        finally:
+            index.close()
+        write_manifest(
+            file_path,
+            search_results_to_attachments(rows),
+            {row["path"] for row in rows if row["downloaded_at"]},
+        )
+        self.manifest_input.setText(file_path)
+        self.plan_only_checkbox.setChecked(False)
+        self.log_output.append(f"已把 {len(rows)} 个搜索结果保存到 {file_path}")
+
+    def select_filter_file(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "选择过滤规则文件", "", "JSON 文件 (*.json);;所有文件 (*)"
+        )
+        if file_path:
+            self.filter_file_input.setText(file_path)
+
+    def select_proxy_list(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "选择代理列表文件", "", "文本文件 (*.txt);;所有文件 (*)"
+        )
+        if file_path:
+            self.proxy_list_input.setText(file_path)
 
     def start_download(self):
         url = self.url_input.text()
@@ -472,55 +4842,593 @@ class MainWindow(QMainWindow):
         request_timeout = self.request_timeout_input.value()
         max_concurrent_requests = self.max_concurrent_requests_input.value()
         save_path = self.save_path_input.text()
+        proxy_list_file = self.proxy_list_input.text() or None
+        breaker_error_rate = self.breaker_error_rate_input.value() / 100
+        scheduling_policy = self.scheduling_policy_combo.currentData()
+        write_buffer_size = self.write_buffer_input.value() * 1024 * 1024
+        min_free_space = self.min_free_space_input.value() * 1024**3
+        scratch_path = self.scratch_path_input.text().strip() or None
+        autotune_bounds = None
+        if self.autotune_checkbox.isChecked():
+            autotune_bounds = (1, max(self.autotune_max_input.value(), max_concurrent_requests))
+        postprocess_command = self.postprocess_command_input.text().strip() or None
+        postprocess_actions = []
+        if self.extract_checkbox.isChecked():
+            postprocess_actions.append("extract")
+        if self.checksum_checkbox.isChecked():
+            postprocess_actions.append("checksum")
+        if postprocess_command:
+            postprocess_actions.append("command")
+        manifest_path = self.manifest_input.text() or None
+        plan_file = None
+        manifest_file = None
+        if self.plan_only_checkbox.isChecked():
+            plan_file = manifest_path
+        else:
+            manifest_file = manifest_path
 
-        if not url or not save_path:
+        if not (url or manifest_file) or not save_path:
             QMessageBox.warning(self, "警告", "请填写所有必填字段")
             return
+        if self.plan_only_checkbox.isChecked() and not (plan_file and url):
+            QMessageBox.warning(self, "警告", "生成下载清单需要填写目标URL和清单文件路径")
+            return
+        try:
+            attachment_filter = build_attachment_filter(
+                self.extensions_input.text(), self.filter_file_input.text() or None
+            )
+        except (OSError, ValueError, TypeError) as e:
+            QMessageBox.warning(self, "警告", f"过滤规则无效: {e}")
+            return
+        try:
+            rate, schedule = self.bandwidth_settings()
+        except ValueError as e:
+            QMessageBox.warning(self, "警告", f"带宽时间表无效: {e}")
+            return
+        if proxy_list_file:
+            try:
+                load_proxy_list(proxy_list_file)
+            except (OSError, ValueError) as e:
+                QMessageBox.warning(self, "警告", f"代理列表无效: {e}")
+                return
 
-        self.download_thread = DownloadThread(
-            url,
-            use_proxy,
-            proxy_type,
-            proxy_address,
-            proxy_port,
-            max_retries,
-            request_delay,
-            request_timeout,
-            max_concurrent_requests,
+        if self.engine_process_checkbox.isChecked():
+            if find_running_engine(save_path) is not None:
+                QMessageBox.warning(self, "警告", "该下载目录中已有正在运行的下载进程")
+                return
+            argv = ["download" if plan_file is None else "plan"]
+            if url:
+                argv.append(url)
+            if plan_file:
+                argv += ["-o", plan_file]
+            else:
+                argv += ["--schedule", scheduling_policy]
+            if manifest_file:
+                argv += ["--manifest", manifest_file]
+            argv += [
+                "--save-path", save_path,
+                "--max-retries", str(max_retries),
+                "--request-delay", str(request_delay),
+                "--request-timeout", str(request_timeout),
+                "--max-concurrent", str(max_concurrent_requests),
+                "--breaker-error-rate", str(breaker_error_rate),
+                "--write-buffer", str(write_buffer_size),
+                "--min-free-space", str(min_free_space),
+                "--bandwidth", f"{self.bandwidth_input.value()}Mbit",
+                "--ext", self.extensions_input.text(),
+            ]
+            if use_proxy:
+                argv += ["--proxy", f"{proxy_type}://{proxy_address}:{proxy_port}"]
+            if proxy_list_file:
+                argv += ["--proxy-list", proxy_list_file]
+            if self.bandwidth_schedule_input.text().strip():
+                argv += ["--bandwidth-schedule", self.bandwidth_schedule_input.text()]
+            if autotune_bounds is not None:
+                argv += [
+                    "--autotune",
+                    "--autotune-min", str(autotune_bounds[0]),
+                    "--autotune-max", str(autotune_bounds[1]),
+                ]
+            if postprocess_actions:
+                argv += ["--postprocess", ",".join(postprocess_actions)]
+            if postprocess_command:
+                argv += ["--postprocess-command", postprocess_command]
+            if self.filter_file_input.text():
+                argv += ["--filter-file", self.filter_file_input.text()]
+            if self.http2_checkbox.isChecked():
+                argv.append("--http2")
+            if scratch_path:
+                argv += ["--scratch-dir", scratch_path]
+            self.start_thread(EngineProcess(save_path, argv))
+            return
+
+        options = JobOptions(
             save_path,
+            max_retries=max_retries,
+            request_delay=request_delay,
+            request_timeout=request_timeout,
+            max_concurrent_requests=max_concurrent_requests,
+            use_proxy=use_proxy,
+            proxy_type=proxy_type,
+            proxy_address=proxy_address,
+            proxy_port=proxy_port,
+            proxy_list_file=proxy_list_file,
+            breaker_error_rate=breaker_error_rate,
+            scheduling_policy=scheduling_policy,
+            plan_file=plan_file,
+            manifest_file=manifest_file,
+            attachment_filter=attachment_filter,
+            write_buffer_size=write_buffer_size,
+            autotune_bounds=autotune_bounds,
+            postprocess_actions=postprocess_actions,
+            postprocess_command=postprocess_command,
+            http2=self.http2_checkbox.isChecked(),
+            min_free_space=min_free_space,
+            scratch_path=scratch_path,
         )
+        download_thread = DownloadThread(url, options, BandwidthLimiter(rate, schedule))
+        self.start_thread(download_thread)
+
+    # 启动下载线程或下载进程的连接线程，两者的信号和控制方法相同
+    def start_thread(self, download_thread):
+        self.download_thread = download_thread
         self.download_thread.finished.connect(self.download_finished)
         self.download_thread.progress.connect(self.update_progress)
         self.download_thread.log.connect(self.update_log)
+        self.download_thread.state.connect(self.update_state)
         self.download_thread.start()
 
         # 禁用开始按钮，启用停止按钮
         self.start_button.setEnabled(False)
+        self.pause_button.setEnabled(True)
+        self.pause_button.setText("暂停")
         self.stop_button.setEnabled(True)
 
+    # 读取界面上的带宽设置，返回 (字节/秒, 时间表)
+    def bandwidth_settings(self):
+        rate = self.bandwidth_input.value() * 1024 * 1024 // 8
+        schedule = parse_bandwidth_schedule(self.bandwidth_schedule_input.text())
+        return rate, schedule
+
+    # 下载过程中修改带宽设置立即生效
+    def apply_bandwidth(self):
+        try:
+            rate, schedule = self.bandwidth_settings()
+        except ValueError as e:
+            self.log_output.append(f"带宽时间表无效: {e}")
+            return
+        if self.download_thread is not None and self.download_thread.isRunning():
+            self.download_thread.set_bandwidth(rate, schedule)
+            self.log_output.append("带宽设置已更新")
+
     def stop_download(self):
         if self.download_thread:
             self.download_thread.stop()
             self.log_output.append("停止下载请求已发送")
+            self.pause_button.setEnabled(False)
+
+    # 暂停后不再开始新的请求，正在下载的文件保留已下载的部分，继续时接着下载
+    def toggle_pause(self):
+        if not self.download_thread:
+            return
+        if self.download_thread.paused:
+            self.download_thread.resume()
+            self.pause_button.setText("暂停")
+        else:
+            self.download_thread.pause()
+            self.pause_button.setText("继续")
+
+    # 关闭界面时断开与下载进程的连接，下载进程继续运行
+    def closeEvent(self, event):
+        if isinstance(self.download_thread, EngineProcess) and self.download_thread.isRunning():
+            self.download_thread.finished.disconnect(self.download_finished)
+            self.download_thread.detach()
+            self.download_thread.wait(2000)
+        super().closeEvent(event)
 
     def download_finished(self):
-        QMessageBox.information(self, "完成", "下载完成！")
+        if self.download_thread is not None and self.download_thread.failed:
+            QMessageBox.warning(self, "失败", "下载任务出错结束，详细信息见日志")
+        else:
+            QMessageBox.information(self, "完成", "下载完成！")
 
         # 启用开始按钮，禁用停止按钮
         self.start_button.setEnabled(True)
+        self.pause_button.setEnabled(False)
+        self.pause_button.setText("暂停")
         self.stop_button.setEnabled(False)
 
     @Slot(float)
     def update_progress(self, value):
         self.progress_bar.setValue(value)
 
+    @Slot(str)
+    def update_state(self, state):
+        self.state_label.setText(f"任务状态: {state}")
+        if self.download_thread is not None and self.download_thread.isRunning():
+            self.pause_button.setText("继续" if self.download_thread.paused else "暂停")
+
     @Slot(str)
     def update_log(self, message):
-        print(f"Log received: {message}")  # 调试信息
         self.log_output.append(message)
 
 
+# 命令行模式下代替 Qt 信号的对象，直接把日志打印到终端
+class ConsoleSignal:
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+
+    def emit(self, message):
+        if not self.quiet:
+            print(message, flush=True)
+
+
+# 命令行模式下从标准输入读取运行时命令:
+#   bandwidth 100Mbit   修改带宽上限 (0 为不限速)
+#   stop                停止下载
+def start_console_commands(bandwidth_limiter, job_control):
+    def read_commands():
+        for line in sys.stdin:
+            parts = line.split()
+            if not parts:
+                continue
+            command, args = parts[0].lower(), parts[1:]
+            try:
+                if command == "bandwidth" and args:
+                    bandwidth_limiter.set_rate(parse_bandwidth(args[0]))
+                    print(f"带宽上限已修改为 {args[0]}", flush=True)
+                elif command == "stop":
+                    job_control.stop()
+                    print("正在停止下载任务", flush=True)
+                elif command == "pause":
+                    job_control.pause()
+                    print("下载任务已暂停，输入 resume 继续", flush=True)
+                elif command == "resume":
+                    job_control.resume()
+                    print("下载任务已继续", flush=True)
+                else:
+                    print(f"未知命令: {line.strip()}", flush=True)
+            except ValueError as e:
+                print(f"命令无效: {e}", flush=True)
+
+    if sys.stdin is not None and sys.stdin.isatty():
+        threading.Thread(target=read_commands, daemon=True).start()
+
+
+# 命令行入口，不带参数运行时启动图形界面
+def run_cli(argv):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--save-path", required=True, help="下载目录")
+    common.add_argument("--proxy", help="单个代理，例如 socks5://127.0.0.1:1080")
+    common.add_argument("--proxy-list", help="代理列表文件")
+    common.add_argument("--max-retries", type=int, default=20)
+    common.add_argument("--request-delay", type=float, default=35)
+    common.add_argument("--request-timeout", type=float, default=30)
+    common.add_argument("--max-concurrent", type=int, default=5)
+    common.add_argument("--breaker-error-rate", type=float, default=0.5)
+    common.add_argument(
+        "--request-budget",
+        type=float,
+        help="所有请求合计的频率上限 (次/秒)，0 为不限制，监视模式默认 1，其他命令默认不限制",
+    )
+    common.add_argument(
+        "--log-level", choices=list(LOG_LEVELS), default="info",
+        help=f"终端显示的日志级别，完整日志写入下载目录的 {LOG_FILE_NAME}",
+    )
+    common.add_argument(
+        "--http2", action="store_true", help="页面和 HEAD 请求使用 HTTP/2，多个请求复用同一个连接"
+    )
+    common.add_argument(
+        "--autotune", action="store_true", help="根据下载速度和错误率自动调整并发数"
+    )
+    common.add_argument("--autotune-min", type=int, default=1)
+    common.add_argument("--autotune-max", type=int, default=20)
+    common.add_argument(
+        "--bandwidth", default="0", help="带宽上限，例如 300Mbit 或 30MB (按 1024 进制)，0 为不限速"
+    )
+    common.add_argument(
+        "--bandwidth-schedule", help="带宽时间表，例如 00:00-07:00=0,07:00-23:00=300Mbit"
+    )
+    common.add_argument(
+        "--write-buffer", type=parse_size, default=DEFAULT_WRITE_BUFFER_SIZE,
+        help="写入缓冲区大小，例如 8MB",
+    )
+    common.add_argument(
+        "--min-free-space", type=parse_size, default=DEFAULT_MIN_FREE_SPACE,
+        help="下载目录所在磁盘保留的剩余空间，例如 20GB，不足时暂停开始新的下载，默认 1GB",
+    )
+    common.add_argument(
+        "--scratch-dir",
+        help="临时下载目录 (例如本地 SSD)，文件下载完成并校验后再移动到下载目录",
+    )
+    common.add_argument(
+        "--max-staged", type=parse_size, default=DEFAULT_MAX_STAGED,
+        help="临时下载目录中等待移动的文件上限，例如 50GB，超过时暂停开始新的下载，默认 20GB",
+    )
+    common.add_argument(
+        "--postprocess", type=parse_postprocess_actions, default=[],
+        help="下载完成后的处理，逗号分隔: extract,checksum,command",
+    )
+    common.add_argument("--postprocess-command", help="后处理命令，{path} 为文件路径")
+    common.add_argument(
+        "--ext", default="mp4,zip", help="下载的扩展名，逗号分隔，空字符串表示全部"
+    )
+    common.add_argument("--include", action="append", help="文件名通配符或 re:正则")
+    common.add_argument("--exclude", action="append", help="排除的文件名通配符或 re:正则")
+    common.add_argument("--min-size", help="最小文件大小，例如 10MB (按 1024 进制)")
+    common.add_argument("--max-size", help="最大文件大小，例如 2GB (按 1024 进制)")
+    common.add_argument("--date-from", help="帖子发布日期下限 YYYY-MM-DD")
+    common.add_argument("--date-to", help="帖子发布日期上限 YYYY-MM-DD")
+    common.add_argument("--filter-file", help="JSON 过滤规则文件，指定后忽略上面的过滤参数")
+    common.add_argument(
+        "--ipc", action="store_true",
+        help="作为界面的后台下载进程运行，通过本地端口接收界面的连接和命令",
+    )
+
+    parser = argparse.ArgumentParser(description="Kemono Downloader")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser(
+        "plan", parents=[common], help="只抓取并生成下载清单，不下载"
+    )
+    plan_parser.add_argument("url")
+    plan_parser.add_argument("-o", "--output", required=True, help="清单文件 (.jsonl/.csv)")
+    download_parser = commands.add_parser("download", parents=[common], help="下载")
+    download_parser.add_argument(
+        "url", nargs="*", help="目标URL，可以指定多个，依次下载并复用同一组连接"
+    )
+    download_parser.add_argument("--manifest", help="执行已有的下载清单，不重新抓取")
+    download_parser.add_argument(
+        "--schedule", choices=sorted(SCHEDULING_POLICIES), default="none"
+    )
+    verify_parser = commands.add_parser(
+        "verify",
+        parents=[common],
+        help="校验下载目录中的文件，生成损坏和缺失文件的修复清单",
+    )
+    verify_parser.add_argument("--manifest", required=True, help="包含 sha256 的下载清单")
+    verify_parser.add_argument(
+        "-o", "--output", default="repair.jsonl", help="修复清单 (.jsonl/.csv)"
+    )
+    verify_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    verify_parser.add_argument(
+        "--repair", action="store_true", help="校验后立即重新下载损坏和缺失的文件"
+    )
+    publish_parser = commands.add_parser(
+        "publish", parents=[common], help="抓取附件并发布到任务队列，由 worker 下载"
+    )
+    publish_parser.add_argument("url", nargs="?")
+    publish_parser.add_argument("--manifest", help="发布已有的下载清单，不重新抓取")
+    publish_parser.add_argument("--queue", required=True, help="任务队列，例如 queue.db")
+    worker_parser = commands.add_parser(
+        "worker", parents=[common], help="从任务队列领取并下载附件，可以同时运行多个"
+    )
+    worker_parser.add_argument("--queue", required=True, help="任务队列，例如 queue.db")
+    worker_parser.add_argument("--worker-id", default=default_worker_id())
+    worker_parser.add_argument(
+        "--lease", type=float, default=300, help="任务租约时长 (秒)，超时未续约的任务会重新分配"
+    )
+    worker_parser.add_argument("--max-attempts", type=int, default=3)
+    status_parser = commands.add_parser("queue-status", help="查看任务队列的进度")
+    status_parser.add_argument("--queue", required=True, help="任务队列，例如 queue.db")
+    status_parser.add_argument("-o", "--output", help="把已完成的任务导出为下载清单")
+    migrate_parser = commands.add_parser(
+        "migrate", help="把旧的按时间命名的下载文件夹整理到 服务/创作者/帖子 结构中"
+    )
+    migrate_parser.add_argument("--save-path", required=True, help="下载目录")
+    migrate_parser.add_argument(
+        "--manifest", action="append", help="用来查找文件所属帖子的下载清单，可以指定多个"
+    )
+    watch_parser = commands.add_parser(
+        "watch", parents=[common], help="持续监视多个创作者，只下载新帖子的附件"
+    )
+    watch_parser.add_argument("--creators", required=True, help="创作者列表文件，每行一个地址")
+    watch_parser.add_argument("--min-interval", type=float, default=600, help="最短检查间隔 (秒)")
+    watch_parser.add_argument("--max-interval", type=float, default=3600, help="最长检查间隔 (秒)")
+    search_parser = commands.add_parser(
+        "search", help="在本地元数据索引中搜索抓取过的帖子和附件，不访问网站"
+    )
+    search_parser.add_argument(
+        "query", nargs="*", help="搜索词和过滤条件，例如 ext:zip year:2023 creator:12345"
+    )
+    search_parser.add_argument("--save-path", required=True, help="下载目录")
+    search_parser.add_argument("--limit", type=int, default=50, help="最多显示的结果数，0 为不限制")
+    search_parser.add_argument(
+        "-o", "--output", help="把搜索结果导出为下载清单，可以用 download --manifest 下载"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        migrate_library(args.save_path, args.manifest, ConsoleSignal())
+        return 0
+
+    if args.command == "search":
+        if not os.path.exists(os.path.join(args.save_path, METADATA_INDEX_FILE_NAME)):
+            print("下载目录中还没有元数据索引，抓取过帖子之后才能搜索")
+            return 1
+        index = MetadataIndex().open(args.save_path)
+        start = time.perf_counter()
+        try:
+            rows = index.search(" ".join(args.query), 0 if args.output else args.limit)
+        except ValueError as e:
+            parser.error(str(e))
+        elapsed = time.perf_counter() - start
+        for row in rows[: args.limit or None]:
+            print(
+                f"{row['published'] or '----------'}  {row['creator_name'] or row['creator']}"
+                f"  {row['title'] or ''}  {row['file_name']}"
+                f"  {format_size(row['size']) if row['size'] is not None else '大小未知'}"
+            )
+            if row["downloaded_at"] or os.path.isfile(row["local_path"]):
+                print(f"    {row['local_path']}")
+        posts, attachments = index.counts()
+        print(
+            f"找到 {len(rows)} 个附件 (索引中共 {posts} 个帖子、{attachments} 个附件，"
+            f"耗时 {elapsed * 1000:.1f} 毫秒)"
+        )
+        if args.output:
+            write_manifest(
+                args.output,
+                search_results_to_attachments(rows),
+                {row["path"] for row in rows if row["downloaded_at"]},
+            )
+            print(f"已导出到 {args.output}")
+        index.close()
+        return 0
+
+    if args.command == "queue-status":
+        work_queue = open_work_queue(args.queue)
+        counts = work_queue.counts()
+        print("，".join(f"{state} {count}" for state, count in sorted(counts.items())) or "队列为空")
+        if args.output:
+            done = work_queue.completed()
+            write_manifest(args.output, done, {a.relative_path for a in done})
+            print(f"已导出 {len(done)} 个已完成的任务到 {args.output}")
+        work_queue.close()
+        return 0
+
+    if args.command == "verify":
+        repair = verify_library(
+            args.save_path, args.manifest, args.output, args.workers, ConsoleSignal()
+        )
+        if not (repair and args.repair):
+            return 0
+        # 按修复清单重新下载，清单中的文件当初已经通过了过滤规则
+        args.command, args.url, args.manifest = "download", None, args.output
+        args.ext, args.filter_file = "", None
+
+    if "command" in args.postprocess and not args.postprocess_command:
+        parser.error("--postprocess command 需要同时指定 --postprocess-command")
+    if args.command in ("worker", "watch") and args.autotune:
+        # 这两个命令按批下载，每一批的下载时间太短，无法测量出合适的并发数
+        parser.error(f"{args.command} 不支持 --autotune，请用 --max-concurrent 指定并发数")
+    if args.command in ("download", "publish") and not (args.url or args.manifest):
+        parser.error(f"{args.command} 需要目标URL或 --manifest")
+    if args.proxy_list:
+        try:
+            load_proxy_list(args.proxy_list)
+        except (OSError, ValueError) as e:
+            parser.error(f"代理列表无效: {e}")
+    work_queue = None
+    if args.command == "publish":
+        work_queue = open_work_queue(args.queue)
+    elif args.command == "worker":
+        work_queue = open_work_queue(args.queue, args.lease, args.max_attempts)
+
+    attachment_filter = build_attachment_filter(
+        args.ext,
+        args.filter_file,
+        include=args.include,
+        exclude=args.exclude,
+        min_size=args.min_size,
+        max_size=args.max_size,
+        date_from=args.date_from,
+        date_to=args.date_to,
+    )
+
+    bandwidth_limiter = BandwidthLimiter(
+        parse_bandwidth(args.bandwidth), parse_bandwidth_schedule(args.bandwidth_schedule)
+    )
+    request_budget = args.request_budget
+    if request_budget is None:
+        request_budget = 1.0 if args.command == "watch" else 0
+    interrupted = [False]
+    job_control = JobControl(interrupted)
+    start_console_commands(bandwidth_limiter, job_control)
+    engine = None
+    progress_signal, log_signal, state_signal = (
+        ConsoleSignal(quiet=True), ConsoleSignal(), ConsoleSignal()
+    )
+    if args.ipc:
+        engine = EngineServer(args.save_path, bandwidth_limiter, job_control)
+        progress_signal, log_signal, state_signal = (
+            engine.progress_signal, engine.log_signal, engine.state_signal
+        )
+    log_signal = LogSink(args.save_path, log_signal, args.log_level).start()
+    if engine is not None:
+        engine.log_sink = log_signal
+
+    proxy_type, proxy_address, proxy_port = "http", "", ""
+    if args.proxy:
+        proxy_type, rest = args.proxy.split("://", 1)
+        proxy_address, proxy_port = rest.rsplit(":", 1)
+    # download 可以指定多个地址，依次运行并复用同一组连接；只执行清单时没有地址
+    urls = getattr(args, "url", None)
+    if not isinstance(urls, list):
+        urls = [urls]
+    elif not urls:
+        urls = [None]
+
+    options = JobOptions(
+        args.save_path,
+        max_retries=args.max_retries,
+        request_delay=args.request_delay,
+        request_timeout=args.request_timeout,
+        max_concurrent_requests=args.max_concurrent,
+        use_proxy=bool(args.proxy),
+        proxy_type=proxy_type,
+        proxy_address=proxy_address,
+        proxy_port=proxy_port,
+        proxy_list_file=args.proxy_list,
+        breaker_error_rate=args.breaker_error_rate,
+        scheduling_policy=getattr(args, "schedule", "none"),
+        plan_file=args.output if args.command == "plan" else None,
+        manifest_file=getattr(args, "manifest", None),
+        attachment_filter=attachment_filter,
+        write_buffer_size=args.write_buffer,
+        autotune_bounds=(args.autotune_min, args.autotune_max) if args.autotune else None,
+        postprocess_actions=args.postprocess,
+        postprocess_command=args.postprocess_command,
+        request_budget=request_budget,
+        http2=args.http2,
+        min_free_space=args.min_free_space,
+        scratch_path=args.scratch_dir,
+        max_staged=args.max_staged,
+    )
+    if args.command == "watch":
+        options.watch_urls = load_creator_list(args.creators)
+        options.watch_intervals = (args.min_interval, args.max_interval)
+    worker_id = args.worker_id if args.command == "worker" else None
+
+    def make_job(url):
+        return main(
+            url,
+            options,
+            progress_signal,
+            log_signal,
+            interrupted,
+            state_signal,
+            bandwidth_limiter,
+            job_control,
+            work_queue,
+            worker_id,
+        )
+
+    # Ctrl+C 会取消整个任务，正在进行的请求都会结束并删除未完成的文件
+    # 被停止的任务 (Ctrl+C、stop 命令或界面) 按中止退出，批量任务中后面的地址不再开始
+    try:
+        job = run_jobs(make_job, urls, interrupted, log_signal)
+        asyncio.run(job if engine is None else serve_engine(engine, job, log_signal))
+    except KeyboardInterrupt:
+        interrupted[0] = True
+    except LibraryDiskFullError:
+        return 1
+    finally:
+        log_signal.close()
+        metadata_index.close()
+        parser_pool.shutdown()
+        if work_queue is not None:
+            work_queue.close()
+    if interrupted[0]:
+        print("下载任务已中止", flush=True)
+        return 130
+    return 0
+
+
 if __name__ == "__main__":
+    # 打包成 exe 后，进程池的子进程会重新运行程序，必须先交给 multiprocessing 处理
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()